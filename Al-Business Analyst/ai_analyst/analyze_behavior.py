@@ -1,143 +1,162 @@
-import csv
 import os
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Set
 from collections import Counter
+from csv_ingest import CsvIngestError, open_csv
+from streaming_stats import RunningStats, should_stream
+from parallel_parse import parse_parallel, resolve_workers
+from incremental import analyze_incremental, load_state
+from job_runner import JobCancelled
+from behavior_table import BehaviorTable, parse_behavior_row, detect_phone_brand, detect_os_type
 
 # Путь к файлу по умолчанию
 DEFAULT_BEHAVIOR_FILE = r"c:\Users\bulat\Downloads\поведенческие паттерны клиентов.csv"
 
-def analyze_behavior_patterns(file_path: Optional[str] = None) -> Dict:
-    """Анализирует CSV файл с поведенческими паттернами клиентов"""
+# Версия анализатора: меняется при изменении формата результата
+ANALYZER_VERSION = 1
+
+class BehaviorAccumulator:
+    """Однопроходный аккумулятор статистики поведенческих паттернов"""
+    
+    def __init__(self):
+        self.os_changes = RunningStats()
+        self.phone_changes = RunningStats()
+        self.logins_7d = RunningStats()
+        self.logins_30d = RunningStats()
+        self.brands: Counter = Counter()
+        self.os_types: Counter = Counter()
+        self.suspicious_os = 0
+        self.suspicious_phone = 0
+        self.low_activity = 0
+        # Растет с числом уникальных клиентов, а не строк
+        self.clients: Set[str] = set()
+    
+    def update(self, rows: List[List[str]]):
+        """Обрабатывает пакет строк CSV"""
+        for row in rows:
+            record = parse_behavior_row(row)
+            if record is None:
+                continue
+            self.os_changes.update(record['monthly_os_changes'])
+            self.phone_changes.update(record['monthly_phone_model_changes'])
+            self.logins_7d.update(record['logins_last_7_days'])
+            self.logins_30d.update(record['logins_last_30_days'])
+            self.clients.add(record['cst_dim_id'])
+            
+            if record['monthly_os_changes'] >= 3:
+                self.suspicious_os += 1
+            if record['monthly_phone_model_changes'] >= 3:
+                self.suspicious_phone += 1
+            if record['logins_last_30_days'] < 5:
+                self.low_activity += 1
+            
+            brand = detect_phone_brand(record['last_phone_model'])
+            if brand:
+                self.brands[brand] += 1
+            os_type = detect_os_type(record['last_os'])
+            if os_type:
+                self.os_types[os_type] += 1
+    
+    def merge(self, other: "BehaviorAccumulator"):
+        """Добавляет результаты следующей части файла"""
+        self.os_changes.merge(other.os_changes)
+        self.phone_changes.merge(other.phone_changes)
+        self.logins_7d.merge(other.logins_7d)
+        self.logins_30d.merge(other.logins_30d)
+        self.brands.update(other.brands)
+        self.os_types.update(other.os_types)
+        self.suspicious_os += other.suspicious_os
+        self.suspicious_phone += other.suspicious_phone
+        self.low_activity += other.low_activity
+        self.clients |= other.clients
+    
+    def result(self) -> Dict:
+        """Возвращает словарь того же формата, что и analyze_behavior_patterns()"""
+        total = self.os_changes.count
+        if total == 0:
+            return {"error": "Не удалось прочитать данные из файла"}
+        return {
+            "total_records": total,
+            "unique_clients": len(self.clients),
+            "avg_os_changes": round(self.os_changes.mean, 2),
+            "avg_phone_changes": round(self.phone_changes.mean, 2),
+            "avg_logins_7d": round(self.logins_7d.mean, 2),
+            "avg_logins_30d": round(self.logins_30d.mean, 2),
+            "top_phone_brands": dict(self.brands.most_common(5)),
+            "os_distribution": dict(self.os_types),
+            "suspicious_os_changes": self.suspicious_os,
+            "suspicious_phone_changes": self.suspicious_phone,
+            "low_activity_clients": self.low_activity,
+            "suspicious_percentage": round((self.suspicious_os + self.suspicious_phone) / total * 100, 2)
+        }
+
+def _analyze_behavior_streaming(file_path: str,
+                                progress: Optional[Callable[[int, int, int], None]] = None) -> Dict:
+    """Потоковый анализ: файл читается пакетами, без списков на каждую колонку"""
+    try:
+        source = open_csv(file_path)
+    except CsvIngestError as e:
+        return {"error": str(e)}
+    
+    accumulator = BehaviorAccumulator()
+    total = os.path.getsize(file_path)
+    rows = 0
+    with source:
+        for batch in source.batches():
+            accumulator.update(batch)
+            rows += len(batch)
+            if progress is not None:
+                progress(source.bytes_read, total, rows)
+    return accumulator.result()
+
+def analyze_behavior_patterns(file_path: Optional[str] = None, streaming: Optional[bool] = None,
+                              workers: Optional[int] = None, incremental: bool = False,
+                              progress: Optional[Callable[[int, int, int], None]] = None) -> Dict:
+    """
+    Анализирует CSV файл с поведенческими паттернами клиентов
+    
+    Args:
+        file_path: Путь к CSV (по умолчанию DEFAULT_BEHAVIOR_FILE)
+        streaming: Потоковый режим с постоянным расходом памяти (для многогигабайтных выгрузок).
+            None - выбрать автоматически по размеру файла
+        workers: Число процессов для параллельного разбора (None - по размеру файла)
+        incremental: Разобрать только строки, дописанные с прошлого запуска
+            (для выгрузок, которые растут каждый день); без сохраненного состояния -
+            бинарный кеш или полный разбор
+        progress: progress(done, total, rows) - отчет о прогрессе для фоновых задач
+            (потоковый и инкрементальный режимы)
+    """
     if file_path is None:
         file_path = DEFAULT_BEHAVIOR_FILE
     
     if not os.path.exists(file_path):
         return {"error": f"Файл не найден: {file_path}"}
     
-    records = []
-    os_changes = []
-    phone_changes = []
-    logins_7d = []
-    logins_30d = []
-    os_types = []
-    phone_brands = []
-    
     try:
-        # Пробуем разные кодировки
-        encodings = ['utf-8-sig', 'cp1251', 'windows-1251', 'utf-8']
-        f = None
-        for enc in encodings:
-            try:
-                f = open(file_path, 'r', encoding=enc)
-                f.readline()
-                f.seek(0)
-                break
-            except:
-                if f:
-                    f.close()
-                continue
-        
-        if not f:
-            return {"error": "Не удалось определить кодировку файла"}
-        
-        with f:
-            reader = csv.reader(f, delimiter=';')
-            header1 = next(reader)  # Пропускаем русский заголовок
-            header2 = next(reader)  # Пропускаем английский заголовок
-            
-            for row in reader:
-                if len(row) >= 19:
-                    try:
-                        record = {
-                            'transdate': row[0],
-                            'cst_dim_id': row[1],
-                            'monthly_os_changes': int(float(row[2])) if row[2] and row[2] != '-1.0' else 0,
-                            'monthly_phone_model_changes': int(float(row[3])) if row[3] and row[3] != '-1.0' else 0,
-                            'last_phone_model': row[4],
-                            'last_os': row[5],
-                            'logins_last_7_days': int(float(row[6])) if row[6] and row[6] != '-1.0' else 0,
-                            'logins_last_30_days': int(float(row[7])) if row[7] and row[7] != '-1.0' else 0,
-                            'login_frequency_7d': float(row[8]) if row[8] and row[8] != '-1.0' else 0,
-                            'login_frequency_30d': float(row[9]) if row[9] and row[9] != '-1.0' else 0,
-                        }
-                        records.append(record)
-                        
-                        os_changes.append(record['monthly_os_changes'])
-                        phone_changes.append(record['monthly_phone_model_changes'])
-                        logins_7d.append(record['logins_last_7_days'])
-                        logins_30d.append(record['logins_last_30_days'])
-                        
-                        # Извлекаем бренд из модели телефона
-                        phone_model = record['last_phone_model']
-                        if phone_model:
-                            if 'iPhone' in phone_model or 'iOS' in phone_model:
-                                phone_brands.append('Apple')
-                            elif 'Samsung' in phone_model:
-                                phone_brands.append('Samsung')
-                            elif 'Xiaomi' in phone_model:
-                                phone_brands.append('Xiaomi')
-                            elif 'Huawei' in phone_model:
-                                phone_brands.append('Huawei')
-                            elif 'Oppo' in phone_model or 'OPPO' in phone_model:
-                                phone_brands.append('OPPO')
-                            elif 'Vivo' in phone_model:
-                                phone_brands.append('Vivo')
-                            else:
-                                phone_brands.append('Другое')
-                        
-                        # Извлекаем тип ОС
-                        os_type = record['last_os']
-                        if os_type:
-                            if 'iOS' in os_type:
-                                os_types.append('iOS')
-                            elif 'Android' in os_type:
-                                os_types.append('Android')
-                            else:
-                                os_types.append('Другое')
-                    except (ValueError, IndexError) as e:
-                        continue
-        
-        total = len(records)
-        if total == 0:
-            return {"error": "Не удалось прочитать данные из файла"}
-        
-        # Статистика по изменениям устройств
-        avg_os_changes = sum(os_changes) / len(os_changes) if os_changes else 0
-        avg_phone_changes = sum(phone_changes) / len(phone_changes) if phone_changes else 0
-        
-        # Статистика по логинам
-        avg_logins_7d = sum(logins_7d) / len(logins_7d) if logins_7d else 0
-        avg_logins_30d = sum(logins_30d) / len(logins_30d) if logins_30d else 0
+        if incremental:
+            state = load_state(file_path, "behavior")
+            if state is not None:
+                return analyze_incremental(file_path, BehaviorAccumulator, "behavior", progress, state).result()
         
-        # Распределение брендов
-        brand_counter = Counter(phone_brands)
-        top_brands = dict(brand_counter.most_common(5))
+        # Готовый бинарный кеш читается быстрее любого разбора CSV
+        table = BehaviorTable.from_cache(file_path)
+        if table is not None:
+            return table.statistics()
         
-        # Распределение ОС
-        os_counter = Counter(os_types)
-        os_distribution = dict(os_counter)
+        workers = resolve_workers(file_path, workers)
+        if incremental:
+            # Первый запуск: полный разбор (параллельный для больших файлов) сохраняет состояние
+            return analyze_incremental(file_path, BehaviorAccumulator, "behavior", progress, workers=workers).result()
+        if workers > 1:
+            return parse_parallel(file_path, BehaviorAccumulator, workers, progress=progress).result()
         
-        # Клиенты с подозрительным поведением (много изменений устройств)
-        suspicious_os = len([x for x in os_changes if x >= 3])
-        suspicious_phone = len([x for x in phone_changes if x >= 3])
+        if should_stream(file_path, streaming):
+            return _analyze_behavior_streaming(file_path, progress)
         
-        # Клиенты с низкой активностью
-        low_activity = len([x for x in logins_30d if x < 5])
-        
-        return {
-            "total_records": total,
-            "unique_clients": len(set([r['cst_dim_id'] for r in records])),
-            "avg_os_changes": round(avg_os_changes, 2),
-            "avg_phone_changes": round(avg_phone_changes, 2),
-            "avg_logins_7d": round(avg_logins_7d, 2),
-            "avg_logins_30d": round(avg_logins_30d, 2),
-            "top_phone_brands": top_brands,
-            "os_distribution": os_distribution,
-            "suspicious_os_changes": suspicious_os,
-            "suspicious_phone_changes": suspicious_phone,
-            "low_activity_clients": low_activity,
-            "suspicious_percentage": round((suspicious_os + suspicious_phone) / total * 100, 2) if total > 0 else 0
-        }
+        table = BehaviorTable.from_csv(file_path)
+        table.save_cache(file_path)
+        return table.statistics()
+    except JobCancelled:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
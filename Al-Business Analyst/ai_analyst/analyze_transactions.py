@@ -1,92 +1,139 @@
-import csv
 import os
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Union
+from csv_ingest import CsvIngestError, open_csv
+from transaction_table import TransactionTable
+from streaming_stats import RunningStats, should_stream
+from parallel_parse import parse_parallel, resolve_workers
+from incremental import analyze_incremental, load_state
+from job_runner import JobCancelled
 
 # Путь к файлу по умолчанию
 DEFAULT_TRANSACTIONS_FILE = r"c:\Users\bulat\Downloads\транзакции в Мобильном интернет Банкинге.csv"
 
-def analyze_transactions(file_path: Optional[str] = None) -> Dict:
-    """Анализирует CSV файл с транзакциями"""
+# Версия анализатора: меняется при изменении формата результата
+ANALYZER_VERSION = 1
+
+class TransactionAccumulator:
+    """Однопроходный аккумулятор статистики транзакций"""
+    
+    def __init__(self, sample_size: int = 5):
+        self.amounts = RunningStats()
+        self.fraud_amounts = RunningStats()
+        self.sample_size = sample_size
+        self.sample_rows: List[List[str]] = []
+    
+    def update(self, rows: List[List[str]]):
+        """Обрабатывает пакет строк CSV"""
+        for row in rows:
+            if len(row) < 7:
+                continue
+            amount = float(row[3]) if row[3] else 0
+            self.amounts.update(amount)
+            if row[6] == '1':
+                self.fraud_amounts.update(amount)
+            if len(self.sample_rows) < self.sample_size:
+                self.sample_rows.append(row)
+    
+    def merge(self, other: "TransactionAccumulator"):
+        """Добавляет результаты следующей части файла"""
+        self.amounts.merge(other.amounts)
+        self.fraud_amounts.merge(other.fraud_amounts)
+        free = self.sample_size - len(self.sample_rows)
+        if free > 0:
+            self.sample_rows.extend(other.sample_rows[:free])
+    
+    def result(self) -> Dict:
+        """Возвращает словарь того же формата, что и TransactionTable.statistics()"""
+        total = self.amounts.count
+        target_1 = self.fraud_amounts.count
+        fraud_percent = (target_1 / total * 100) if total > 0 else 0
+        return {
+            "total_transactions": total,
+            "normal_transactions": total - target_1,
+            "fraud_transactions": target_1,
+            "fraud_percentage": round(fraud_percent, 2),
+            "avg_amount": round(self.amounts.mean, 2),
+            "max_amount": round(self.amounts.max_or(0), 2),
+            "min_amount": round(self.amounts.min_or(0), 2),
+            "avg_fraud_amount": round(self.fraud_amounts.mean, 2),
+            "std_amount": round(self.amounts.std, 2),
+            "sample_transactions": TransactionTable.from_rows(self.sample_rows).records(self.sample_size)
+        }
+
+def _analyze_transactions_streaming(file_path: str,
+                                    progress: Optional[Callable[[int, int, int], None]] = None) -> Dict:
+    """Потоковый анализ: файл читается пакетами, память не зависит от его размера"""
+    try:
+        source = open_csv(file_path)
+    except CsvIngestError as e:
+        return {"error": str(e)}
+    
+    accumulator = TransactionAccumulator()
+    total = os.path.getsize(file_path)
+    rows = 0
+    with source:
+        for batch in source.batches():
+            accumulator.update(batch)
+            rows += len(batch)
+            if progress is not None:
+                progress(source.bytes_read, total, rows)
+    return accumulator.result()
+
+def analyze_transactions(file_path: Optional[str] = None, streaming: Optional[bool] = None,
+                         workers: Optional[int] = None, incremental: bool = False,
+                         progress: Optional[Callable[[int, int, int], None]] = None) -> Dict:
+    """
+    Анализирует CSV файл с транзакциями
+    
+    Args:
+        file_path: Путь к CSV (по умолчанию DEFAULT_TRANSACTIONS_FILE)
+        streaming: Потоковый режим с постоянным расходом памяти (для многогигабайтных выгрузок).
+            None - выбрать автоматически по размеру файла
+        workers: Число процессов для параллельного разбора (None - по размеру файла)
+        incremental: Разобрать только строки, дописанные с прошлого запуска
+            (для выгрузок, которые растут каждый день); без сохраненного состояния -
+            бинарный кеш или полный разбор
+        progress: progress(done, total, rows) - отчет о прогрессе для фоновых задач
+            (потоковый и инкрементальный режимы)
+    """
     if file_path is None:
         file_path = DEFAULT_TRANSACTIONS_FILE
     
     if not os.path.exists(file_path):
         return {"error": f"Файл не найден: {file_path}"}
     
-    transactions = []
-    target_0 = 0
-    target_1 = 0
-    
     try:
-        # Пробуем разные кодировки
-        encodings = ['utf-8-sig', 'cp1251', 'windows-1251', 'utf-8']
-        f = None
-        for enc in encodings:
-            try:
-                f = open(file_path, 'r', encoding=enc)
-                # Пробуем прочитать первую строку
-                f.readline()
-                f.seek(0)
-                break
-            except:
-                if f:
-                    f.close()
-                continue
-        
-        if not f:
-            return {"error": "Не удалось определить кодировку файла"}
-        
-        with f:
-            reader = csv.reader(f, delimiter=';')
-            header1 = next(reader)  # Пропускаем русский заголовок
-            header2 = next(reader)  # Пропускаем английский заголовок
-            
-            for row in reader:
-                if len(row) >= 7:
-                    transactions.append({
-                        'cst_dim_id': row[0],
-                        'transdate': row[1],
-                        'transdatetime': row[2],
-                        'amount': float(row[3]) if row[3] else 0,
-                        'docno': row[4],
-                        'direction': row[5],
-                        'target': int(row[6]) if row[6] else 0
-                    })
-                    if row[6] == '1':
-                        target_1 += 1
-                    else:
-                        target_0 += 1
+        if incremental:
+            state = load_state(file_path, "transactions")
+            if state is not None:
+                return analyze_incremental(file_path, TransactionAccumulator, "transactions", progress, state).result()
         
-        total = len(transactions)
-        fraud_percent = (target_1 / total * 100) if total > 0 else 0
-        
-        # Статистика по суммам
-        amounts = [t['amount'] for t in transactions]
-        avg_amount = sum(amounts) / len(amounts) if amounts else 0
-        max_amount = max(amounts) if amounts else 0
-        min_amount = min(amounts) if amounts else 0
+        # Готовый бинарный кеш читается быстрее любого разбора CSV
+        table = TransactionTable.from_cache(file_path)
+        if table is not None:
+            return table.statistics()
         
-        # Статистика по мошенническим транзакциям
-        fraud_transactions = [t for t in transactions if t['target'] == 1]
-        fraud_amounts = [t['amount'] for t in fraud_transactions]
-        avg_fraud_amount = sum(fraud_amounts) / len(fraud_amounts) if fraud_amounts else 0
+        workers = resolve_workers(file_path, workers)
+        if incremental:
+            # Первый запуск: полный разбор (параллельный для больших файлов) сохраняет состояние
+            return analyze_incremental(file_path, TransactionAccumulator, "transactions", progress, workers=workers).result()
+        if workers > 1:
+            return parse_parallel(file_path, TransactionAccumulator, workers, progress=progress).result()
         
-        return {
-            "total_transactions": total,
-            "normal_transactions": target_0,
-            "fraud_transactions": target_1,
-            "fraud_percentage": round(fraud_percent, 2),
-            "avg_amount": round(avg_amount, 2),
-            "max_amount": round(max_amount, 2),
-            "min_amount": round(min_amount, 2),
-            "avg_fraud_amount": round(avg_fraud_amount, 2),
-            "sample_transactions": transactions[:5]
-        }
+        if should_stream(file_path, streaming):
+            return _analyze_transactions_streaming(file_path, progress)
+        table = TransactionTable.from_csv(file_path)
+        table.save_cache(file_path)
+        return table.statistics()
+    except JobCancelled:
+        raise
     except Exception as e:
         return {"error": str(e)}
 
-def get_transaction_statistics_summary(stats: Dict) -> str:
-    """Форматирует статистику для вывода"""
+def get_transaction_statistics_summary(stats: Union[Dict, TransactionTable]) -> str:
+    """Форматирует статистику для вывода (принимает готовый словарь или таблицу транзакций)"""
+    if isinstance(stats, TransactionTable):
+        stats = stats.statistics()
     if "error" in stats:
         return f"❌ Ошибка: {stats['error']}"
     
@@ -0,0 +1,212 @@
+"""
+Каталог файлов пользователей.
+Вместо просмотра всей общей папки temp_files на каждый /files и /lastfile
+файлы регистрируются при сохранении (save_file, генерация документов),
+а списки читаются из SQLite по индексу (пользователь, время) - с
+постраничным выводом и без stat каждого файла. Очистка старых файлов
+тоже берет их из каталога. Если база пропала, каталог один раз
+восстанавливается по содержимому папки.
+
+Загрузки хранятся один раз по хешу содержимого (blob), записи пользователей
+ссылаются на него; blob удаляется вместе с последней ссылкой.
+Время последнего обращения к файлу нужно очистке по объему диска.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Путь к базе каталога
+ARTIFACT_DB_PATH = os.path.join("data", "artifacts.db")
+
+# Подпапка, где загрузки хранятся по хешу содержимого
+BLOB_DIR_NAME = "blobs"
+
+# Имена файлов пользователя начинаются с его id: {user_id}_...
+_USER_PREFIX = re.compile(r"^(\d+)_")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    blob TEXT,
+    accessed_at REAL
+);
+CREATE INDEX IF NOT EXISTS artifacts_user_time ON artifacts (user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS artifacts_time ON artifacts (created_at);
+CREATE INDEX IF NOT EXISTS artifacts_blob ON artifacts (blob);
+CREATE TABLE IF NOT EXISTS uploads (
+    file_unique_id TEXT PRIMARY KEY,
+    blob TEXT NOT NULL
+);
+"""
+
+
+def _row_to_file(row) -> Dict:
+    path, name, kind, size, created_at = row
+    return {
+        "name": name,
+        "path": path,
+        "kind": kind,
+        "size": size,
+        "modified": datetime.fromtimestamp(created_at)
+    }
+
+
+class ArtifactCatalog:
+    """Файлы пользователей в SQLite: списки по пользователю, по времени, постранично"""
+
+    def __init__(self, files_dir: str, db_path: str = ARTIFACT_DB_PATH):
+        self.files_dir = files_dir
+        self.blob_dir = os.path.join(files_dir, BLOB_DIR_NAME)
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        is_new = not os.path.exists(db_path)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(artifacts)")}
+        for column, column_type in (("blob", "TEXT"), ("accessed_at", "REAL")):
+            if columns and column not in columns:
+                # База от прошлой версии: добавляем колонку
+                self._conn.execute(f"ALTER TABLE artifacts ADD COLUMN {column} {column_type}")
+        self._conn.executescript(_SCHEMA)
+        # lower() в SQLite понимает только латиницу
+        self._conn.create_function("py_lower", 1, lambda text: text.lower() if text else text, deterministic=True)
+        self._lock = threading.Lock()
+        if is_new:
+            self.rebuild()
+
+    def add(self, user_id: int, path: str, kind: str = "document", blob: Optional[str] = None) -> Dict:
+        """Регистрирует сохраненный файл (blob - общий файл, на который ссылается запись)"""
+        # Время записи, а не mtime: у жесткой ссылки mtime общий с blob
+        created_at = time.time()
+        size = os.path.getsize(path)
+        row = (path, user_id, os.path.basename(path), kind, size, created_at, blob)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts (path, user_id, name, kind, size, created_at, blob) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", row
+            )
+        return _row_to_file((path, row[2], kind, size, created_at))
+
+    def remove(self, path: str) -> Optional[str]:
+        """
+        Удаляет запись. Возвращает путь blob, если это была последняя ссылка на него
+        (тогда blob можно удалить с диска).
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT blob FROM artifacts WHERE path = ?", (path,)).fetchone()
+            self._conn.execute("DELETE FROM artifacts WHERE path = ?", (path,))
+            blob = row[0] if row else None
+            if blob is None:
+                return None
+            if self._conn.execute("SELECT 1 FROM artifacts WHERE blob = ? LIMIT 1", (blob,)).fetchone():
+                return None
+            self._conn.execute("DELETE FROM uploads WHERE blob = ?", (blob,))
+        return blob
+
+    def touch(self, path: str):
+        """Отмечает обращение к файлу (очистка по диску удаляет давно не нужные первыми)"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE artifacts SET accessed_at = ? WHERE path = ?", (time.time(), path))
+
+    def entries(self) -> List[Tuple[str, int, int, float, Optional[str]]]:
+        """Все записи: (путь, пользователь, размер, последнее обращение, blob)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT path, user_id, size, COALESCE(accessed_at, created_at), blob FROM artifacts"
+            ).fetchall()
+
+    def references(self, blob: str) -> int:
+        """Число записей пользователей, ссылающихся на blob"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM artifacts WHERE blob = ?", (blob,)).fetchone()[0]
+
+    def tracked_paths(self) -> set:
+        """Пути всех файлов и blob в каталоге (для очистки файлов вне каталога)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, blob FROM artifacts").fetchall()
+        return {path for row in rows for path in row if path}
+
+    def upload_blob(self, file_unique_id: str) -> Optional[str]:
+        """blob, уже сохраненный для этого файла Telegram"""
+        with self._lock:
+            row = self._conn.execute("SELECT blob FROM uploads WHERE file_unique_id = ?",
+                                     (file_unique_id,)).fetchone()
+        return row[0] if row else None
+
+    def remember_upload(self, file_unique_id: str, blob: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO uploads (file_unique_id, blob) VALUES (?, ?)",
+                               (file_unique_id, blob))
+
+    def forget_upload(self, file_unique_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM uploads WHERE file_unique_id = ?", (file_unique_id,))
+
+    def list_user(self, user_id: int, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """Файлы пользователя, новые первыми"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, name, kind, size, created_at FROM artifacts WHERE user_id = ? "
+                "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (user_id, -1 if limit is None else limit, offset)
+            ).fetchall()
+        return [_row_to_file(row) for row in rows]
+
+    def count_user(self, user_id: int) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM artifacts WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    def find_user(self, user_id: int, name_part: str, limit: int = 1) -> List[Dict]:
+        """Файлы пользователя, в имени которых есть name_part (без учета регистра)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, name, kind, size, created_at FROM artifacts "
+                "WHERE user_id = ? AND instr(py_lower(name), ?) > 0 ORDER BY created_at DESC LIMIT ?",
+                (user_id, name_part.lower(), limit)
+            ).fetchall()
+        return [_row_to_file(row) for row in rows]
+
+    def older_than(self, cutoff: float) -> List[str]:
+        """Пути файлов, сохраненных раньше cutoff"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path FROM artifacts WHERE created_at < ?", (cutoff,)).fetchall()
+        return [row[0] for row in rows]
+
+    def rebuild(self) -> int:
+        """Заполняет каталог по файлам в папке (если база пропала)"""
+        # Ссылки на blob узнаются по общему inode
+        blobs = {}
+        if os.path.isdir(self.blob_dir):
+            for entry in os.scandir(self.blob_dir):
+                if entry.is_file() and not entry.name.startswith("."):
+                    blobs[entry.inode()] = entry.path
+        rows = []
+        if os.path.isdir(self.files_dir):
+            for entry in os.scandir(self.files_dir):
+                match = _USER_PREFIX.match(entry.name)
+                if match and entry.is_file():
+                    stat = entry.stat()
+                    rows.append((os.path.join(self.files_dir, entry.name), int(match.group(1)), entry.name,
+                                 "document", stat.st_size, stat.st_mtime, blobs.get(stat.st_ino)))
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM artifacts")
+            self._conn.execute("DELETE FROM uploads")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO artifacts (path, user_id, name, kind, size, created_at, blob) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,252 @@
+"""
+Колоночное представление поведенческих паттернов клиентов на базе NumPy
+"""
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from columnar_cache import ColumnarTable
+from csv_ingest import batched, concat_columns, open_csv, parse_int, to_datetime64
+
+
+def _parse_count(value: str) -> int:
+    """Значение -1.0 в выгрузке означает отсутствие данных"""
+    return int(float(value)) if value and value != '-1.0' else 0
+
+
+def _parse_float(value: str) -> float:
+    return float(value) if value and value != '-1.0' else 0
+
+
+def parse_behavior_row(row: List[str]) -> Optional[Dict]:
+    """Разбирает строку CSV с поведенческими паттернами, None для некорректных строк"""
+    if len(row) < 19:
+        return None
+    try:
+        return {
+            'transdate': row[0],
+            'cst_dim_id': row[1],
+            'monthly_os_changes': _parse_count(row[2]),
+            'monthly_phone_model_changes': _parse_count(row[3]),
+            'last_phone_model': row[4],
+            'last_os': row[5],
+            'logins_last_7_days': _parse_count(row[6]),
+            'logins_last_30_days': _parse_count(row[7]),
+            'login_frequency_7d': _parse_float(row[8]),
+            'login_frequency_30d': _parse_float(row[9]),
+        }
+    except (ValueError, IndexError):
+        return None
+
+
+def detect_phone_brand(phone_model: str) -> Optional[str]:
+    """Извлекает бренд из модели телефона"""
+    if not phone_model:
+        return None
+    if 'iPhone' in phone_model or 'iOS' in phone_model:
+        return 'Apple'
+    elif 'Samsung' in phone_model:
+        return 'Samsung'
+    elif 'Xiaomi' in phone_model:
+        return 'Xiaomi'
+    elif 'Huawei' in phone_model:
+        return 'Huawei'
+    elif 'Oppo' in phone_model or 'OPPO' in phone_model:
+        return 'OPPO'
+    elif 'Vivo' in phone_model:
+        return 'Vivo'
+    return 'Другое'
+
+
+def detect_os_type(os_name: str) -> Optional[str]:
+    """Извлекает тип ОС"""
+    if not os_name:
+        return None
+    if 'iOS' in os_name:
+        return 'iOS'
+    elif 'Android' in os_name:
+        return 'Android'
+    return 'Другое'
+
+
+class _Categories:
+    """Словарь категорий: значение -> код в порядке первого появления"""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+
+    def code(self, value: Optional[str]) -> int:
+        if value is None:
+            return -1
+        return self.codes.setdefault(value, len(self.codes))
+
+    def array(self) -> np.ndarray:
+        return np.array(list(self.codes), dtype=str)
+
+
+class BehaviorTable(ColumnarTable):
+    """Таблица поведенческих паттернов с типизированными колонками"""
+
+    CACHE_KIND = "behavior"
+    COLUMNS = ("transdate", "cst_dim_id", "monthly_os_changes", "monthly_phone_model_changes",
+               "logins_last_7_days", "logins_last_30_days", "login_frequency_7d", "login_frequency_30d",
+               "phone_model", "phone_model_categories", "os_name", "os_name_categories",
+               "brand", "brand_categories", "os_type", "os_type_categories")
+
+    def __init__(self, transdate: np.ndarray, cst_dim_id: np.ndarray, monthly_os_changes: np.ndarray,
+                 monthly_phone_model_changes: np.ndarray, logins_last_7_days: np.ndarray,
+                 logins_last_30_days: np.ndarray, login_frequency_7d: np.ndarray,
+                 login_frequency_30d: np.ndarray, phone_model: np.ndarray, phone_model_categories: np.ndarray,
+                 os_name: np.ndarray, os_name_categories: np.ndarray, brand: np.ndarray,
+                 brand_categories: np.ndarray, os_type: np.ndarray, os_type_categories: np.ndarray):
+        self.transdate = transdate
+        self.cst_dim_id = cst_dim_id
+        self.monthly_os_changes = monthly_os_changes
+        self.monthly_phone_model_changes = monthly_phone_model_changes
+        self.logins_last_7_days = logins_last_7_days
+        self.logins_last_30_days = logins_last_30_days
+        self.login_frequency_7d = login_frequency_7d
+        self.login_frequency_30d = login_frequency_30d
+        # Коды категорий, -1 - значение отсутствует
+        self.phone_model = phone_model
+        self.phone_model_categories = phone_model_categories
+        self.os_name = os_name
+        self.os_name_categories = os_name_categories
+        self.brand = brand
+        self.brand_categories = brand_categories
+        self.os_type = os_type
+        self.os_type_categories = os_type_categories
+
+    def __len__(self) -> int:
+        return len(self.cst_dim_id)
+
+    @classmethod
+    def from_batches(cls, batches: Iterable[List[List[str]]]) -> "BehaviorTable":
+        """
+        Строит таблицу из пакетов строк CSV, некорректные строки пропускаются.
+        Каждый пакет сразу переводится в массивы, списки живут только в пределах пакета.
+        """
+        dates: List[np.ndarray] = []
+        ids: List[np.ndarray] = []
+        os_changes: List[np.ndarray] = []
+        phone_changes: List[np.ndarray] = []
+        logins_7d: List[np.ndarray] = []
+        logins_30d: List[np.ndarray] = []
+        freq_7d: List[np.ndarray] = []
+        freq_30d: List[np.ndarray] = []
+        models: List[np.ndarray] = []
+        os_names: List[np.ndarray] = []
+        brands: List[np.ndarray] = []
+        os_types: List[np.ndarray] = []
+        model_categories, os_name_categories = _Categories(), _Categories()
+        brand_categories, os_type_categories = _Categories(), _Categories()
+
+        for batch in batches:
+            records = [record for record in map(parse_behavior_row, batch) if record is not None]
+            if not records:
+                continue
+            dates.append(to_datetime64([r['transdate'][:10] for r in records], "D"))
+            ids.append(np.array([parse_int(r['cst_dim_id']) for r in records], dtype=np.int64))
+            os_changes.append(np.array([r['monthly_os_changes'] for r in records], dtype=np.int32))
+            phone_changes.append(np.array([r['monthly_phone_model_changes'] for r in records], dtype=np.int32))
+            logins_7d.append(np.array([r['logins_last_7_days'] for r in records], dtype=np.int32))
+            logins_30d.append(np.array([r['logins_last_30_days'] for r in records], dtype=np.int32))
+            freq_7d.append(np.array([r['login_frequency_7d'] for r in records], dtype=np.float64))
+            freq_30d.append(np.array([r['login_frequency_30d'] for r in records], dtype=np.float64))
+            models.append(np.array([model_categories.code(r['last_phone_model'] or None) for r in records],
+                                   dtype=np.int32))
+            os_names.append(np.array([os_name_categories.code(r['last_os'] or None) for r in records],
+                                     dtype=np.int32))
+            brands.append(np.array([brand_categories.code(detect_phone_brand(r['last_phone_model']))
+                                    for r in records], dtype=np.int8))
+            os_types.append(np.array([os_type_categories.code(detect_os_type(r['last_os'])) for r in records],
+                                     dtype=np.int8))
+
+        return cls(
+            transdate=concat_columns(dates, "datetime64[D]"),
+            cst_dim_id=concat_columns(ids, np.int64),
+            monthly_os_changes=concat_columns(os_changes, np.int32),
+            monthly_phone_model_changes=concat_columns(phone_changes, np.int32),
+            logins_last_7_days=concat_columns(logins_7d, np.int32),
+            logins_last_30_days=concat_columns(logins_30d, np.int32),
+            login_frequency_7d=concat_columns(freq_7d, np.float64),
+            login_frequency_30d=concat_columns(freq_30d, np.float64),
+            phone_model=concat_columns(models, np.int32),
+            phone_model_categories=model_categories.array(),
+            os_name=concat_columns(os_names, np.int32),
+            os_name_categories=os_name_categories.array(),
+            brand=concat_columns(brands, np.int8),
+            brand_categories=brand_categories.array(),
+            os_type=concat_columns(os_types, np.int8),
+            os_type_categories=os_type_categories.array(),
+        )
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[str]]) -> "BehaviorTable":
+        """Строит таблицу из потока строк CSV (разбивается на пакеты, см. from_batches)"""
+        return cls.from_batches(batched(rows))
+
+    @classmethod
+    def from_csv(cls, file_path: str) -> "BehaviorTable":
+        """Читает CSV выгрузку поведенческих паттернов. Бросает CsvIngestError, если файл не читается"""
+        with open_csv(file_path) as source:
+            return cls.from_batches(source.batches())
+
+    def records(self, indices: Sequence[int]) -> List[Dict]:
+        """Строки таблицы с номерами indices в виде словарей"""
+
+        def category(codes, categories, i):
+            code = int(codes[i])
+            return str(categories[code]) if code >= 0 else ''
+
+        result = []
+        for i in indices:
+            result.append({
+                'transdate': str(self.transdate[i]),
+                'cst_dim_id': str(self.cst_dim_id[i]),
+                'monthly_os_changes': int(self.monthly_os_changes[i]),
+                'monthly_phone_model_changes': int(self.monthly_phone_model_changes[i]),
+                'last_phone_model': category(self.phone_model, self.phone_model_categories, i),
+                'last_os': category(self.os_name, self.os_name_categories, i),
+                'logins_last_7_days': int(self.logins_last_7_days[i]),
+                'logins_last_30_days': int(self.logins_last_30_days[i]),
+                'login_frequency_7d': float(self.login_frequency_7d[i]),
+                'login_frequency_30d': float(self.login_frequency_30d[i]),
+            })
+        return result
+
+    @staticmethod
+    def _distribution(codes: np.ndarray, categories: np.ndarray) -> Counter:
+        """Частоты категорий в порядке первого появления (как у Counter по списку)"""
+        present = codes[codes >= 0]
+        counts = np.bincount(present, minlength=len(categories)) if len(present) else np.zeros(len(categories), dtype=np.int64)
+        return Counter({str(categories[i]): int(counts[i]) for i in range(len(categories)) if counts[i]})
+
+    def statistics(self) -> Dict:
+        """Векторно считает агрегаты, формат совпадает с analyze_behavior_patterns()"""
+        total = len(self)
+        if total == 0:
+            return {"error": "Не удалось прочитать данные из файла"}
+
+        suspicious_os = int(np.count_nonzero(self.monthly_os_changes >= 3))
+        suspicious_phone = int(np.count_nonzero(self.monthly_phone_model_changes >= 3))
+        low_activity = int(np.count_nonzero(self.logins_last_30_days < 5))
+
+        brand_counter = self._distribution(self.brand, self.brand_categories)
+        os_counter = self._distribution(self.os_type, self.os_type_categories)
+
+        return {
+            "total_records": total,
+            "unique_clients": int(len(np.unique(self.cst_dim_id))),
+            "avg_os_changes": round(float(self.monthly_os_changes.sum(dtype=np.int64)) / total, 2),
+            "avg_phone_changes": round(float(self.monthly_phone_model_changes.sum(dtype=np.int64)) / total, 2),
+            "avg_logins_7d": round(float(self.logins_last_7_days.sum(dtype=np.int64)) / total, 2),
+            "avg_logins_30d": round(float(self.logins_last_30_days.sum(dtype=np.int64)) / total, 2),
+            "top_phone_brands": dict(brand_counter.most_common(5)),
+            "os_distribution": dict(os_counter),
+            "suspicious_os_changes": suspicious_os,
+            "suspicious_phone_changes": suspicious_phone,
+            "low_activity_clients": low_activity,
+            "suspicious_percentage": round((suspicious_os + suspicious_phone) / total * 100, 2)
+        }
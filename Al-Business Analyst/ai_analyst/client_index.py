@@ -0,0 +1,237 @@
+"""
+Индекс агрегатов по клиентам (cst_dim_id).
+Строится один раз по выгрузкам транзакций и поведенческих паттернов,
+сохраняется в бинарный кеш и отвечает на запрос по клиенту без повторного
+чтения CSV: поиск идет по отсортированному массиву идентификаторов.
+"""
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from analyze_behavior import DEFAULT_BEHAVIOR_FILE
+from analyze_transactions import DEFAULT_TRANSACTIONS_FILE
+from behavior_table import BehaviorTable
+from columnar_cache import file_content_hash, load_columns, save_columns
+from transaction_table import TransactionTable
+
+_NAT = np.datetime64('NaT')
+
+# Уже открытые индексы {(файл транзакций, mtime, файл поведения, mtime): ClientIndex}
+_loaded_indexes: Dict[Tuple, "ClientIndex"] = {}
+
+
+def _group_extreme(values: np.ndarray, groups: np.ndarray, size: int, latest: bool) -> np.ndarray:
+    """Минимум/максимум datetime64 по группам, NaT для групп без значений"""
+    result = np.full(size, _NAT, dtype=values.dtype)
+    valid = ~np.isnat(values)
+    if not valid.any():
+        return result
+    ints = values[valid].view(np.int64)
+    idx = groups[valid]
+    if latest:
+        acc = np.full(size, np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(acc, idx, ints)
+        found = acc != np.iinfo(np.int64).min
+    else:
+        acc = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(acc, idx, ints)
+        found = acc != np.iinfo(np.int64).max
+    result[found] = acc[found].view(values.dtype)
+    return result
+
+
+class ClientIndex:
+    """Агрегаты по клиентам, отсортированные по cst_dim_id"""
+
+    COLUMNS = ("client_id", "tx_count", "tx_total", "fraud_count", "first_tx", "last_tx",
+               "behavior_date", "phone_model", "phone_model_categories", "os_name", "os_name_categories",
+               "logins_last_7_days", "logins_last_30_days", "monthly_os_changes", "monthly_phone_model_changes")
+
+    def __init__(self, **columns):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self) -> int:
+        return len(self.client_id)
+
+    @classmethod
+    def build(cls, transactions: Optional[TransactionTable], behavior: Optional[BehaviorTable]) -> "ClientIndex":
+        """Векторно строит индекс по колоночным таблицам"""
+        tx_ids = transactions.cst_dim_id if transactions is not None else np.array([], dtype=np.int64)
+        bh_ids = behavior.cst_dim_id if behavior is not None else np.array([], dtype=np.int64)
+        client_id = np.union1d(tx_ids, bh_ids)
+        size = len(client_id)
+
+        columns = {"client_id": client_id}
+
+        # Транзакции
+        if transactions is not None and len(transactions):
+            groups = np.searchsorted(client_id, tx_ids)
+            columns["tx_count"] = np.bincount(groups, minlength=size).astype(np.int32)
+            columns["tx_total"] = np.bincount(groups, weights=transactions.amount, minlength=size)
+            columns["fraud_count"] = np.bincount(groups, weights=transactions.target, minlength=size).astype(np.int32)
+            columns["first_tx"] = _group_extreme(np.asarray(transactions.transdatetime), groups, size, latest=False)
+            columns["last_tx"] = _group_extreme(np.asarray(transactions.transdatetime), groups, size, latest=True)
+        else:
+            columns["tx_count"] = np.zeros(size, dtype=np.int32)
+            columns["tx_total"] = np.zeros(size, dtype=np.float64)
+            columns["fraud_count"] = np.zeros(size, dtype=np.int32)
+            columns["first_tx"] = np.full(size, _NAT, dtype="datetime64[s]")
+            columns["last_tx"] = np.full(size, _NAT, dtype="datetime64[s]")
+
+        # Поведение: берем самую свежую запись клиента
+        latest_columns = ("phone_model", "os_name", "logins_last_7_days", "logins_last_30_days",
+                          "monthly_os_changes", "monthly_phone_model_changes")
+        columns["behavior_date"] = np.full(size, _NAT, dtype="datetime64[D]")
+        for name in latest_columns:
+            columns[name] = np.full(size, -1, dtype=np.int32)
+        if behavior is not None and len(behavior):
+            dates = np.asarray(behavior.transdate).view(np.int64)
+            order = np.lexsort((dates, bh_ids))
+            sorted_ids = bh_ids[order]
+            # Последняя строка каждой группы одинаковых id
+            is_last = np.append(sorted_ids[1:] != sorted_ids[:-1], True)
+            latest = order[is_last]
+            positions = np.searchsorted(client_id, bh_ids[latest])
+            columns["behavior_date"][positions] = behavior.transdate[latest]
+            for name in latest_columns:
+                columns[name][positions] = getattr(behavior, name)[latest]
+            columns["phone_model_categories"] = np.asarray(behavior.phone_model_categories)
+            columns["os_name_categories"] = np.asarray(behavior.os_name_categories)
+        else:
+            columns["phone_model_categories"] = np.array([], dtype=str)
+            columns["os_name_categories"] = np.array([], dtype=str)
+
+        return cls(**columns)
+
+    def lookup(self, client_id: int) -> Optional[Dict]:
+        """Агрегаты по одному клиенту или None, если клиента нет в выгрузках"""
+        pos = int(np.searchsorted(self.client_id, client_id))
+        if pos >= len(self) or int(self.client_id[pos]) != client_id:
+            return None
+
+        def category(codes, categories):
+            code = int(codes[pos])
+            return str(categories[code]) if code >= 0 else None
+
+        def number(values):
+            value = int(values[pos])
+            return value if value >= 0 else None
+
+        def timestamp(values):
+            value = values[pos]
+            return None if np.isnat(value) else str(value).replace('T', ' ')
+
+        tx_count = int(self.tx_count[pos])
+        tx_total = float(self.tx_total[pos])
+        return {
+            "cst_dim_id": client_id,
+            "transactions": tx_count,
+            "total_amount": round(tx_total, 2),
+            "avg_amount": round(tx_total / tx_count, 2) if tx_count else 0,
+            "fraud_transactions": int(self.fraud_count[pos]),
+            "first_transaction": timestamp(self.first_tx),
+            "last_transaction": timestamp(self.last_tx),
+            "behavior_date": timestamp(self.behavior_date),
+            "last_phone_model": category(self.phone_model, self.phone_model_categories),
+            "last_os": category(self.os_name, self.os_name_categories),
+            "logins_last_7_days": number(self.logins_last_7_days),
+            "logins_last_30_days": number(self.logins_last_30_days),
+            "monthly_os_changes": number(self.monthly_os_changes),
+            "monthly_phone_model_changes": number(self.monthly_phone_model_changes),
+        }
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+
+def _index_location(transactions_file: Optional[str], behavior_file: Optional[str]) -> Tuple[str, str]:
+    """Файл, рядом с которым хранится индекс, и ключ кеша по содержимому обоих файлов"""
+    tx_hash = file_content_hash(transactions_file)[:16] if transactions_file else "none"
+    bh_hash = file_content_hash(behavior_file)[:16] if behavior_file else "none"
+    anchor = transactions_file or behavior_file
+    return anchor, f"clients-{tx_hash}-{bh_hash}"
+
+
+def get_client_index(transactions_file: Optional[str] = None,
+                     behavior_file: Optional[str] = None) -> Optional[ClientIndex]:
+    """
+    Возвращает индекс клиентов: из памяти процесса, из бинарного кеша
+    или строит его заново. None, если ни одной выгрузки нет.
+    """
+    transactions_file = transactions_file or DEFAULT_TRANSACTIONS_FILE
+    behavior_file = behavior_file or DEFAULT_BEHAVIOR_FILE
+    if not os.path.exists(transactions_file):
+        transactions_file = None
+    if not os.path.exists(behavior_file):
+        behavior_file = None
+    if transactions_file is None and behavior_file is None:
+        return None
+
+    memo_key = (
+        transactions_file, os.path.getmtime(transactions_file) if transactions_file else None,
+        behavior_file, os.path.getmtime(behavior_file) if behavior_file else None,
+    )
+    if memo_key in _loaded_indexes:
+        return _loaded_indexes[memo_key]
+
+    anchor, kind = _index_location(transactions_file, behavior_file)
+    columns = load_columns(anchor, kind, ClientIndex.COLUMNS)
+    if columns is not None:
+        index = ClientIndex(**columns)
+    else:
+        transactions = TransactionTable.load(transactions_file) if transactions_file else None
+        behavior = BehaviorTable.load(behavior_file) if behavior_file else None
+        index = ClientIndex.build(transactions, behavior)
+        save_columns(anchor, kind, index.to_columns())
+
+    _loaded_indexes.clear()
+    _loaded_indexes[memo_key] = index
+    return index
+
+
+def lookup_client(client_id: int, transactions_file: Optional[str] = None,
+                  behavior_file: Optional[str] = None) -> Dict:
+    """Агрегаты по клиенту для команды /client"""
+    try:
+        index = get_client_index(transactions_file, behavior_file)
+        if index is None:
+            return {"error": "Файлы выгрузок не найдены"}
+        info = index.lookup(client_id)
+        if info is None:
+            return {"error": f"Клиент {client_id} не найден"}
+        return info
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def get_client_summary(info: Dict) -> str:
+    """Форматирует агрегаты клиента для вывода"""
+    if "error" in info:
+        return f"❌ Ошибка: {info['error']}"
+
+    def value(key: str) -> str:
+        if info.get(key) is None:
+            return "нет данных"
+        # Модели телефонов вида Xiaomi_m2006c3mg ломают разметку Markdown
+        return str(info[key]).replace('_', '\\_')
+
+    return (
+        f"👤 **Клиент {info['cst_dim_id']}**\n\n"
+        f"💳 **Транзакции:**\n"
+        f"• Всего: {info['transactions']:,}\n"
+        f"• Сумма: {info['total_amount']:,.2f} ₸\n"
+        f"• Средняя сумма: {info['avg_amount']:,.2f} ₸\n"
+        f"• Мошеннических: {info['fraud_transactions']:,}\n"
+        f"• Первая: {value('first_transaction')}\n"
+        f"• Последняя: {value('last_transaction')}\n\n"
+        f"📱 **Устройство (на {value('behavior_date')}):**\n"
+        f"• Телефон: {value('last_phone_model')}\n"
+        f"• ОС: {value('last_os')}\n"
+        f"• Смен ОС за месяц: {value('monthly_os_changes')}\n"
+        f"• Смен модели телефона за месяц: {value('monthly_phone_model_changes')}\n\n"
+        f"🔐 **Логины:**\n"
+        f"• За 7 дней: {value('logins_last_7_days')}\n"
+        f"• За 30 дней: {value('logins_last_30_days')}"
+    )
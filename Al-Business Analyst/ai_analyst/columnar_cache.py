@@ -0,0 +1,186 @@
+"""
+Бинарный кеш разобранных CSV выгрузок.
+После первого разбора колонки сохраняются в .npy файлы рядом с загрузкой,
+повторный анализ того же файла открывает их через memory-map без разбора CSV.
+Ключ кеша - хеш содержимого файла и версия парсера.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Увеличивать при любом изменении разбора строк, чтобы старый кеш не использовался
+PARSER_VERSION = 1
+
+# Папка кеша создается рядом с исходным файлом
+CACHE_DIR_NAME = ".parsed_cache"
+
+_HASH_CHUNK = 1024 * 1024
+
+# Хеши уже прочитанных файлов {path: (size, mtime, sha256)}
+_hash_memo: Dict[str, Tuple[int, float, str]] = {}
+
+
+def file_content_hash(file_path: str) -> str:
+    """SHA-256 содержимого файла (запоминается по размеру и времени изменения)"""
+    stat = os.stat(file_path)
+    memo = _hash_memo.get(file_path)
+    if memo and memo[0] == stat.st_size and memo[1] == stat.st_mtime:
+        return memo[2]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+    content_hash = digest.hexdigest()
+    _hash_memo[file_path] = (stat.st_size, stat.st_mtime, content_hash)
+    return content_hash
+
+
+def remember_content_hash(file_path: str, content_hash: str):
+    """Запоминает хеш, уже посчитанный при загрузке файла, чтобы не читать файл повторно"""
+    stat = os.stat(file_path)
+    _hash_memo[file_path] = (stat.st_size, stat.st_mtime, content_hash)
+
+
+def content_hash_memo(paths: Iterable[str]) -> Dict[str, Tuple[int, float, str]]:
+    """
+    Хеши существующих файлов из paths вместе с размером и временем изменения.
+    Считается в главном процессе и передается фоновым задачам (restore_content_hashes),
+    чтобы каждый новый дочерний процесс не читал выгрузку целиком заново.
+    """
+    memo = {}
+    for path in paths:
+        if os.path.exists(path):
+            file_content_hash(path)
+            memo[path] = _hash_memo[path]
+    return memo
+
+
+def restore_content_hashes(memo: Dict[str, Tuple[int, float, str]]):
+    """Принимает хеши из content_hash_memo(); при изменении файла они не используются"""
+    _hash_memo.update(memo)
+
+
+def cache_dir_for(file_path: str, kind: str) -> str:
+    """Путь к папке кеша для файла и типа таблицы"""
+    key = f"{kind}-v{PARSER_VERSION}-{file_content_hash(file_path)[:32]}"
+    return os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR_NAME, key)
+
+
+def save_columns(file_path: str, kind: str, columns: Dict[str, np.ndarray]) -> Optional[str]:
+    """Сохраняет колонки в кеш. Запись атомарна: сначала во временную папку"""
+    target = cache_dir_for(file_path, kind)
+    if os.path.isdir(target):
+        return target
+    parent = os.path.dirname(target)
+    try:
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+        for name, array in columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(array), allow_pickle=False)
+        try:
+            os.rename(tmp_dir, target)
+        except OSError:
+            # Параллельный процесс успел записать тот же кеш
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return target
+    except Exception as e:
+        logging.warning(f"Ошибка записи кеша: {e}")
+        return None
+
+
+def load_columns(file_path: str, kind: str, names) -> Optional[Dict[str, np.ndarray]]:
+    """Открывает колонки из кеша через memory-map. None, если кеша нет"""
+    target = cache_dir_for(file_path, kind)
+    if not os.path.isdir(target):
+        return None
+    try:
+        columns = {
+            name: np.load(os.path.join(target, f"{name}.npy"), mmap_mode='r', allow_pickle=False)
+            for name in names
+        }
+    except (OSError, ValueError):
+        return None
+    # Отмечаем обращение, чтобы очистка удаляла только неиспользуемые записи
+    os.utime(target)
+    return columns
+
+
+def cleanup_cache(base_dir: str, max_age_hours: int = 24):
+    """Удаляет записи кеша, к которым давно не обращались"""
+    cache_root = os.path.join(base_dir, CACHE_DIR_NAME)
+    if not os.path.isdir(cache_root):
+        return
+    now = time.time()
+    for entry in os.listdir(cache_root):
+        path = os.path.join(cache_root, entry)
+        if os.path.isdir(path) and now - os.path.getmtime(path) > max_age_hours * 3600:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def cache_entries(base_dir: str) -> List[Tuple[str, int, float]]:
+    """Записи кеша: (папка, размер в байтах, последнее обращение)"""
+    cache_root = os.path.join(base_dir, CACHE_DIR_NAME)
+    if not os.path.isdir(cache_root):
+        return []
+    entries = []
+    for entry in os.scandir(cache_root):
+        # .tmp- - запись, которая еще пишется
+        if entry.is_dir() and not entry.name.startswith("."):
+            size = sum(item.stat().st_size for item in os.scandir(entry.path) if item.is_file())
+            entries.append((entry.path, size, entry.stat().st_mtime))
+    return entries
+
+
+class ColumnarTable(ABC):
+    """
+    Базовый класс колоночной таблицы с кешированием.
+    Наследники задают CACHE_KIND и COLUMNS (имена атрибутов-массивов).
+    """
+
+    CACHE_KIND = ""
+    COLUMNS: Tuple[str, ...] = ()
+
+    def to_columns(self) -> Dict[str, np.ndarray]:
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray]):
+        return cls(**columns)
+
+    @classmethod
+    @abstractmethod
+    def from_csv(cls, file_path: str):
+        """Разбирает CSV выгрузку. Бросает CsvIngestError, если файл не читается"""
+
+    @classmethod
+    def from_cache(cls, file_path: str):
+        """Таблица из бинарного кеша или None"""
+        columns = load_columns(file_path, cls.CACHE_KIND, cls.COLUMNS)
+        return cls.from_columns(columns) if columns is not None else None
+
+    def save_cache(self, file_path: str) -> Optional[str]:
+        return save_columns(file_path, self.CACHE_KIND, self.to_columns())
+
+    @classmethod
+    def load(cls, file_path: str, use_cache: bool = True):
+        """Берет таблицу из кеша, иначе разбирает CSV (см. from_csv) и сохраняет кеш"""
+        if use_cache:
+            table = cls.from_cache(file_path)
+            if table is not None:
+                return table
+        table = cls.from_csv(file_path)
+        if use_cache:
+            table.save_cache(file_path)
+        return table
+
+    def nbytes(self) -> int:
+        """Объем памяти, занимаемый колонками"""
+        return sum(np.asarray(getattr(self, name)).nbytes for name in self.COLUMNS)
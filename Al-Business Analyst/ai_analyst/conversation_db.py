@@ -0,0 +1,162 @@
+"""
+Хранение диалогов и метрик в SQLite, чтобы перезапуск бота не терял
+незавершенные интервью. База работает в режиме WAL, изменения копятся
+в памяти и записываются пакетом в одной транзакции. Сессия читается из
+базы только при следующем сообщении пользователя (ленивое восстановление),
+поэтому старт не зависит от числа сохраненных диалогов.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from history_compaction import content_text
+
+# Путь к базе диалогов
+CONVERSATION_DB_PATH = os.path.join("data", "conversations.db")
+
+# Как часто накопленные изменения записываются в базу (секунды)
+FLUSH_INTERVAL_SECONDS = 2.0
+
+# Сколько хранится диалог без активности
+CONVERSATION_RETENTION_DAYS = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id INTEGER PRIMARY KEY,
+    history TEXT NOT NULL,
+    metrics TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+"""
+
+
+def history_records(history) -> List[Dict]:
+    """История ChatSession в виде словарей (изображения заменяются текстовой заглушкой)"""
+    return [{"role": content.role, "parts": [content_text(content)]} for content in history]
+
+
+def serialize_history(history) -> str:
+    """История ChatSession в JSON"""
+    return json.dumps(history_records(history), ensure_ascii=False)
+
+
+class ConversationStore:
+    """Диалоги и метрики пользователей в SQLite с пакетной записью"""
+
+    def __init__(self, db_path: str = CONVERSATION_DB_PATH):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        # _lock - соединение с базой, _pending_lock - очередь изменений (короткие захваты из цикла событий)
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        # Несохраненные изменения {user_id: (снимок истории, metrics_json)} и удаления.
+        # История сериализуется в потоке flush(), а не в цикле событий
+        self._pending: Dict[int, tuple] = {}
+        self._deleted: set = set()
+
+    def load(self, user_id: int) -> Optional[Dict]:
+        """
+        Сохраненный диалог пользователя: {"history": [...], "metrics": {...} | None} или None.
+        Читает базу - из цикла событий вызывать через asyncio.to_thread.
+        """
+        with self._pending_lock:
+            if user_id in self._deleted:
+                return None
+            pending = self._pending.get(user_id)
+        if pending is not None:
+            history, metrics = pending
+            records = history_records(history)
+        else:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT history, metrics FROM conversations WHERE user_id = ?", (user_id,)
+                ).fetchone()
+            if row is None:
+                return None
+            history, metrics = row
+            records = json.loads(history)
+        return {"history": records, "metrics": json.loads(metrics) if metrics else None}
+
+    def save(self, user_id: int, history, metrics: Optional[Dict]):
+        """
+        Запоминает состояние диалога; в базу оно попадет при следующем flush().
+        Сохраняется только снимок списка реплик (сами реплики не меняются, сжатие
+        заменяет список целиком), сериализация - в потоке flush().
+        """
+        record = (list(history), json.dumps(metrics) if metrics else None)
+        with self._pending_lock:
+            self._deleted.discard(user_id)
+            self._pending[user_id] = record
+
+    def delete(self, user_id: int):
+        with self._pending_lock:
+            self._pending.pop(user_id, None)
+            self._deleted.add(user_id)
+
+    def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией, возвращает число записей"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            deleted, self._deleted = self._deleted, set()
+        if not pending and not deleted:
+            return 0
+        now = time.time()
+        rows: List[tuple] = [(user_id, serialize_history(history), metrics, now)
+                             for user_id, (history, metrics) in pending.items()]
+        try:
+            with self._lock, self._conn:
+                if deleted:
+                    self._conn.executemany("DELETE FROM conversations WHERE user_id = ?",
+                                           [(user_id,) for user_id in deleted])
+                self._conn.executemany(
+                    "INSERT INTO conversations (user_id, history, metrics, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET history = excluded.history, "
+                    "metrics = excluded.metrics, updated_at = excluded.updated_at",
+                    rows
+                )
+        except Exception:
+            # Возвращаем изменения в очередь, если за это время не пришли более новые
+            with self._pending_lock:
+                for user_id, record in pending.items():
+                    if user_id not in self._pending and user_id not in self._deleted:
+                        self._pending[user_id] = record
+                for user_id in deleted:
+                    if user_id not in self._pending:
+                        self._deleted.add(user_id)
+            raise
+        return len(rows) + len(deleted)
+
+    def purge_older_than(self, days: int = CONVERSATION_RETENTION_DAYS) -> int:
+        """Удаляет диалоги без активности дольше days дней"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM conversations WHERE updated_at < ?",
+                                        (time.time() - days * 86400,))
+        return cursor.rowcount
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+
+async def run_flush_loop(store: ConversationStore, interval: float = FLUSH_INTERVAL_SECONDS):
+    """Фоновая задача: периодически сбрасывает изменения в базу в отдельном потоке"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(None, store.flush)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить диалоги: {e}")
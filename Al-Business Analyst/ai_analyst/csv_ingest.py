@@ -0,0 +1,416 @@
+"""
+Общий слой чтения CSV выгрузок банка.
+Определяет кодировку по байтовой выборке, разбирает двухстрочный заголовок
+(русские описания + английские имена колонок), снимает кавычки с дат
+вида '2025-01-05 00:00:00.000' и отдает строки пакетами.
+"""
+import codecs
+import csv
+import glob
+import os
+import queue
+import re
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Сколько байт читаем для определения кодировки
+SNIFF_BYTES = 64 * 1024
+
+# Размер пакета строк
+INGEST_BATCH_SIZE = 10000
+
+# Сколько текста без строки с именами колонок ждем при потоковом разборе
+STREAM_HEADER_LIMIT = 4 * SNIFF_BYTES
+
+CSV_DELIMITER = ';'
+
+_COLUMN_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class CsvIngestError(Exception):
+    """Файл не удалось прочитать как CSV выгрузку"""
+
+
+def detect_encoding(sample: bytes) -> Optional[str]:
+    """
+    Определяет кодировку по первым байтам файла.
+    Выгрузки приходят в cp1251, но загруженные вручную файлы бывают в UTF-8.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # final=False: выборка может оборваться посреди многобайтного символа
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    try:
+        sample.decode('cp1251')
+        return 'cp1251'
+    except UnicodeDecodeError:
+        return None
+
+
+def sniff_file_encoding(file_path: str) -> Optional[str]:
+    """Читает байтовую выборку из начала файла и определяет кодировку"""
+    with open(file_path, 'rb') as f:
+        return detect_encoding(f.read(SNIFF_BYTES))
+
+
+def _is_column_row(row: List[str]) -> bool:
+    """Строка с английскими именами колонок (cst_dim_id;transdate;...)"""
+    return bool(row) and all(_COLUMN_NAME_RE.match(cell.strip()) for cell in row)
+
+
+def strip_quotes(value: str) -> str:
+    """Снимает кавычки с дат вида '2025-01-05 00:00:00.000'"""
+    if value[:1] in ("'", '"'):
+        return value.strip("'\"")
+    return value
+
+
+def quoted_column_indices(columns: List[str]) -> List[int]:
+    """Колонки с датами приходят в кавычках"""
+    return [i for i, name in enumerate(columns) if 'date' in name]
+
+
+def clean_rows(batch: List[List[str]], quoted_columns: List[int]) -> List[List[str]]:
+    """Снимает кавычки с дат в пакете строк (на месте)"""
+    for row in batch:
+        for i in quoted_columns:
+            if i < len(row):
+                row[i] = strip_quotes(row[i])
+    return batch
+
+
+def parse_int(value: str, default: int = -1) -> int:
+    """Целое из ячейки CSV, default для пустых и некорректных значений"""
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def to_datetime64(values: List[str], unit: str) -> np.ndarray:
+    """Векторно переводит строки дат в datetime64, некорректные значения становятся NaT"""
+    dtype = f"datetime64[{unit}]"
+    try:
+        return np.array(values, dtype=dtype)
+    except ValueError:
+        result = np.empty(len(values), dtype=dtype)
+        for i, value in enumerate(values):
+            try:
+                result[i] = np.datetime64(value, unit)
+            except ValueError:
+                result[i] = np.datetime64('NaT')
+        return result
+
+
+def concat_columns(chunks: List[np.ndarray], dtype) -> np.ndarray:
+    """Склеивает массивы пакетов в одну колонку (пустая колонка, если пакетов не было)"""
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=dtype)
+
+
+def batched(rows: Iterable[List[str]], batch_size: int = INGEST_BATCH_SIZE) -> Iterator[List[List[str]]]:
+    """Разбивает поток строк на пакеты по batch_size"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class CsvSource:
+    """
+    Открытый CSV файл выгрузки.
+
+    Атрибуты:
+        encoding: Определенная кодировка
+        columns: Имена колонок из английской строки заголовка
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.encoding = sniff_file_encoding(file_path)
+        if self.encoding is None:
+            raise CsvIngestError("Не удалось определить кодировку файла")
+
+        self._file = open(file_path, 'r', encoding=self.encoding, newline='')
+        self._reader = csv.reader(self._file, delimiter=CSV_DELIMITER)
+        try:
+            self.columns = self._read_header()
+        except Exception:
+            self._file.close()
+            raise
+        self.column_index: Dict[str, int] = {name: i for i, name in enumerate(self.columns)}
+        self.quoted_columns = quoted_column_indices(self.columns)
+
+    def _read_header(self) -> List[str]:
+        """Пропускает русский заголовок и возвращает имена колонок из английского"""
+        first = next(self._reader, None)
+        if first is None:
+            raise CsvIngestError("Файл пуст")
+        if _is_column_row(first):
+            return [cell.strip() for cell in first]
+        second = next(self._reader, None)
+        if second is None or not _is_column_row(second):
+            raise CsvIngestError("Не найдена строка с именами колонок")
+        return [cell.strip() for cell in second]
+
+    def batches(self, batch_size: int = INGEST_BATCH_SIZE) -> Iterator[List[List[str]]]:
+        """Отдает строки данных пакетами по batch_size"""
+        while True:
+            batch = list(islice(self._reader, batch_size))
+            if not batch:
+                return
+            yield clean_rows(batch, self.quoted_columns)
+
+    @property
+    def bytes_read(self) -> int:
+        """Сколько байт файла уже прочитано (с точностью до буфера чтения)"""
+        return self._file.buffer.tell()
+
+    def rows(self) -> Iterator[List[str]]:
+        """Построчный обход поверх пакетов"""
+        for batch in self.batches():
+            yield from batch
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "CsvSource":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_csv(file_path: str) -> CsvSource:
+    """Открывает CSV выгрузку. Бросает CsvIngestError, если файл не читается"""
+    return CsvSource(file_path)
+
+
+def _record_end(text: str, start: int) -> Optional[int]:
+    """Конец записи CSV, начатой в start (после перевода строки вне кавычек), или None"""
+    in_quotes = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == '\n' and not in_quotes:
+            return i + 1
+    return None
+
+
+class CsvStream:
+    """
+    CSV выгрузка, которая разбирается по мере загрузки.
+    feed() получает байты (из цикла событий), как только пришла строка с
+    именами колонок, известны columns; rows() отдает строки данных в
+    рабочем потоке и ждет следующих фрагментов, пока загрузка не закончится.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self.columns: Optional[List[str]] = None
+        self.quoted_columns: List[int] = []
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._head = ""
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._error: Optional[str] = None
+        self._closed = False
+
+    def feed(self, chunk: bytes, final: bool = False):
+        """Очередной фрагмент файла. Бросает CsvIngestError, если заголовок не найден"""
+        text = self._decoder.decode(chunk, final=final)
+        if self.columns is not None:
+            if text:
+                self._queue.put(text)
+            return
+        self._head += text
+        data = self._read_header(final)
+        if data:
+            self._queue.put(data)
+
+    def _read_header(self, final: bool) -> Optional[str]:
+        """Ищет строку с именами колонок в начале файла; возвращает текст после нее"""
+        head = self._head
+        start = 0
+        # Имена колонок стоят в первой или второй записи
+        for _ in range(2):
+            end = _record_end(head, start)
+            if end is None:
+                if not final and len(head) < STREAM_HEADER_LIMIT:
+                    return None
+                end = len(head)
+            row = next(csv.reader([head[start:end].rstrip('\r\n')], delimiter=CSV_DELIMITER), [])
+            if _is_column_row(row):
+                self.columns = [cell.strip() for cell in row]
+                self.quoted_columns = quoted_column_indices(self.columns)
+                self._head = ""
+                return head[end:]
+            if end >= len(head):
+                break
+            start = end
+        raise CsvIngestError("Не найдена строка с именами колонок")
+
+    def finish(self):
+        """Загрузка закончилась: дочитываем остаток"""
+        try:
+            self.feed(b"", final=True)
+        finally:
+            self.close()
+
+    def close(self, error: Optional[str] = None):
+        """Конец данных; с error - загрузка прервана, rows() бросит CsvIngestError"""
+        if self._closed:
+            return
+        self._closed = True
+        self._error = error
+        self._queue.put(None)
+
+    def _lines(self) -> Iterator[str]:
+        tail = ""
+        while True:
+            text = self._queue.get()
+            if text is None:
+                if self._error:
+                    raise CsvIngestError(self._error)
+                if tail:
+                    yield tail
+                return
+            lines = (tail + text).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+    def rows(self) -> Iterator[List[str]]:
+        """Строки данных по мере поступления (вызывать в рабочем потоке)"""
+        for row in csv.reader(self._lines(), delimiter=CSV_DELIMITER):
+            if row:
+                for i in self.quoted_columns:
+                    if i < len(row):
+                        row[i] = strip_quotes(row[i])
+                yield row
+
+
+def data_start_offset(file_path: str, encoding: str) -> int:
+    """
+    Байтовое смещение первой строки данных (после строки с именами колонок).
+    Русский заголовок может содержать перевод строки внутри кавычек,
+    поэтому границы записей ищем с учетом кавычек.
+    """
+    with open(file_path, 'rb') as f:
+        in_quotes = False
+        record_start = 0
+        offset = 0
+        while True:
+            block = f.read(SNIFF_BYTES)
+            if not block:
+                raise CsvIngestError("Не найдена строка с именами колонок")
+            for i, byte in enumerate(block):
+                if byte == 0x22:  # '"'
+                    in_quotes = not in_quotes
+                elif byte == 0x0A and not in_quotes:  # '\n'
+                    end = offset + i + 1
+                    f.seek(record_start)
+                    record = f.read(end - record_start).decode(encoding)
+                    f.seek(offset + len(block))
+                    row = next(csv.reader([record.rstrip('\r\n')], delimiter=CSV_DELIMITER), [])
+                    if _is_column_row(row):
+                        return end
+                    # Имена колонок стоят в первой или второй строке
+                    if record_start > 0:
+                        raise CsvIngestError("Не найдена строка с именами колонок")
+                    record_start = end
+            offset += len(block)
+
+
+def split_byte_ranges(file_path: str, parts: int, start: int,
+                      end: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Делит файл (или его часть [start, end)) на диапазоны байт, выровненные по переводам строк"""
+    size = os.path.getsize(file_path) if end is None else end
+    if start >= size:
+        return []
+    step = max(1, (size - start) // max(1, parts))
+    bounds = [start]
+    with open(file_path, 'rb') as f:
+        position = start + step
+        while position < size:
+            f.seek(position)
+            f.readline()  # дочитываем до конца текущей строки
+            aligned = f.tell()
+            if aligned >= size:
+                break
+            if aligned > bounds[-1]:
+                bounds.append(aligned)
+            position = aligned + step
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_byte_range_chunks(file_path: str, encoding: str, start: int, end: int,
+                           quoted_columns: List[int],
+                           block_size: int = 8 * 1024 * 1024) -> Iterator[Tuple[List[List[str]], int]]:
+    """
+    Читает строки данных из диапазона байт [start, end) пакетами.
+    Отдает пары (пакет, смещение конца пакета в файле) - по смещению считается прогресс.
+    Границы диапазона должны совпадать с началами строк (см. split_byte_ranges).
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        tail = b''
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            block = tail + block
+            if remaining > 0:
+                cut = block.rfind(b'\n') + 1
+                block, tail = block[:cut], block[cut:]
+            else:
+                tail = b''
+            lines = block.decode(encoding).split('\n')
+            batch = [row for row in csv.reader(lines, delimiter=CSV_DELIMITER) if row]
+            if batch:
+                yield clean_rows(batch, quoted_columns), end - remaining - len(tail)
+
+
+def iter_byte_range_batches(file_path: str, encoding: str, start: int, end: int,
+                            quoted_columns: List[int],
+                            block_size: int = 8 * 1024 * 1024) -> Iterator[List[List[str]]]:
+    """Пакеты строк из диапазона байт [start, end) (см. iter_byte_range_chunks)"""
+    for batch, _ in iter_byte_range_chunks(file_path, encoding, start, end, quoted_columns, block_size):
+        yield batch
+
+
+def measure_throughput(file_path: str) -> Dict:
+    """Замеряет скорость разбора файла (строк в секунду)"""
+    start = time.perf_counter()
+    rows = 0
+    with open_csv(file_path) as source:
+        encoding = source.encoding
+        for batch in source.batches():
+            rows += len(batch)
+    elapsed = time.perf_counter() - start
+    return {
+        "file": os.path.basename(file_path),
+        "encoding": encoding,
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "rows_per_second": round(rows / elapsed) if elapsed > 0 else 0
+    }
+
+
+if __name__ == "__main__":
+    print("\n=== Скорость разбора CSV ===")
+    for path in sorted(glob.glob(os.path.join("temp_files", "*.csv"))):
+        result = measure_throughput(path)
+        print(f"{result['file']}: {result['rows']:,} строк, {result['encoding']}, "
+              f"{result['seconds']} с, {result['rows_per_second']:,} строк/с")
@@ -0,0 +1,152 @@
+"""
+Периодическая очистка temp_files по возрасту и объему.
+Фоновая задача раз в DISK_SWEEP_INTERVAL_SECONDS удаляет файлы старше
+FILE_MAX_AGE_HOURS и файлы вне каталога, затем держит каждого пользователя
+в пределах USER_QUOTA_BYTES, а всю папку (вместе с кешем разобранных CSV) -
+в пределах TEMP_FILES_BUDGET_BYTES. Первыми удаляются файлы, к которым
+дольше всего не обращались. Проход по папке идет в рабочем потоке и не
+блокирует цикл событий. Счетчики освобожденных байт и удаленных файлов -
+в stats.
+"""
+import asyncio
+import logging
+import shutil
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from columnar_cache import cache_entries, cleanup_cache
+from file_handler import TEMP_DIR, catalog, remove_untracked_files, remove_user_file
+
+# Как часто проверять папку
+DISK_SWEEP_INTERVAL_SECONDS = 10 * 60
+
+# Сколько хранятся файлы пользователей
+FILE_MAX_AGE_HOURS = 24
+
+# Объем всей папки temp_files (файлы, blob и кеш разобранных CSV)
+TEMP_FILES_BUDGET_BYTES = 2 * 1024 * 1024 * 1024
+
+# Объем файлов одного пользователя (общий blob считается у каждого, кто на него ссылается)
+USER_QUOTA_BYTES = 200 * 1024 * 1024
+
+# Файлы, к которым обращались недавно, по объему не удаляются (с ними может идти анализ)
+EVICTION_GRACE_SECONDS = 10 * 60
+
+
+class DiskJanitor:
+    """Очистка temp_files: возраст, квоты пользователей, общий бюджет"""
+
+    def __init__(self, max_age_hours: float = FILE_MAX_AGE_HOURS,
+                 budget_bytes: int = TEMP_FILES_BUDGET_BYTES,
+                 user_quota_bytes: int = USER_QUOTA_BYTES,
+                 grace_seconds: float = EVICTION_GRACE_SECONDS):
+        self.max_age_hours = max_age_hours
+        self.budget_bytes = budget_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.grace_seconds = grace_seconds
+        self.stats = {
+            "runs": 0,
+            "files_evicted": 0,
+            "bytes_freed": 0,
+            "expired": 0,
+            "over_quota": 0,
+            "over_budget": 0,
+            "untracked": 0,
+            "cache_evicted": 0,
+            "disk_bytes": 0,
+        }
+
+    def _evict(self, path: str, reason: str) -> int:
+        freed = remove_user_file(path)
+        self.stats["files_evicted"] += 1
+        self.stats["bytes_freed"] += freed
+        self.stats[reason] += 1
+        return freed
+
+    def sweep(self) -> Dict:
+        """Один проход очистки (вызывать в рабочем потоке)"""
+        now = time.time()
+        cutoff = now - self.max_age_hours * 3600
+        for path in catalog.older_than(cutoff):
+            self._evict(path, "expired")
+        removed, freed = remove_untracked_files(cutoff)
+        self.stats["untracked"] += removed
+        self.stats["bytes_freed"] += freed
+        cleanup_cache(TEMP_DIR, self.max_age_hours)
+
+        entries = catalog.entries()
+        evicted = self._enforce_quotas(entries, now - self.grace_seconds)
+        entries = [entry for entry in entries if entry[0] not in evicted]
+        self.stats["disk_bytes"] = self._enforce_budget(entries, now - self.grace_seconds)
+        self.stats["runs"] += 1
+        return dict(self.stats)
+
+    def _enforce_quotas(self, entries: List[Tuple], protected_after: float) -> set:
+        """Удаляет давно не нужные файлы пользователей сверх квоты; возвращает удаленные пути"""
+        by_user: Dict[int, List[Tuple]] = defaultdict(list)
+        for entry in entries:
+            by_user[entry[1]].append(entry)
+        evicted = set()
+        for user_entries in by_user.values():
+            usage = sum(entry[2] for entry in user_entries)
+            if usage <= self.user_quota_bytes:
+                continue
+            for path, _, size, accessed_at, _ in sorted(user_entries, key=lambda entry: entry[3]):
+                if usage <= self.user_quota_bytes or accessed_at >= protected_after:
+                    break
+                self._evict(path, "over_quota")
+                evicted.add(path)
+                usage -= size
+        return evicted
+
+    def _enforce_budget(self, entries: List[Tuple], protected_after: float) -> int:
+        """
+        Держит объем папки в бюджете: кеш и файлы удаляются вместе в порядке
+        давности обращения. Возвращает объем после очистки.
+        """
+        # Ссылки на один blob занимают место один раз
+        blob_refs = Counter(entry[4] for entry in entries if entry[4])
+        usage = sum(entry[2] for entry in entries if not entry[4])
+        usage += sum({entry[4]: entry[2] for entry in entries if entry[4]}.values())
+        cache = cache_entries(TEMP_DIR)
+        usage += sum(size for _, size, _ in cache)
+        if usage <= self.budget_bytes:
+            return usage
+
+        # (последнее обращение, путь, размер, blob или None, запись кеша)
+        candidates = [(entry[3], entry[0], entry[2], entry[4], False) for entry in entries]
+        candidates += [(accessed_at, path, size, None, True) for path, size, accessed_at in cache]
+        for accessed_at, path, size, blob, is_cache in sorted(candidates):
+            if usage <= self.budget_bytes or accessed_at >= protected_after:
+                break
+            if is_cache:
+                shutil.rmtree(path, ignore_errors=True)
+                self.stats["cache_evicted"] += 1
+                self.stats["bytes_freed"] += size
+                usage -= size
+                continue
+            self._evict(path, "over_budget")
+            if blob:
+                blob_refs[blob] -= 1
+                if blob_refs[blob]:
+                    continue
+            usage -= size
+        return usage
+
+
+# Общий уборщик бота
+disk_janitor = DiskJanitor()
+
+
+async def run_disk_janitor(janitor: Optional[DiskJanitor] = None,
+                           interval: float = DISK_SWEEP_INTERVAL_SECONDS):
+    """Фоновая задача: первый проход сразу при запуске, дальше - раз в interval"""
+    janitor = janitor or disk_janitor
+    while True:
+        try:
+            stats = await asyncio.to_thread(janitor.sweep)
+            logging.info(f"Очистка temp_files: {stats}")
+        except Exception as e:
+            logging.error(f"Ошибка очистки temp_files: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,183 @@
+"""
+Имитация Gemini API для нагрузочных проверок и локального запуска без ключа.
+Подменяет асинхронный клиент модели, поэтому через нее проходят настоящие
+ChatSession, история и usage_metadata. Отвечает уточняющим вопросом после
+заданной задержки; на сообщение со словом «готово» возвращает итоговый JSON.
+Включается переменной окружения GEMINI_FAKE=1 (см. gemini_client).
+Запуск модуля прогоняет через имитацию планировщик запросов (check_scheduler).
+"""
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List
+
+import google.generativeai as genai
+from google.generativeai import protos
+
+from gemini_scheduler import GeminiScheduler, TokenBucket
+
+# Задержка ответа (секунды)
+FAKE_LATENCY_SECONDS = 0.5
+
+# Размер фрагмента при потоковом ответе (символы)
+FAKE_STREAM_CHUNK_CHARS = 40
+
+_FINAL_REPORT = {
+    "status": "completed",
+    "project_name": "Тестовый проект",
+    "goal": "Проверка бота без обращения к Gemini",
+    "summary": "Ответ сформирован имитацией Gemini",
+    "requirements": ["Бот принимает сообщения", "Бот формирует отчет"],
+    "mermaid_code": "sequenceDiagram\n    Пользователь->>Бот: Сообщение\n    Бот-->>Пользователь: Ответ",
+}
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 3)
+
+
+def _request_text(request) -> str:
+    return "\n".join(part.text for content in request.contents for part in content.parts if part.text)
+
+
+def _last_user_text(request) -> str:
+    for content in reversed(request.contents):
+        if content.role == "user":
+            return "\n".join(part.text for part in content.parts if part.text)
+    return ""
+
+
+class FakeGeminiClient:
+    """Подмена GenerativeServiceAsyncClient: generate_content и stream_generate_content"""
+
+    def __init__(self, latency: float = FAKE_LATENCY_SECONDS, chunk_chars: int = FAKE_STREAM_CHUNK_CHARS):
+        self.latency = latency
+        self.chunk_chars = chunk_chars
+        self.calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def _reply(self, request) -> str:
+        text = _last_user_text(request)
+        if "готово" in text.lower():
+            return json.dumps(_FINAL_REPORT, ensure_ascii=False)
+        return f"Уточните, пожалуйста: что происходит после шага «{text[:60]}»? (вопрос {self.calls})"
+
+    def _chunk(self, text: str, request, final: bool, reply: str) -> protos.GenerateContentResponse:
+        candidate = protos.Candidate(content=protos.Content(role="model", parts=[protos.Part(text=text)]))
+        response = protos.GenerateContentResponse(candidates=[candidate])
+        if final:
+            candidate.finish_reason = protos.Candidate.FinishReason.STOP
+            prompt_tokens = _estimate_tokens(_request_text(request))
+            reply_tokens = _estimate_tokens(reply)
+            response.usage_metadata = protos.GenerateContentResponse.UsageMetadata(
+                prompt_token_count=prompt_tokens,
+                candidates_token_count=reply_tokens,
+                total_token_count=prompt_tokens + reply_tokens,
+            )
+        return response
+
+    async def generate_content(self, request, **kwargs) -> protos.GenerateContentResponse:
+        self.calls += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            reply = self._reply(request)
+            return self._chunk(reply, request, True, reply)
+        finally:
+            self.in_flight -= 1
+
+    async def stream_generate_content(self, request, **kwargs) -> AsyncIterator[protos.GenerateContentResponse]:
+        self.calls += 1
+        reply = self._reply(request)
+        pieces = [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)] or [""]
+
+        async def chunks():
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            try:
+                # Первый фрагмент приходит быстрее полного ответа
+                step = self.latency / (len(pieces) + 1)
+                await asyncio.sleep(step * 2)
+                for i, piece in enumerate(pieces):
+                    if i:
+                        await asyncio.sleep(step)
+                    yield self._chunk(piece, request, i == len(pieces) - 1, reply)
+            finally:
+                self.in_flight -= 1
+
+        return chunks()
+
+
+def install_fake_gemini(*models, latency: float = FAKE_LATENCY_SECONDS) -> FakeGeminiClient:
+    """Подключает имитацию к моделям genai.GenerativeModel"""
+    client = FakeGeminiClient(latency=latency)
+    for model in models:
+        model._async_client = client
+    return client
+
+
+async def check_scheduler(users: int = 3, messages: int = 3, burst: int = 3,
+                          requests_per_minute: int = 600, latency: float = 0.05) -> Dict:
+    """
+    Прогоняет GeminiScheduler через имитацию так же, как services._run_turn:
+    ход пользователя, место в квоте, отправка в ChatSession.
+    Проверяет, что ответы каждому пользователю идут в порядке его сообщений,
+    ожидающие в очереди получают свою позицию, а ведро запросов (емкость burst)
+    растягивает поток до requests_per_minute.
+    """
+    from gemini_client import GEMINI_MODEL_NAME, send_chat_message
+
+    model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME)
+    client = install_fake_gemini(model, latency=latency)
+    scheduler = GeminiScheduler(requests_per_minute=requests_per_minute, max_user_queue=messages)
+    scheduler.requests = TokenBucket(burst, requests_per_minute)
+
+    answered: Dict[int, List[int]] = {user_id: [] for user_id in range(users)}
+    positions: List[int] = []
+
+    async def on_wait(position: int):
+        positions.append(position)
+
+    async def send(user_id: int, chat, number: int):
+        async with scheduler.user_turn(user_id):
+            await scheduler.acquire(100, on_wait)
+            response = await send_chat_message(chat, f"Сообщение {number}")
+            scheduler.settle(100, response.usage_metadata.total_token_count)
+            answered[user_id].append(number)
+            assert f"Сообщение {number}" in response.text, response.text
+
+    chats = {user_id: model.start_chat() for user_id in range(users)}
+    started = time.perf_counter()
+    await asyncio.gather(*(send(user_id, chats[user_id], number)
+                           for number in range(messages) for user_id in range(users)))
+    elapsed = time.perf_counter() - started
+
+    total = users * messages
+    # Порядок по пользователю: ответы и история сессии в порядке отправки
+    for user_id, numbers in answered.items():
+        assert numbers == list(range(messages)), f"пользователь {user_id}: {numbers}"
+        sent = [content.parts[0].text for content in chats[user_id].history if content.role == "user"]
+        assert sent == [f"Сообщение {number}" for number in range(messages)], sent
+    # Позиции в очереди: по одному уведомлению на каждый ожидавший запрос
+    assert len(positions) == scheduler.stats["queued"] > 0, positions
+    assert all(1 <= position <= users for position in positions), positions
+    # Квота: сверх burst запросы пропускаются не чаще requests_per_minute
+    min_seconds = (total - burst) * 60 / requests_per_minute
+    assert elapsed >= min_seconds * 0.9, f"{elapsed:.2f} с < {min_seconds:.2f} с"
+    assert client.calls == scheduler.stats["admitted"] == total
+    return {
+        "requests": total,
+        "seconds": round(elapsed, 2),
+        "min_seconds": round(min_seconds, 2),
+        "queued": scheduler.stats["queued"],
+        "positions": positions,
+    }
+
+
+if __name__ == "__main__":
+    result = asyncio.run(check_scheduler())
+    print("\n=== Планировщик Gemini на имитации ===")
+    print(f"{result['requests']} запросов за {result['seconds']} с (квота: не меньше {result['min_seconds']} с), "
+          f"ждали в очереди: {result['queued']}, позиции: {result['positions']}")
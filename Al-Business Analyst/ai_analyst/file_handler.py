@@ -2,29 +2,111 @@
 Модуль для работы с файлами: сохранение, обработка, генерация документов
 """
 import os
-import json
-from typing import Optional, Dict
+import shutil
+from typing import Optional, Dict, Tuple
 from datetime import datetime
 import tempfile
+from columnar_cache import cleanup_cache
+from report_model import DOCUMENT_FORMATS, Report, render_documents
+from artifact_catalog import ArtifactCatalog
 
 # Папка для временных файлов
 TEMP_DIR = "temp_files"
 if not os.path.exists(TEMP_DIR):
     os.makedirs(TEMP_DIR)
 
-def save_file(file_path: str, user_id: int, file_type: str = "document") -> Dict:
-    """Сохраняет файл во временную папку"""
+# Каталог файлов пользователей: списки и очистка без просмотра всей папки
+catalog = ArtifactCatalog(TEMP_DIR)
+
+# Загрузки по хешу содержимого: один экземпляр на все копии пользователей
+BLOB_DIR = catalog.blob_dir
+
+def store_blob(tmp_path: str, content_hash: str, file_ext: str = "") -> Tuple[str, bool]:
+    """
+    Переносит скачанный файл в хранилище по хешу.
+    Если такое содержимое уже есть, файл удаляется. Возвращает (путь, новый ли blob).
+    """
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    blob_path = os.path.join(BLOB_DIR, f"{content_hash}{file_ext.lower()}")
+    if os.path.isfile(blob_path):
+        os.remove(tmp_path)
+        return blob_path, False
+    os.replace(tmp_path, blob_path)
+    return blob_path, True
+
+def remove_user_file(filepath: str) -> int:
+    """
+    Удаляет файл пользователя; blob удаляется вместе с последней ссылкой на него.
+    Возвращает, сколько байт освободилось на диске.
+    """
+    freed = 0
+    if os.path.exists(filepath):
+        stat = os.stat(filepath)
+        os.remove(filepath)
+        # Ссылка на blob место не освобождает
+        if stat.st_nlink == 1:
+            freed += stat.st_size
+    blob = catalog.remove(filepath)
+    if blob and os.path.exists(blob):
+        freed += os.path.getsize(blob)
+        os.remove(blob)
+    return freed
+
+def remove_untracked_files(cutoff: float) -> Tuple[int, int]:
+    """
+    Удаляет файлы вне каталога (прерванные загрузки, blob без ссылок),
+    измененные раньше cutoff. Возвращает (число файлов, байт).
+    """
+    # mtime ссылки общий с blob, поэтому файлы из каталога не трогаем
+    tracked = catalog.tracked_paths()
+    folders = [TEMP_DIR, BLOB_DIR] if os.path.isdir(BLOB_DIR) else [TEMP_DIR]
+    removed, freed = 0, 0
+    for folder in folders:
+        for entry in os.scandir(folder):
+            if not entry.is_file() or entry.path in tracked:
+                continue
+            stat = entry.stat()
+            if stat.st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+                freed += stat.st_size
+    return removed, freed
+
+def mark_file_used(filepath: str):
+    """Отмечает обращение к файлу пользователя"""
+    catalog.touch(filepath)
+
+def _link(source: str, target: str) -> bool:
+    """Жесткая ссылка; False, если ФС их не поддерживает"""
+    try:
+        os.link(source, target)
+        return True
+    except OSError:
+        return False
+
+def save_file(file_path: str, user_id: int, file_type: str = "document", blob: Optional[str] = None) -> Dict:
+    """
+    Сохраняет файл во временную папку.
+    Если file_path - blob из хранилища по хешу (blob), вместо копии создается жесткая ссылка.
+    """
     try:
         # Создаем уникальное имя файла
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         file_ext = os.path.splitext(file_path)[1] if file_path else ""
         filename = f"{user_id}_{timestamp}_{file_type}{file_ext}"
         save_path = os.path.join(TEMP_DIR, filename)
+        # Существующий файл может быть ссылкой на blob: запись поверх испортила бы его
+        counter = 1
+        while os.path.exists(save_path):
+            filename = f"{user_id}_{timestamp}_{file_type}_{counter}{file_ext}"
+            save_path = os.path.join(TEMP_DIR, filename)
+            counter += 1
         
-        # Копируем файл
         if os.path.exists(file_path):
-            import shutil
-            shutil.copy2(file_path, save_path)
+            # Ссылка на blob не копирует байты и не занимает места
+            if blob is None or not _link(file_path, save_path):
+                shutil.copy2(file_path, save_path)
+            catalog.add(user_id, save_path, file_type, blob)
             return {
                 "success": True,
                 "path": save_path,
@@ -35,182 +117,84 @@ def save_file(file_path: str, user_id: int, file_type: str = "document") -> Dict
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def generate_requirements_document(project_data: Dict, format: str = "txt") -> Optional[str]:
+def generate_requirements_document(project_data: Dict, format: str = "txt",
+                                   user_id: Optional[int] = None) -> Optional[str]:
     """
     Генерирует документ с требованиями в указанном формате
     
     Args:
         project_data: Данные проекта
-        format: Формат файла (txt, json, md)
+        format: Формат файла (txt, json, md, confluence)
+        user_id: Владелец документа (документ попадет в его список файлов)
     
     Returns:
         Путь к созданному файлу или None
     """
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        project_name = project_data.get('project_name', 'Проект').replace(' ', '_')
-        
-        if format == "txt":
-            filename = f"{project_name}_{timestamp}.txt"
-            filepath = os.path.join(TEMP_DIR, filename)
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(f"БИЗНЕС-ТРЕБОВАНИЯ: {project_data.get('project_name', 'Проект')}\n")
-                f.write("=" * 80 + "\n\n")
-                
-                if project_data.get('goal'):
-                    f.write(f"ЦЕЛЬ ПРОЕКТА:\n{project_data.get('goal')}\n\n")
-                
-                if project_data.get('summary'):
-                    f.write(f"ОПИСАНИЕ:\n{project_data.get('summary')}\n\n")
-                
-                if project_data.get('scope'):
-                    f.write("SCOPE ПРОЕКТА:\n")
-                    scope = project_data['scope']
-                    if scope.get('in_scope'):
-                        f.write("Входит в scope:\n")
-                        for item in scope['in_scope']:
-                            f.write(f"  • {item}\n")
-                    if scope.get('out_scope'):
-                        f.write("\nНе входит в scope:\n")
-                        for item in scope['out_scope']:
-                            f.write(f"  • {item}\n")
-                    f.write("\n")
-                
-                if project_data.get('actors'):
-                    f.write("УЧАСТНИКИ:\n")
-                    for actor in project_data['actors']:
-                        if isinstance(actor, dict):
-                            f.write(f"  • {actor.get('role', '')}: {actor.get('description', '')}\n")
-                        else:
-                            f.write(f"  • {actor}\n")
-                    f.write("\n")
-                
-                if project_data.get('trigger'):
-                    f.write(f"ТРИГГЕР ПРОЦЕССА:\n{project_data.get('trigger')}\n\n")
-                
-                if project_data.get('expected_result'):
-                    f.write(f"ОЖИДАЕМЫЙ РЕЗУЛЬТАТ:\n{project_data.get('expected_result')}\n\n")
-                
-                if project_data.get('business_rules'):
-                    f.write("БИЗНЕС-ПРАВИЛА:\n")
-                    for i, rule in enumerate(project_data['business_rules'], 1):
-                        f.write(f"{i}. {rule}\n")
-                    f.write("\n")
-                
-                if project_data.get('kpi'):
-                    f.write("KPI И МЕТРИКИ:\n")
-                    for kpi in project_data['kpi']:
-                        if isinstance(kpi, dict):
-                            f.write(f"  • {kpi.get('metric', '')}: {kpi.get('target', '')} - {kpi.get('description', '')}\n")
-                    f.write("\n")
-                
-                if project_data.get('requirements'):
-                    f.write("ФУНКЦИОНАЛЬНЫЕ ТРЕБОВАНИЯ:\n")
-                    for i, req in enumerate(project_data['requirements'], 1):
-                        f.write(f"{i}. {req}\n")
-                    f.write("\n")
-                
-                if project_data.get('use_cases'):
-                    f.write("USE CASES:\n")
-                    for uc in project_data['use_cases']:
-                        if isinstance(uc, dict):
-                            f.write(f"\n{uc.get('id', '')} - {uc.get('title', '')}\n")
-                            f.write(f"Actor: {uc.get('actor', '')}\n")
-                            f.write(f"Precondition: {uc.get('precondition', '')}\n")
-                            f.write("Main Flow:\n")
-                            for step in uc.get('main_flow', []):
-                                f.write(f"  • {step}\n")
-                            f.write(f"Postcondition: {uc.get('postcondition', '')}\n")
-                    f.write("\n")
-                
-                if project_data.get('user_stories'):
-                    f.write("USER STORIES:\n")
-                    for us in project_data['user_stories']:
-                        if isinstance(us, dict):
-                            f.write(f"\n{us.get('id', '')}\n")
-                            f.write(f"As {us.get('as', '')} I want {us.get('i_want', '')} so that {us.get('so_that', '')}\n")
-                            if us.get('acceptance_criteria'):
-                                f.write("Acceptance Criteria:\n")
-                                for criteria in us['acceptance_criteria']:
-                                    f.write(f"  ✓ {criteria}\n")
-                    f.write("\n")
-                
-                if project_data.get('metrics'):
-                    f.write("МЕТРИКИ ВЫПОЛНЕНИЯ:\n")
-                    metrics = project_data['metrics']
-                    f.write(f"  • Время формирования: {metrics.get('total_time_minutes', 0):.2f} минут\n")
-                    f.write(f"  • Количество сообщений: {metrics.get('messages_count', 0)}\n")
-            
-            return filepath
-        
-        elif format == "json":
-            filename = f"{project_name}_{timestamp}.json"
-            filepath = os.path.join(TEMP_DIR, filename)
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(project_data, f, ensure_ascii=False, indent=2)
-            
-            return filepath
-        
-        elif format == "md":
-            filename = f"{project_name}_{timestamp}.md"
-            filepath = os.path.join(TEMP_DIR, filename)
-            
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(f"# {project_data.get('project_name', 'Проект')}\n\n")
-                
-                if project_data.get('goal'):
-                    f.write(f"## Цель проекта\n\n{project_data.get('goal')}\n\n")
-                
-                if project_data.get('summary'):
-                    f.write(f"## Описание\n\n{project_data.get('summary')}\n\n")
-                
-                # Добавляем остальные секции в Markdown формате
-                # (аналогично txt версии, но с Markdown разметкой)
-            
-            return filepath
-        
-        return None
+        if format not in DOCUMENT_FORMATS:
+            return None
+        filename, content = render_documents(Report(project_data), [format])[format]
+        if user_id is not None:
+            return save_generated_document(user_id, filename, content)
+        filepath = os.path.join(TEMP_DIR, filename)
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        return filepath
     except Exception as e:
         print(f"Ошибка генерации документа: {e}")
         return None
 
-def cleanup_old_files(max_age_hours: int = 24):
-    """Удаляет старые файлы из временной папки"""
+def save_generated_document(user_id: int, filename: str, content: bytes) -> Optional[str]:
+    """Сохраняет сгенерированный документ пользователя и регистрирует его в каталоге"""
+    try:
+        filepath = os.path.join(TEMP_DIR, f"{user_id}_{filename}")
+        with open(filepath, 'wb') as f:
+            f.write(content)
+        catalog.add(user_id, filepath, "report")
+        return filepath
+    except Exception as e:
+        print(f"Ошибка сохранения документа: {e}")
+        return None
+
+def cleanup_old_files(max_age_hours: int = 24, scan_untracked: bool = True):
+    """
+    Удаляет старые файлы из временной папки.
+    Файлы пользователей берутся из каталога; просмотр всей папки (scan_untracked)
+    нужен только для файлов вне каталога - при запуске бота.
+    """
     try:
-        current_time = datetime.now().timestamp()
-        for filename in os.listdir(TEMP_DIR):
-            filepath = os.path.join(TEMP_DIR, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getmtime(filepath)
-                if file_age > max_age_hours * 3600:
-                    os.remove(filepath)
+        cutoff = datetime.now().timestamp() - max_age_hours * 3600
+        for filepath in catalog.older_than(cutoff):
+            remove_user_file(filepath)
+        if scan_untracked:
+            remove_untracked_files(cutoff)
+        # Бинарный кеш разобранных CSV живет столько же, сколько сами файлы
+        cleanup_cache(TEMP_DIR, max_age_hours)
     except Exception as e:
         print(f"Ошибка очистки файлов: {e}")
 
-def list_user_files(user_id: int) -> list:
-    """Возвращает список файлов пользователя"""
+def list_user_files(user_id: int, limit: Optional[int] = None, offset: int = 0) -> list:
+    """Возвращает список файлов пользователя (новые первыми), постранично"""
     try:
-        files = []
-        if os.path.exists(TEMP_DIR):
-            for filename in os.listdir(TEMP_DIR):
-                if filename.startswith(f"{user_id}_"):
-                    filepath = os.path.join(TEMP_DIR, filename)
-                    if os.path.isfile(filepath):
-                        file_size = os.path.getsize(filepath)
-                        file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-                        files.append({
-                            "name": filename,
-                            "path": filepath,
-                            "size": file_size,
-                            "modified": file_time
-                        })
-        return sorted(files, key=lambda x: x["modified"], reverse=True)
+        files = catalog.list_user(user_id, limit, offset)
+        # Файлы, удаленные в обход каталога, убираем из него
+        missing = [file_info for file_info in files if not os.path.isfile(file_info["path"])]
+        for file_info in missing:
+            remove_user_file(file_info["path"])
+        return [file_info for file_info in files if file_info not in missing]
     except Exception as e:
         print(f"Ошибка получения списка файлов: {e}")
         return []
 
+def count_user_files(user_id: int) -> int:
+    """Число файлов пользователя"""
+    return catalog.count_user(user_id)
+
+def find_user_file(user_id: int, name_part: str) -> Optional[Dict]:
+    """Последний файл пользователя, в имени которого есть name_part"""
+    found = catalog.find_user(user_id, name_part)
+    return found[0] if found else None
+
 def get_file_by_name(filename: str) -> Optional[str]:
     """Возвращает путь к файлу по имени"""
     filepath = os.path.join(TEMP_DIR, filename)
@@ -0,0 +1,125 @@
+"""
+Кеш file_id Telegram по содержимому файла.
+Файл, однажды загруженный в Telegram, повторно отправляется по file_id из
+ответа на первую отправку: байты не передаются заново, это один короткий
+вызов Bot API. Ключ - тип отправки и хеш содержимого (для диаграмм - хеш
+кода mermaid). Соответствия хранятся в SQLite и переживают перезапуск.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, Optional, Union
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+# Путь к базе file_id
+FILE_ID_DB_PATH = os.path.join("data", "telegram_files.db")
+
+# Сколько хранить неиспользуемые file_id
+FILE_ID_RETENTION_DAYS = 90
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telegram_files (
+    key TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+"""
+
+
+def content_hash(content: Union[str, bytes]) -> str:
+    """Ключ для содержимого в памяти (документ, код диаграммы)"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+
+def extract_file_id(sent: types.Message, kind: str) -> Optional[str]:
+    """file_id из сообщения, которое вернул Telegram после отправки"""
+    if kind == "photo":
+        return sent.photo[-1].file_id if sent.photo else None
+    media = getattr(sent, kind, None)
+    return media.file_id if media else None
+
+
+class FileIdCache:
+    """Соответствия {тип:хеш содержимого -> file_id}"""
+
+    def __init__(self, db_path: str = FILE_ID_DB_PATH):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.stats = {"reused": 0, "uploaded": 0, "stale": 0}
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT file_id FROM telegram_files WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE telegram_files SET used_at = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+
+    def put(self, key: str, file_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO telegram_files (key, file_id, used_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET file_id = excluded.file_id, used_at = excluded.used_at",
+                (key, file_id, time.time())
+            )
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM telegram_files WHERE key = ?", (key,))
+
+    def purge_older_than(self, days: int = FILE_ID_RETENTION_DAYS) -> int:
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM telegram_files WHERE used_at < ?",
+                                        (time.time() - days * 86400,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Общий кеш бота
+file_ids = FileIdCache()
+
+
+async def send_with_file_id(kind: str, digest: str,
+                            send: Callable[[Union[str, types.InputFile]], Awaitable[types.Message]],
+                            source: Union[str, types.InputFile]) -> types.Message:
+    """
+    Отправляет файл по сохраненному file_id, а если его нет - загружает source
+    (файл или URL) и запоминает file_id из ответа.
+    kind - тип отправки (photo, document, video, audio), digest - хеш содержимого,
+    send(media) - вызов Bot API.
+    """
+    key = f"{kind}:{digest}"
+    # Запросы к SQLite - в рабочем потоке, чтобы не задерживать цикл событий
+    file_id = await asyncio.to_thread(file_ids.get, key)
+    if file_id is not None:
+        try:
+            sent = await send(file_id)
+            file_ids.stats["reused"] += 1
+            return sent
+        except TelegramBadRequest as e:
+            # file_id мог стать недействительным - загружаем заново
+            logging.info(f"file_id для {key} не принят: {e}")
+            file_ids.stats["stale"] += 1
+            await asyncio.to_thread(file_ids.delete, key)
+
+    sent = await send(source)
+    file_ids.stats["uploaded"] += 1
+    new_file_id = extract_file_id(sent, kind)
+    if new_file_id:
+        await asyncio.to_thread(file_ids.put, key, new_file_id)
+    return sent
@@ -0,0 +1,138 @@
+"""
+Общий клиент Gemini.
+Одна модель на весь бот вместо новой GenerativeModel на каждого пользователя,
+запросы идут через асинхронный API SDK (без пула потоков по умолчанию),
+а глобальный семафор ограничивает число одновременных запросов к Gemini.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+import google.generativeai as genai
+
+from config import GOOGLE_API_KEY
+from prompts import SYSTEM_PROMPT
+
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# Максимум одновременных запросов к Gemini от всего бота
+GEMINI_MAX_CONCURRENCY = 16
+
+# GEMINI_FAKE=1 - имитация Gemini вместо API (нагрузочные проверки, запуск без ключа)
+USE_FAKE_GEMINI = os.getenv("GEMINI_FAKE") == "1"
+
+# Настройка Google API
+genai.configure(api_key=GOOGLE_API_KEY)
+
+_analyst_model: Optional[genai.GenerativeModel] = None
+_plain_model: Optional[genai.GenerativeModel] = None
+_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+_fake_client = None
+
+# Счетчики для наблюдения за нагрузкой
+gemini_stats = {"in_flight": 0, "waiting": 0, "requests": 0}
+
+
+def _connect(model: genai.GenerativeModel) -> genai.GenerativeModel:
+    """Подключает имитацию Gemini, если она включена"""
+    global _fake_client
+    if USE_FAKE_GEMINI:
+        from fake_gemini import install_fake_gemini
+        if _fake_client is None:
+            _fake_client = install_fake_gemini(model)
+        else:
+            model._async_client = _fake_client
+    return model
+
+
+def get_analyst_model() -> genai.GenerativeModel:
+    """Модель с системным промптом аналитика (общая для всех сессий)"""
+    global _analyst_model
+    if _analyst_model is None:
+        _analyst_model = _connect(genai.GenerativeModel(
+            model_name=GEMINI_MODEL_NAME,
+            system_instruction=SYSTEM_PROMPT
+        ))
+    return _analyst_model
+
+
+def get_plain_model() -> genai.GenerativeModel:
+    """Модель без системного промпта для служебных запросов (краткое содержание истории)"""
+    global _plain_model
+    if _plain_model is None:
+        _plain_model = _connect(genai.GenerativeModel(model_name=GEMINI_MODEL_NAME))
+    return _plain_model
+
+
+def start_chat(history=None):
+    return get_analyst_model().start_chat(history=history or [])
+
+
+class _GeminiSlot:
+    """Место в глобальном лимите одновременных запросов"""
+
+    async def __aenter__(self):
+        gemini_stats["waiting"] += 1
+        try:
+            await _semaphore.acquire()
+        finally:
+            gemini_stats["waiting"] -= 1
+        gemini_stats["in_flight"] += 1
+        gemini_stats["requests"] += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        gemini_stats["in_flight"] -= 1
+        _semaphore.release()
+
+
+def _chunk_text(chunk) -> str:
+    # Последний фрагмент потока может не содержать текста (только finish_reason и usage)
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+async def _deliver_chunks(chunks: "asyncio.Queue[Optional[str]]", on_chunk: Callable[[str], Awaitable]):
+    """Передает фрагменты ответа в on_chunk до None"""
+    while True:
+        text = await chunks.get()
+        if text is None:
+            return
+        await on_chunk(text)
+
+
+async def send_chat_message(chat, content, on_chunk: Optional[Callable[[str], Awaitable]] = None):
+    """
+    Отправляет сообщение в сессию чата через асинхронный API.
+    С on_chunk ответ запрашивается потоком (stream=True): on_chunk(text) вызывается
+    на каждый фрагмент, а возвращается собранный ответ (text, usage_metadata, история).
+    """
+    if on_chunk is None:
+        async with _GeminiSlot():
+            return await chat.send_message_async(content)
+
+    # Фрагменты обрабатывает отдельная задача: медленные правки в Telegram
+    # не держат место в лимите одновременных запросов к Gemini
+    chunks: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    delivery = asyncio.create_task(_deliver_chunks(chunks, on_chunk))
+    try:
+        async with _GeminiSlot():
+            response = await chat.send_message_async(content, stream=True)
+            async for chunk in response:
+                text = _chunk_text(chunk)
+                if text:
+                    chunks.put_nowait(text)
+    except BaseException:
+        delivery.cancel()
+        raise
+    chunks.put_nowait(None)
+    await delivery
+    return response
+
+
+async def generate_text(prompt: str) -> str:
+    """Разовый запрос без истории"""
+    async with _GeminiSlot():
+        response = await get_plain_model().generate_content_async(prompt)
+    return response.text
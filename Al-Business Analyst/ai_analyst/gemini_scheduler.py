@@ -0,0 +1,152 @@
+"""
+Планировщик запросов к Gemini.
+Сообщения одного пользователя обрабатываются строго по очереди (одна
+ChatSession не получает параллельных send_message), а общий поток запросов
+укладывается в квоту запросов и токенов в минуту (token bucket). Если квота
+исчерпана, запросы ждут в очереди FIFO, а пользователь видит свою позицию;
+при переполнении очереди запрос отклоняется сразу (SchedulerBusy).
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+# Квота Gemini API
+GEMINI_REQUESTS_PER_MINUTE = 60
+GEMINI_TOKENS_PER_MINUTE = 1_000_000
+
+# Сколько сообщений одного пользователя может ждать ответа одновременно
+MAX_USER_QUEUE = 3
+
+# Сколько запросов всего может ждать квоту
+MAX_QUOTA_QUEUE = 500
+
+
+class SchedulerBusy(Exception):
+    """Очередь переполнена, запрос не принят"""
+
+
+class TokenBucket:
+    """Ведро токенов: емкость capacity, пополнение per_minute в минуту"""
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Через сколько секунд в ведре будет amount (запрос больше емкости ждет полного ведра)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        # Уровень может уйти в минус: долг гасится пополнением
+        self._refill()
+        self.level -= amount
+
+    def adjust(self, delta: float):
+        """Поправка после ответа: фактический расход минус оценка"""
+        self._refill()
+        self.level = min(self.capacity, self.level - delta)
+
+
+class GeminiScheduler:
+    """Очередь запросов к Gemini с порядком по пользователю и общей квотой"""
+
+    def __init__(self, requests_per_minute: int = GEMINI_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = GEMINI_TOKENS_PER_MINUTE,
+                 max_user_queue: int = MAX_USER_QUEUE, max_queue: int = MAX_QUOTA_QUEUE):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute)
+        self.max_user_queue = max_user_queue
+        self.max_queue = max_queue
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_pending: Dict[int, int] = {}
+        self._queue: Deque[asyncio.Future] = deque()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0}
+
+    @asynccontextmanager
+    async def user_turn(self, user_id: int):
+        """Ход пользователя: следующее сообщение ждет, пока обработается предыдущее"""
+        pending = self._user_pending.get(user_id, 0)
+        if pending >= self.max_user_queue:
+            self.stats["rejected"] += 1
+            raise SchedulerBusy("Слишком много сообщений подряд, дождитесь ответа на предыдущие")
+        self._user_pending[user_id] = pending + 1
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        try:
+            async with lock:
+                yield
+        finally:
+            self._user_pending[user_id] -= 1
+            if not self._user_pending[user_id]:
+                del self._user_pending[user_id]
+                self._user_locks.pop(user_id, None)
+
+    def _wake_head(self):
+        if self._queue and not self._queue[0].done():
+            self._queue[0].set_result(None)
+
+    async def acquire(self, tokens: int, on_wait: Optional[Callable[[int], Awaitable]] = None):
+        """
+        Ждет места в квоте под один запрос примерно на tokens токенов.
+        on_wait(position) вызывается один раз, если запросу приходится ждать.
+        """
+        if len(self._queue) >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise SchedulerBusy("Сервис перегружен, попробуйте через минуту")
+
+        turn = asyncio.get_running_loop().create_future()
+        self._queue.append(turn)
+        notified = False
+        try:
+            if len(self._queue) == 1:
+                turn.set_result(None)
+            else:
+                self.stats["queued"] += 1
+                notified = True
+                if on_wait is not None:
+                    await on_wait(len(self._queue))
+            await turn
+
+            # Первый в очереди ждет пополнения квоты
+            while True:
+                delay = max(self.requests.delay(1), self.tokens.delay(tokens))
+                if delay <= 0:
+                    break
+                if not notified:
+                    self.stats["queued"] += 1
+                    notified = True
+                    if on_wait is not None:
+                        await on_wait(1)
+                await asyncio.sleep(delay)
+
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.stats["admitted"] += 1
+        finally:
+            was_head = self._queue and self._queue[0] is turn
+            self._queue.remove(turn)
+            if was_head:
+                self._wake_head()
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Учитывает фактический расход токенов по usage_metadata ответа"""
+        if actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    @property
+    def queue_length(self) -> int:
+        return len(self._queue)
+
+
+# Общий планировщик бота (диалоги и служебные запросы)
+gemini_scheduler = GeminiScheduler()
@@ -0,0 +1,198 @@
+"""
+Сжатие истории диалога с Gemini по бюджету токенов.
+Для каждой реплики хранится число токенов (по usage_metadata ответов, без
+лишних запросов count_tokens). Когда история превышает бюджет, старые
+реплики заменяются кратким содержанием, последние остаются дословно.
+Сжатие выполняется в фоне после ответа, поэтому не добавляет задержку
+к ходу пользователя.
+"""
+import asyncio
+import logging
+import weakref
+from typing import Callable, List, Optional
+
+from gemini_client import generate_text
+from gemini_scheduler import gemini_scheduler
+
+# Бюджет истории в токенах: выше него старые реплики сворачиваются в краткое содержание
+HISTORY_TOKEN_BUDGET = 8000
+
+# Сколько последних реплик (пользователь + аналитик) всегда остаются дословно
+KEEP_RECENT_MESSAGES = 6
+
+# Доля бюджета, которую могут занимать дословные последние реплики
+RECENT_BUDGET_SHARE = 0.5
+
+# Оценка для реплик, по которым нет usage_metadata (русский текст ~3 символа на токен)
+CHARS_PER_TOKEN = 3
+
+SUMMARY_MARKER = "[Краткое содержание предыдущей части диалога]"
+
+SUMMARY_PROMPT = """
+Ниже фрагмент диалога бизнес-аналитика с заказчиком о процессе автоматизации.
+Составь краткое содержание на русском языке, которое заменит этот фрагмент в истории.
+Сохрани все факты, необходимые для итоговых требований: название и цель проекта,
+описание процесса, участников и их роли, триггеры, бизнес-правила, ограничения,
+KPI и числа, границы scope, принятые решения и еще не закрытые вопросы.
+Не добавляй ничего, чего нет в диалоге. Только текст, без вступлений.
+
+{dialog}
+"""
+
+SUMMARY_ACK = "Понял, учитываю краткое содержание предыдущей части диалога."
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def content_text(content) -> str:
+    """Текст реплики истории (изображения обозначаются заглушкой)"""
+    parts = []
+    for part in content.parts:
+        if part.text:
+            parts.append(part.text)
+        elif "inline_data" in part:
+            parts.append("[изображение]")
+    return "\n".join(parts)
+
+
+class HistoryBudget:
+    """Учет токенов истории одной сессии чата"""
+
+    def __init__(self):
+        # Токены каждой реплики, по одному числу на элемент chat.history
+        self.turn_tokens: List[int] = []
+        self.last_prompt_tokens = 0
+        self.last_reply_tokens = 0
+        self.compactions = 0
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(self.turn_tokens)
+
+
+# Бюджеты привязаны к объекту сессии: удаление сессии из chats освобождает и бюджет
+_budgets: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def budget_for(chat) -> HistoryBudget:
+    budget = _budgets.get(chat)
+    if budget is None:
+        budget = _budgets[chat] = HistoryBudget()
+    return budget
+
+
+def _sync_estimates(chat, budget: HistoryBudget):
+    """Выравнивает учет по фактической истории (оценкой по длине текста)"""
+    history = chat.history
+    if len(budget.turn_tokens) > len(history):
+        budget.turn_tokens = [estimate_tokens(content_text(c)) for c in history]
+    while len(budget.turn_tokens) < len(history):
+        budget.turn_tokens.append(estimate_tokens(content_text(history[len(budget.turn_tokens)])))
+
+
+def record_turn(chat, response):
+    """
+    Учитывает токены последнего хода по usage_metadata ответа.
+    Запрос хода n = запрос хода n-1 + ответ n-1 + новая реплика,
+    поэтому токены реплики пользователя получаются вычитанием.
+    """
+    budget = budget_for(chat)
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    reply_tokens = getattr(usage, "candidates_token_count", 0) or 0
+
+    history = chat.history
+    if prompt_tokens and reply_tokens and len(history) >= 2 and len(budget.turn_tokens) == len(history) - 2:
+        user_tokens = prompt_tokens - budget.last_prompt_tokens - budget.last_reply_tokens
+        if not budget.last_prompt_tokens or user_tokens <= 0:
+            user_tokens = estimate_tokens(content_text(history[-2]))
+        budget.turn_tokens.extend([user_tokens, reply_tokens])
+    _sync_estimates(chat, budget)
+    budget.last_prompt_tokens = prompt_tokens
+    budget.last_reply_tokens = reply_tokens
+
+
+def _compaction_cut(budget: HistoryBudget, budget_tokens: int) -> int:
+    """Сколько реплик с начала истории свернуть (четное число: пары пользователь/аналитик)"""
+    recent_limit = budget_tokens * RECENT_BUDGET_SHARE
+    kept, kept_tokens = 0, 0
+    for tokens in reversed(budget.turn_tokens):
+        if kept >= KEEP_RECENT_MESSAGES or (kept >= 2 and kept_tokens + tokens > recent_limit):
+            break
+        kept += 1
+        kept_tokens += tokens
+    cut = len(budget.turn_tokens) - kept
+    return cut - cut % 2
+
+
+def needs_compaction(chat, budget_tokens: Optional[int] = None) -> bool:
+    budget_tokens = budget_tokens or HISTORY_TOKEN_BUDGET
+    budget = budget_for(chat)
+    # Свернуть только реплику с прошлым кратким содержанием бессмысленно
+    return budget.total_tokens > budget_tokens and _compaction_cut(budget, budget_tokens) > 2
+
+
+async def compact_history(chat, budget_tokens: Optional[int] = None) -> bool:
+    """
+    Заменяет старые реплики кратким содержанием (один запрос к модели).
+    Прошлое краткое содержание попадает в сворачиваемый фрагмент, поэтому оно накопительное.
+    """
+    budget_tokens = budget_tokens or HISTORY_TOKEN_BUDGET
+    budget = budget_for(chat)
+    _sync_estimates(chat, budget)
+    cut = _compaction_cut(budget, budget_tokens)
+    if cut <= 2:
+        return False
+
+    history = chat.history
+    dialog = "\n\n".join(
+        f"{'Пользователь' if content.role == 'user' else 'Аналитик'}: {content_text(content)}"
+        for content in history[:cut]
+    )
+    prompt = SUMMARY_PROMPT.format(dialog=dialog)
+    # Служебный запрос тоже расходует общую квоту
+    await gemini_scheduler.acquire(estimate_tokens(prompt))
+    summary = (await generate_text(prompt)).strip()
+
+    summary_text = f"{SUMMARY_MARKER}\n{summary}"
+    chat.history = [
+        {"role": "user", "parts": [summary_text]},
+        {"role": "model", "parts": [SUMMARY_ACK]},
+    ] + list(history[cut:])
+    budget.turn_tokens = [estimate_tokens(summary_text), estimate_tokens(SUMMARY_ACK)] + budget.turn_tokens[cut:]
+    # Следующий ход считаем заново: размер запроса после сжатия изменился
+    budget.last_prompt_tokens = 0
+    budget.last_reply_tokens = 0
+    budget.compactions += 1
+    return True
+
+
+async def _compact_in_background(chat, on_compacted: Optional[Callable[[], None]] = None):
+    try:
+        compacted = await compact_history(chat)
+    except Exception as e:
+        # История остается полной, попробуем на следующем ходе
+        logging.warning(f"Не удалось сжать историю диалога: {e}")
+        return
+    if compacted and on_compacted is not None:
+        on_compacted()
+
+
+def schedule_compaction(chat, on_compacted: Optional[Callable[[], None]] = None):
+    """Запускает сжатие в фоне, если история вышла за бюджет; on_compacted() - после замены истории"""
+    budget = budget_for(chat)
+    if budget.task is not None and not budget.task.done():
+        return
+    if needs_compaction(chat):
+        budget.task = asyncio.create_task(_compact_in_background(chat, on_compacted))
+
+
+async def wait_for_compaction(chat):
+    """Ждет фоновое сжатие перед следующим запросом, чтобы история не менялась во время отправки"""
+    budget = _budgets.get(chat)
+    if budget is not None and budget.task is not None:
+        await budget.task
+        budget.task = None
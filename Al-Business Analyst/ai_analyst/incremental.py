@@ -0,0 +1,179 @@
+"""
+Инкрементальный анализ выгрузок, которые растут дописыванием строк в конец.
+Состояние аккумулятора сохраняется вместе со смещением последней
+обработанной строки и хешами блоков префикса файла. При следующем
+запуске разбирается только новый хвост; если префикс изменился -
+полный пересчет.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+from typing import Callable, List, Optional, Sequence
+
+from columnar_cache import CACHE_DIR_NAME, PARSER_VERSION
+from csv_ingest import data_start_offset, iter_byte_range_chunks, open_csv
+from parallel_parse import parse_parallel
+
+# Версия формата состояния (вместе с PARSER_VERSION)
+STATE_VERSION = 2
+
+# Размер окон в начале и в конце префикса, по которым считается быстрая контрольная сумма
+PREFIX_CHECK_BYTES = 1024 * 1024
+
+# Размер блоков, по которым хешируется весь префикс
+PREFIX_BLOCK_BYTES = 4 * 1024 * 1024
+
+
+class IncrementalState:
+    """Сохраненное состояние инкрементального анализа одного файла"""
+
+    def __init__(self, accumulator, offset: int, prefix_checksum: str, encoding: str, quoted_columns,
+                 prefix_blocks: Optional[List[str]] = None):
+        self.version = (STATE_VERSION, PARSER_VERSION)
+        self.accumulator = accumulator
+        self.offset = offset
+        self.prefix_checksum = prefix_checksum
+        self.prefix_blocks = prefix_blocks or []
+        self.encoding = encoding
+        self.quoted_columns = quoted_columns
+
+
+def _state_path(file_path: str, kind: str) -> str:
+    abs_path = os.path.abspath(file_path)
+    name = hashlib.sha1(abs_path.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(os.path.dirname(abs_path), CACHE_DIR_NAME, "incremental", f"{name}-{kind}.pkl")
+
+
+def prefix_checksum(file_path: str, offset: int) -> str:
+    """
+    Быстрая контрольная сумма префикса [0, offset): длина, первое и последнее окно
+    по PREFIX_CHECK_BYTES. Отсекает замененный или обрезанный файл, не читая его
+    целиком; правку в середине замечает только prefix_block_hashes().
+    """
+    digest = hashlib.sha256(str(offset).encode('ascii'))
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(min(offset, PREFIX_CHECK_BYTES)))
+        if offset > PREFIX_CHECK_BYTES:
+            tail_start = max(PREFIX_CHECK_BYTES, offset - PREFIX_CHECK_BYTES)
+            f.seek(tail_start)
+            digest.update(f.read(offset - tail_start))
+    return digest.hexdigest()
+
+
+def prefix_block_hashes(file_path: str, offset: int, known: Sequence[str] = ()) -> List[str]:
+    """
+    SHA-256 блоков по PREFIX_BLOCK_BYTES префикса [0, offset) (последний блок может быть короче).
+    known - уже посчитанные хеши полных блоков с начала файла, они не перечитываются.
+    """
+    hashes = list(known[:offset // PREFIX_BLOCK_BYTES])
+    position = len(hashes) * PREFIX_BLOCK_BYTES
+    with open(file_path, 'rb') as f:
+        f.seek(position)
+        while position < offset:
+            size = min(PREFIX_BLOCK_BYTES, offset - position)
+            hashes.append(hashlib.sha256(f.read(size)).hexdigest())
+            position += size
+    return hashes
+
+
+def _complete_lines_end(file_path: str) -> int:
+    """Смещение конца последней полной строки: недописанная строка ждет следующего запуска"""
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        position = size
+        while position > 0:
+            start = max(0, position - 64 * 1024)
+            f.seek(start)
+            block = f.read(position - start)
+            cut = block.rfind(b'\n')
+            if cut >= 0:
+                return start + cut + 1
+            position = start
+    return 0
+
+
+def load_state(file_path: str, kind: str) -> Optional[IncrementalState]:
+    """Читает состояние и проверяет, что префикс файла не менялся"""
+    path = _state_path(file_path, kind)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+    except Exception:
+        return None
+    if getattr(state, "version", None) != (STATE_VERSION, PARSER_VERSION):
+        return None
+    if os.path.getsize(file_path) < state.offset:
+        return None
+    if prefix_checksum(file_path, state.offset) != state.prefix_checksum:
+        return None
+    # Полная проверка: правка в середине выгрузки не должна давать устаревшие агрегаты
+    if prefix_block_hashes(file_path, state.offset) != state.prefix_blocks:
+        return None
+    return state
+
+
+def save_state(file_path: str, kind: str, state: IncrementalState):
+    """Атомарно сохраняет состояние"""
+    path = _state_path(file_path, kind)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def analyze_incremental(file_path: str, accumulator_cls, kind: str,
+                        progress: Optional[Callable[[int, int, int], None]] = None,
+                        state: Optional[IncrementalState] = None, workers: int = 1):
+    """
+    Возвращает аккумулятор по всему файлу, разбирая только строки,
+    дописанные после предыдущего запуска.
+    accumulator_cls должен поддерживать update(batch), merge(other) и быть сериализуемым pickle.
+    state - уже проверенное load_state() состояние; без него файл разбирается целиком
+    (в workers процессах, если больше одного) и состояние сохраняется для следующих запусков.
+    progress(done, total, rows) вызывается после каждого пакета (байты нового хвоста),
+    при параллельном разборе - после каждого диапазона.
+    """
+    end = _complete_lines_end(file_path)
+    if state is None:
+        with open_csv(file_path) as source:
+            encoding = source.encoding
+            quoted_columns = source.quoted_columns
+        start = data_start_offset(file_path, encoding)
+        state = IncrementalState(accumulator_cls(), start, "", encoding, quoted_columns)
+        if workers > 1 and end > start:
+            state.accumulator = parse_parallel(file_path, accumulator_cls, workers, end, progress)
+            state.offset = end
+            _save_progress(file_path, kind, state, 0)
+            return state.accumulator
+
+    if end > state.offset:
+        rows = 0
+        chunks = iter_byte_range_chunks(file_path, state.encoding, state.offset, end, state.quoted_columns)
+        for batch, position in chunks:
+            state.accumulator.update(batch)
+            rows += len(batch)
+            if progress is not None:
+                progress(position - state.offset, end - state.offset, rows)
+        known_offset = state.offset if state.prefix_checksum else 0
+        state.offset = end
+        _save_progress(file_path, kind, state, known_offset)
+    elif not state.prefix_checksum:
+        _save_progress(file_path, kind, state, 0)
+    return state.accumulator
+
+
+def _save_progress(file_path: str, kind: str, state: IncrementalState, known_offset: int):
+    """Пересчитывает контрольные суммы префикса до state.offset и сохраняет состояние"""
+    known = state.prefix_blocks[:known_offset // PREFIX_BLOCK_BYTES]
+    state.prefix_checksum = prefix_checksum(file_path, state.offset)
+    state.prefix_blocks = prefix_block_hashes(file_path, state.offset, known)
+    save_state(file_path, kind, state)
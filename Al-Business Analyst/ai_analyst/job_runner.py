@@ -0,0 +1,213 @@
+"""
+Фоновые задачи анализа в пуле процессов.
+Разбор больших выгрузок не блокирует цикл событий бота: задача выполняется
+в отдельном процессе, сообщает прогресс (байты, строки) через общий словарь
+и проверяет флаг отмены между пакетами строк.
+"""
+import asyncio
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from columnar_cache import restore_content_hashes
+
+# Число процессов для фоновых задач
+JOB_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+
+# Как часто задача пишет прогресс в общий словарь (секунды)
+PROGRESS_INTERVAL = 0.5
+
+# Как часто обновляется статусное сообщение в чате (секунды)
+STATUS_UPDATE_INTERVAL = 3.0
+
+
+class JobCancelled(Exception):
+    """Задача отменена пользователем"""
+
+
+class JobProgress:
+    """
+    Отчет о прогрессе из дочернего процесса.
+    Передается в функцию задачи аргументом progress(done, total, rows);
+    при отмене задачи очередной вызов бросает JobCancelled.
+    """
+
+    def __init__(self, shared, cancel_event):
+        self._shared = shared
+        self._cancel_event = cancel_event
+        self._last_report = 0.0
+
+    def __call__(self, done: int, total: int, rows: int):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+        now = time.monotonic()
+        if now - self._last_report >= PROGRESS_INTERVAL or done >= total:
+            self._last_report = now
+            self._shared.update(done=done, total=total, rows=rows)
+
+
+def _run_job(func, args, kwargs, shared, cancel_event, content_hashes):
+    """Точка входа задачи в дочернем процессе"""
+    if content_hashes:
+        restore_content_hashes(content_hashes)
+    return func(*args, progress=JobProgress(shared, cancel_event), **kwargs)
+
+
+class Job:
+    """Запущенная фоновая задача"""
+
+    def __init__(self, job_id: int, user_id: int, title: str, future, shared, cancel_event):
+        self.id = job_id
+        self.user_id = user_id
+        self.title = title
+        self.future = future
+        self.started = time.monotonic()
+        self._shared = shared
+        self._cancel_event = cancel_event
+        # Кто ждет результат: {id ожидания: (id пользователя, событие «перестал ждать»)}
+        self.waiters: Dict[int, Tuple[int, asyncio.Event]] = {}
+
+    def progress(self) -> Dict:
+        """Последний отчет задачи: done, total, rows (пустой словарь, пока отчетов не было)"""
+        try:
+            return dict(self._shared)
+        except Exception:
+            return {}
+
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах по доле обработанных байт"""
+        report = self.progress()
+        done, total = report.get("done", 0), report.get("total", 0)
+        if not done or not total:
+            return None
+        elapsed = time.monotonic() - self.started
+        return elapsed * (total - done) / done
+
+    def cancel(self):
+        """Отменяет задачу: из очереди снимается сразу, запущенная остановится на следующем пакете"""
+        self._cancel_event.set()
+        self.future.cancel()
+
+
+class JobRunner:
+    """Пул процессов для фоновых задач с прогрессом и отменой"""
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.jobs: Dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._manager = None
+
+    def _ensure_started(self):
+        # Пул и менеджер общих объектов создаются при первой задаче
+        if self._pool is None:
+            self._manager = multiprocessing.Manager()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def submit(self, user_id: int, title: str, func: Callable, *args,
+               content_hashes: Optional[Dict] = None, **kwargs) -> Job:
+        """
+        Ставит задачу в пул. func выполняется в дочернем процессе и должна
+        принимать аргумент progress (см. JobProgress).
+        content_hashes - хеши выгрузок из главного процесса (columnar_cache.content_hash_memo),
+        чтобы дочерний процесс не хешировал файлы заново.
+        """
+        self._ensure_started()
+        shared = self._manager.dict()
+        cancel_event = self._manager.Event()
+        future = self._pool.submit(_run_job, func, args, kwargs, shared, cancel_event, content_hashes)
+        job = Job(next(self._ids), user_id, title, future, shared, cancel_event)
+        self.jobs[job.id] = job
+        return job
+
+    async def wait(self, job: Job, on_progress: Optional[Callable[[Job], Awaitable]] = None,
+                   interval: float = STATUS_UPDATE_INTERVAL, user_id: Optional[int] = None):
+        """
+        Ждет результат задачи от имени пользователя user_id (по умолчанию - автора задачи),
+        вызывая on_progress раз в interval секунд. Одну задачу могут ждать несколько
+        пользователей, у каждого свой прогресс.
+        Бросает JobCancelled, если задача отменена или этот пользователь перестал ждать
+        (см. detach_user); задача останавливается, когда ее больше никто не ждет.
+        """
+        waiter_id = next(self._ids)
+        detached = asyncio.Event()
+        job.waiters[waiter_id] = (job.user_id if user_id is None else user_id, detached)
+        result = asyncio.wrap_future(job.future)
+        detach = asyncio.ensure_future(detached.wait())
+        try:
+            while True:
+                done, _ = await asyncio.wait({result, detach}, timeout=interval,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if result in done:
+                    break
+                if detach in done:
+                    raise JobCancelled()
+                if on_progress is not None:
+                    await on_progress(job)
+            try:
+                return result.result()
+            except asyncio.CancelledError:
+                raise JobCancelled()
+        except (asyncio.CancelledError, JobCancelled):
+            # Ожидающий ушел (обработчик отменен или нажата «Отменить») -
+            # задачу останавливаем, только если ее больше никто не ждет
+            del job.waiters[waiter_id]
+            if not job.waiters:
+                job.cancel()
+            raise
+        finally:
+            detach.cancel()
+            if not result.done():
+                # Этот ожидающий результат уже не прочитает
+                result.add_done_callback(lambda f: f.cancelled() or f.exception())
+            job.waiters.pop(waiter_id, None)
+            if not job.waiters:
+                self.jobs.pop(job.id, None)
+
+    def user_jobs(self, user_id: int) -> List[Job]:
+        """Задачи, результат которых ждет пользователь"""
+        return [job for job in self.jobs.values()
+                if any(waiter_user == user_id for waiter_user, _ in job.waiters.values())]
+
+    def detach_user(self, job: Job, user_id: int) -> bool:
+        """Пользователь перестает ждать задачу; False, если он ее не ждал"""
+        detached = False
+        for waiter_user, event in job.waiters.values():
+            if waiter_user == user_id:
+                event.set()
+                detached = True
+        return detached
+
+    def cancel_user_jobs(self, user_id: int) -> int:
+        """Отменяет ожидания пользователя (см. detach_user), возвращает число задач"""
+        jobs = self.user_jobs(user_id)
+        for job in jobs:
+            self.detach_user(job, user_id)
+        return len(jobs)
+
+    def shutdown(self):
+        for job in list(self.jobs.values()):
+            job.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+
+def format_job_status(job: Job) -> str:
+    """Текст статусного сообщения: процент, строки, оставшееся время"""
+    report = job.progress()
+    if not report.get("total"):
+        return f"{job.title}..."
+    percent = report["done"] / report["total"] * 100
+    text = f"{job.title}... {percent:.0f}% ({report.get('rows', 0):,} строк)"
+    eta = job.eta()
+    if eta is not None:
+        text += f", осталось ~{eta:.0f} с"
+    return text
@@ -1,16 +1,37 @@
 import asyncio
+import html
 import logging
 import os
-from typing import Dict
-from aiogram import Bot, Dispatcher, types
+import time
+from typing import Awaitable, Dict, List
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import FSInputFile, InputFile
+from aiogram.types import BufferedInputFile, FSInputFile, InputFile, InlineKeyboardButton, InlineKeyboardMarkup
 from config import TELEGRAM_TOKEN
-from services import get_ai_response, get_ai_response_with_image, generate_diagram_link, chats, metrics
-from analyze_transactions import analyze_transactions, get_transaction_statistics_summary
-from analyze_behavior import analyze_behavior_patterns, get_behavior_statistics_summary
+from services import get_ai_response, get_ai_response_with_image, clear_session, conversations
+from analyze_transactions import analyze_transactions, get_transaction_statistics_summary, DEFAULT_TRANSACTIONS_FILE
+from analyze_transactions import ANALYZER_VERSION as TRANSACTIONS_ANALYZER_VERSION
+from analyze_behavior import analyze_behavior_patterns, get_behavior_statistics_summary, DEFAULT_BEHAVIOR_FILE
+from analyze_behavior import ANALYZER_VERSION as BEHAVIOR_ANALYZER_VERSION
+from client_index import lookup_client, get_client_summary
+from risk_join import join_risk_statistics, get_risk_statistics_summary
 from confluence_integration import create_confluence_page, test_confluence_connection
-from file_handler import save_file, generate_requirements_document, cleanup_old_files, list_user_files, get_file_by_name
+from file_handler import (save_generated_document, list_user_files, count_user_files, find_user_file,
+                          mark_file_used)
+from disk_janitor import run_disk_janitor
+from upload_store import save_document
+from result_cache import AnalysisResultCache, analysis_cache_key
+from upload_digest import describe_upload
+from session_store import SessionStore, run_session_janitor
+from conversation_db import run_flush_loop
+from job_runner import JobCancelled, JobRunner, format_job_status
+from stream_reply import StreamingReply
+from telegram_outbox import MessageBatcher, send_text, telegram_limiter
+from response_cache import response_cache_key
+from columnar_cache import content_hash_memo, file_content_hash
+from file_id_cache import content_hash, file_ids, send_with_file_id
+from report_model import DOCUMENT_FORMATS, Report, generate_diagram_link, render_report
 
 # Включаем логи, чтобы видеть ошибки в консоли
 logging.basicConfig(level=logging.INFO)
@@ -18,17 +39,70 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
 
-# Хранилище списков файлов пользователей для команды /files
-user_files_cache = {}
+# Хранилище списков файлов пользователей для команды /files (ждет ответа с номером файла)
+user_files_cache = SessionStore("user_files", ttl_seconds=30 * 60)
+
+# Сколько файлов показывать на странице /files
+FILES_PAGE_SIZE = 10
+
+# Результаты /transactions и /behavior: повторные и одновременные запросы не разбирают файл заново
+analysis_results = AnalysisResultCache()
+
+# Форматы отчета: разделы сообщений, документы для отправки и страница Confluence
+REPORT_DOCUMENTS = ("txt", "md", "json")
+REPORT_FORMATS = ("chat", "confluence") + REPORT_DOCUMENTS
+
+# Фоновые задачи анализа в пуле процессов: разбор выгрузок не блокирует остальные чаты
+jobs = JobRunner()
+
+async def watch_analysis_job(message: types.Message, status: types.Message, job) -> Dict:
+    """Ждет фоновую задачу от имени автора message и показывает прогресс в его статусном сообщении"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Отменить", callback_data=f"cancel_job:{job.id}")]
+    ])
+    last_text = status.text
+    
+    async def show_progress(job):
+        nonlocal last_text
+        text = format_job_status(job)
+        if text == last_text:
+            return
+        last_text = text
+        try:
+            await status.edit_text(text, reply_markup=keyboard)
+        except TelegramBadRequest:
+            pass
+    
+    try:
+        await status.edit_reply_markup(reply_markup=keyboard)
+    except TelegramBadRequest:
+        pass
+    try:
+        return await jobs.wait(job, show_progress, user_id=message.from_user.id)
+    finally:
+        try:
+            await status.edit_reply_markup(reply_markup=None)
+        except TelegramBadRequest:
+            pass
+
+async def run_analysis_job(message: types.Message, status: types.Message, title: str, func, **kwargs) -> Dict:
+    """Запускает анализ фоновой задачей и показывает прогресс в статусном сообщении"""
+    job = jobs.submit(message.from_user.id, title, func, **kwargs)
+    return await watch_analysis_job(message, status, job)
+
+def queue_notifier(message: types.Message):
+    """Сообщает пользователю позицию в очереди к Gemini, если квота занята"""
+    async def on_wait(position: int):
+        try:
+            await message.answer(f"⏳ Много запросов, ваша позиция в очереди: {position}")
+        except TelegramBadRequest:
+            pass
+    return on_wait
 
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     # Очищаем память при старте
-    user_id = message.from_user.id
-    if user_id in chats:
-        del chats[user_id]
-    if user_id in metrics:
-        del metrics[user_id]
+    clear_session(message.from_user.id)
     help_text = (
         "👨‍💻 Привет! Я AI-Бизнес Аналитик (на базе Gemini).\n\n"
         "**Доступные команды:**\n"
@@ -36,6 +110,9 @@ async def cmd_start(message: types.Message):
         "/clear - Очистить память и начать заново\n"
         "/transactions - Проанализировать транзакции из CSV\n"
         "/behavior - Проанализировать поведенческие паттерны\n"
+        "/client <id> - Показать профиль клиента\n"
+        "/risk - Мошенничество в разрезе поведения клиентов\n"
+        "/cancel - Отменить запущенный анализ\n"
         "/confluence - Проверить подключение к Confluence\n"
         "/files - Показать мои файлы\n"
         "/lastfile - Отправить последний сгенерированный файл\n"
@@ -55,6 +132,9 @@ async def cmd_help(message: types.Message):
         "/clear - Очистить память и начать новый кейс\n"
         "/transactions - Проанализировать транзакции из CSV файла\n"
         "/behavior - Проанализировать поведенческие паттерны клиентов\n"
+        "/client <id> - Показать агрегаты по клиенту (транзакции, устройство, логины)\n"
+        "/risk - Связать транзакции с поведением и показать долю мошенничества по сегментам\n"
+        "/cancel - Отменить запущенный анализ выгрузки\n"
         "/confluence - Проверить подключение к Confluence\n"
         "/files - Показать список ваших файлов\n"
         "/lastfile - Отправить последний сгенерированный файл\n"
@@ -73,20 +153,30 @@ async def cmd_help(message: types.Message):
 
 @dp.message(Command("clear"))
 async def cmd_clear(message: types.Message):
-    user_id = message.from_user.id
-    if user_id in chats:
-        del chats[user_id]
-    if user_id in metrics:
-        del metrics[user_id]
+    clear_session(message.from_user.id)
     await message.answer("🧠 Память очищена. Начинаем новый кейс.")
 
 @dp.message(Command("transactions"))
 async def cmd_transactions(message: types.Message):
     """Анализ транзакций из CSV файла"""
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
-    await message.answer("📊 Анализирую транзакции...")
+    status = await message.answer("📊 Анализирую транзакции...")
     
-    stats = analyze_transactions()
+    # Выгрузка дописывается ежедневно - разбираем только новые строки
+    key = analysis_cache_key("transactions", DEFAULT_TRANSACTIONS_FILE, TRANSACTIONS_ANALYZER_VERSION)
+    # Хеш выгрузки запоминается в главном процессе и передается задаче
+    hashes = await asyncio.to_thread(content_hash_memo, [DEFAULT_TRANSACTIONS_FILE])
+    try:
+        # Одинаковые запросы из разных чатов ждут одну задачу, прогресс видит каждый
+        stats = await analysis_results.get_or_compute(
+            key,
+            lambda: jobs.submit(message.from_user.id, "📊 Анализирую транзакции",
+                                analyze_transactions, content_hashes=hashes, incremental=True),
+            lambda job: watch_analysis_job(message, status, job)
+        )
+    except JobCancelled:
+        await status.edit_text("⛔ Анализ транзакций отменен")
+        return
     summary = get_transaction_statistics_summary(stats)
     
     await message.answer(summary, parse_mode="Markdown")
@@ -95,13 +185,71 @@ async def cmd_transactions(message: types.Message):
 async def cmd_behavior(message: types.Message):
     """Анализ поведенческих паттернов клиентов из CSV файла"""
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
-    await message.answer("🔍 Анализирую поведенческие паттерны клиентов...")
+    status = await message.answer("🔍 Анализирую поведенческие паттерны клиентов...")
     
-    stats = analyze_behavior_patterns()
+    key = analysis_cache_key("behavior", DEFAULT_BEHAVIOR_FILE, BEHAVIOR_ANALYZER_VERSION)
+    hashes = await asyncio.to_thread(content_hash_memo, [DEFAULT_BEHAVIOR_FILE])
+    try:
+        stats = await analysis_results.get_or_compute(
+            key,
+            lambda: jobs.submit(message.from_user.id, "🔍 Анализирую поведенческие паттерны клиентов",
+                                analyze_behavior_patterns, content_hashes=hashes, incremental=True),
+            lambda job: watch_analysis_job(message, status, job)
+        )
+    except JobCancelled:
+        await status.edit_text("⛔ Анализ поведенческих паттернов отменен")
+        return
     summary = get_behavior_statistics_summary(stats)
     
     await message.answer(summary, parse_mode="Markdown")
 
+@dp.message(Command("client"))
+async def cmd_client(message: types.Message):
+    """Агрегаты по клиенту из индекса cst_dim_id"""
+    parts = (message.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        await message.answer("ℹ️ Укажите идентификатор клиента: /client 2937833270")
+        return
+    
+    # Первый запрос строит индекс - не держим цикл событий
+    info = await asyncio.to_thread(lookup_client, int(parts[1]))
+    await message.answer(get_client_summary(info), parse_mode="Markdown")
+
+@dp.message(Command("risk"))
+async def cmd_risk(message: types.Message):
+    """Доля мошенничества по поведенческим сегментам (транзакции × поведение)"""
+    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    status = await message.answer("🛡️ Связываю транзакции с поведенческими паттернами...")
+    
+    hashes = await asyncio.to_thread(content_hash_memo, [DEFAULT_TRANSACTIONS_FILE, DEFAULT_BEHAVIOR_FILE])
+    try:
+        stats = await run_analysis_job(message, status, "🛡️ Связываю транзакции с поведенческими паттернами",
+                                       join_risk_statistics, content_hashes=hashes)
+    except JobCancelled:
+        await status.edit_text("⛔ Риск-анализ отменен")
+        return
+    summary = get_risk_statistics_summary(stats)
+    
+    await message.answer(summary, parse_mode="Markdown")
+
+@dp.message(Command("cancel"))
+async def cmd_cancel(message: types.Message):
+    """Отмена запущенных фоновых анализов пользователя (общий анализ продолжается для остальных)"""
+    cancelled = jobs.cancel_user_jobs(message.from_user.id)
+    if cancelled:
+        await message.answer(f"⛔ Отменяю анализ ({cancelled})...")
+    else:
+        await message.answer("ℹ️ Нет запущенных анализов.")
+
+@dp.callback_query(F.data.startswith("cancel_job:"))
+async def cancel_job_callback(callback: types.CallbackQuery):
+    """Кнопка «Отменить» под статусом анализа"""
+    job = jobs.jobs.get(int(callback.data.split(":", 1)[1]))
+    if job is None or not jobs.detach_user(job, callback.from_user.id):
+        await callback.answer("Задача уже завершена")
+        return
+    await callback.answer("Отменяю...")
+
 @dp.message(Command("confluence"))
 async def cmd_confluence(message: types.Message):
     """Проверка подключения к Confluence"""
@@ -118,33 +266,43 @@ async def cmd_confluence(message: types.Message):
 
 @dp.message(Command("files"))
 async def cmd_files(message: types.Message):
-    """Показать список файлов пользователя"""
+    """Показать список файлов пользователя (/files 2 - следующая страница)"""
     user_id = message.from_user.id
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    files = list_user_files(user_id)
+    args = message.text.split()[1:] if message.text else []
+    page = max(1, int(args[0])) if args and args[0].isdigit() else 1
+    offset = (page - 1) * FILES_PAGE_SIZE
     
-    if not files:
+    total = count_user_files(user_id)
+    files = list_user_files(user_id, FILES_PAGE_SIZE, offset)
+    
+    if not total:
         await message.answer("📁 У вас пока нет сохраненных файлов.")
         return
+    if not files:
+        await message.answer(f"📁 Страница {page} пуста. Всего файлов: {total}.")
+        return
     
-    # Показываем список файлов
-    files_text = f"📁 **Ваши файлы ({len(files)}):**\n\n"
-    for i, file_info in enumerate(files[:10], 1):  # Показываем первые 10
+    # Показываем страницу списка
+    files_text = f"📁 **Ваши файлы ({total}):**\n\n"
+    for i, file_info in enumerate(files, offset + 1):
         size_kb = file_info["size"] / 1024
         time_str = file_info["modified"].strftime("%d.%m.%Y %H:%M")
         files_text += f"{i}. **{file_info['name']}**\n"
         files_text += f"   📏 {size_kb:.2f} KB | 🕒 {time_str}\n\n"
     
-    if len(files) > 10:
-        files_text += f"... и еще {len(files) - 10} файлов\n\n"
+    remaining = total - offset - len(files)
+    if remaining > 0:
+        files_text += f"... и еще {remaining} файлов (/files {page + 1})\n\n"
     
     files_text += "💡 Отправьте номер файла или его имя, чтобы получить его."
     
-    await message.answer(files_text, parse_mode="Markdown")
+    # Имена файлов с "_" могут не разобраться как Markdown - тогда список уйдет простым текстом
+    await send_text(message, files_text, parse_mode="Markdown")
     
-    # Сохраняем список файлов для последующего доступа
-    user_files_cache[user_id] = files
+    # Запоминаем показанную страницу для выбора файла по номеру
+    user_files_cache[user_id] = {"offset": offset, "files": files}
 
 @dp.message(Command("lastfile"))
 async def cmd_lastfile(message: types.Message):
@@ -152,14 +310,14 @@ async def cmd_lastfile(message: types.Message):
     user_id = message.from_user.id
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    files = list_user_files(user_id)
+    files = list_user_files(user_id, limit=1)
     
     if not files:
         await message.answer("📁 У вас пока нет сохраненных файлов.")
         return
     
-    # Берем самый последний файл
-    last_file = files[0]  # Файлы уже отсортированы по дате
+    # Каталог отдает файлы от новых к старым
+    last_file = files[0]
     await send_file_to_user(message, last_file["path"], last_file["name"])
 
 @dp.message(lambda message: message.photo)
@@ -180,13 +338,21 @@ async def handle_photo(message: types.Message):
         
         # Обрабатываем изображение
         caption = message.caption or "Проанализируй это изображение в контексте бизнес-процесса"
-        response = await get_ai_response_with_image(user_id, caption, file_path)
+        # Тот же скриншот с той же подписью в новой сессии отвечается из кеша
+        cache_key = response_cache_key("image", await asyncio.to_thread(file_content_hash, file_path), caption)
+        reply = StreamingReply(message)
+        response = await get_ai_response_with_image(user_id, caption, file_path, on_wait=queue_notifier(message),
+                                                    on_chunk=reply.push, cache_key=cache_key)
         
         if response["type"] == "text":
-            await message.answer(response["text"])
+            await reply.finish(response["text"])
         elif response["type"] == "final":
+            await reply.discard()
             await handle_final_response(message, response["data"])
+        elif response["type"] == "busy":
+            await message.answer(f"⏳ {response['text']}")
         elif response["type"] == "error":
+            await reply.discard()
             await message.answer(f"⚠️ Ошибка: {response['text']}")
         
         # Удаляем временный файл
@@ -203,32 +369,41 @@ async def handle_document(message: types.Message):
     
     try:
         document = message.document
-        file_info = await bot.get_file(document.file_id)
         
         # Определяем расширение
         file_ext = os.path.splitext(document.file_name or "file")[1]
-        file_path = f"temp_files/{user_id}_{document.file_id}{file_ext}"
-        os.makedirs("temp_files", exist_ok=True)
         
-        await bot.download_file(file_info.file_path, file_path)
-        
-        # Сохраняем информацию о файле
-        save_result = save_file(file_path, user_id, "document")
+        # Скачиваем потоком: хеш, проверки и разбор CSV по ходу загрузки; одинаковые файлы хранятся один раз
+        save_result = await save_document(bot, document, user_id)
+        if not save_result["success"]:
+            await message.answer(f"⚠️ {save_result['error']}")
+            return
+        file_path = save_result["path"]
         
         # Обрабатываем файл в зависимости от типа
         if file_ext.lower() in ['.csv', '.txt', '.md']:
-            # Читаем текстовый файл
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()[:5000]  # Ограничиваем размер
+            # Выгрузки разбираем локально целиком (обычно еще во время загрузки),
+            # в модель уходят агрегаты и выборка строк
+            file_name = document.file_name or f"file{file_ext}"
+            content = await asyncio.to_thread(describe_upload, file_path, file_name, save_result["parsed"])
             
-            text = message.caption or f"Проанализируй содержимое этого файла:\n\n{content}"
-            response = await get_ai_response(user_id, text)
+            request = message.caption or "Проанализируй содержимое этого файла"
+            text = f"{request}\n\n{content}"
+            # Имя файла есть в тексте запроса, поэтому входит и в ключ
+            cache_key = response_cache_key("document", save_result["content_hash"], request, file_name)
+            reply = StreamingReply(message, prefix="📄 Файл получен и обработан!\n\n")
+            response = await get_ai_response(user_id, text, on_wait=queue_notifier(message),
+                                             on_chunk=reply.push, cache_key=cache_key)
             
             if response["type"] == "text":
-                await message.answer(f"📄 Файл получен и обработан!\n\n{response['text']}")
+                await reply.finish(response["text"])
             elif response["type"] == "final":
+                await reply.discard()
                 await handle_final_response(message, response["data"])
+            elif response["type"] == "busy":
+                await message.answer(f"⏳ {response['text']}")
             elif response["type"] == "error":
+                await reply.discard()
                 await message.answer(f"⚠️ Ошибка: {response['text']}")
         else:
             await message.answer(
@@ -241,160 +416,125 @@ async def handle_document(message: types.Message):
     except Exception as e:
         await message.answer(f"⚠️ Ошибка обработки документа: {str(e)}")
 
+async def _timed(timings: Dict[str, float], stage: str, awaitable):
+    """Выполняет этап отчета и записывает его длительность"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 2)
+
+async def send_diagram(message: types.Message, mermaid_code: str):
+    """Схема процесса: первый раз Telegram скачивает картинку с mermaid.ink, повторно - по file_id"""
+    diagram_url = generate_diagram_link(mermaid_code)
+    try:
+        # Пробуем отправить как фото через URL
+        await send_with_file_id(
+            "photo", content_hash(mermaid_code),
+            lambda media: telegram_limiter.send(message.chat.id, message.answer_photo, media,
+                                                caption="📊 Схема процесса (Sequence Diagram)"),
+            diagram_url
+        )
+    except Exception:
+        # Если не получилось, отправляем ссылку
+        await send_text(message, f"📊 **Схема процесса:**\n{diagram_url}", parse_mode="Markdown")
+
+async def report_confluence(message: types.Message, publish: Awaitable[Dict]):
+    """Публикует страницу в Confluence (в рабочем потоке) и сообщает результат"""
+    try:
+        confluence_result = await publish
+    except Exception as e:
+        confluence_result = {"success": False, "message": str(e)}
+    if confluence_result.get("success"):
+        await send_text(
+            message,
+            f"✅ <b>Confluence:</b> {html.escape(str(confluence_result.get('message')))}\n"
+            f"📄 Страница: {html.escape(str(confluence_result.get('page_url', 'N/A')))}",
+            parse_mode="HTML"
+        )
+    else:
+        await send_text(
+            message,
+            f"ℹ️ <b>Confluence:</b> "
+            f"{html.escape(str(confluence_result.get('message', 'Не удалось создать страницу')))}",
+            parse_mode="HTML"
+        )
+
+def store_report_documents(user_id: int, documents: Dict[str, tuple]):
+    """Сохраняет документы отчета в каталог файлов пользователя"""
+    for filename, content in documents.values():
+        save_generated_document(user_id, filename, content)
+
+async def upload_requirements_document(message: types.Message, filename: str, content: bytes, label: str):
+    """Отправляет документ с требованиями прямо из памяти (повторно - по file_id)"""
+    try:
+        await send_with_file_id(
+            "document", content_hash(content),
+            lambda media: telegram_limiter.send(message.chat.id, message.answer_document, media,
+                                                caption=f"📄 Документ с требованиями ({label})"),
+            BufferedInputFile(content, filename=filename)
+        )
+    except Exception as e:
+        await send_text(message, f"⚠️ Не удалось отправить {label} файл: {str(e)}")
+
 async def handle_final_response(message: types.Message, data: Dict):
     """Обработка финального ответа с требованиями"""
-    metrics = data.get("metrics", {})
+    timings: Dict[str, float] = {}
+    started = time.perf_counter()
+    
+    # Все представления отчета (сообщения, документы, страница Confluence) - за один проход, в памяти
+    report = Report(data)
+    rendered = await _timed(timings, "рендеринг", asyncio.to_thread(render_report, report, REPORT_FORMATS))
+    
+    # Страница в Confluence публикуется только после того, как разделы дошли до пользователя
+    sections_started = time.perf_counter()
+    await send_report_sections(message, report, rendered["chat"])
+    timings["сообщения"] = round(time.perf_counter() - sections_started, 2)
+    
+    # Диаграмма, Confluence и файлы отправляются параллельно, каждый - как только готов
+    stem = report.file_stem()
+    documents = {fmt: (f"{stem}.{DOCUMENT_FORMATS[fmt]}", rendered[fmt].encode("utf-8"))
+                 for fmt in REPORT_DOCUMENTS}
+    stages = {
+        "отправка confluence": report_confluence(message, _timed(
+            timings, "confluence", asyncio.to_thread(create_confluence_page, data, None, rendered["confluence"]))),
+        # Копии документов - в список файлов пользователя (/files, /lastfile)
+        "сохранение": asyncio.to_thread(store_report_documents, message.from_user.id, documents),
+    }
+    for fmt, (filename, content) in documents.items():
+        stages[f"отправка {fmt}"] = upload_requirements_document(message, filename, content, fmt.upper())
+    if report.mermaid_code:
+        stages["диаграмма"] = send_diagram(message, report.mermaid_code)
+    results = await asyncio.gather(*(_timed(timings, stage, awaitable) for stage, awaitable in stages.items()),
+                                   return_exceptions=True)
+    for stage, result in zip(stages, results):
+        if isinstance(result, Exception):
+            logging.error(f"Этап отчета «{stage}» завершился ошибкой: {result!r}")
+    logging.info(
+        f"Отчет «{report.project_name}» отправлен за {time.perf_counter() - started:.2f} с, "
+        f"этапы: {timings}"
+    )
+
+async def send_report_sections(message: types.Message, report: Report, sections: List[str]):
+    """Текстовые разделы отчета"""
+    # Разделы упаковываются в сообщения до 4096 символов и уходят через лимитер Telegram
+    out = MessageBatcher(message, parse_mode="HTML")
+    metrics = report.metrics
     
     # Показываем метрики времени
-    time_msg = f"⏱️ **Время формирования:** {metrics.get('total_time_minutes', 0):.2f} минут"
+    time_msg = f"⏱️ <b>Время формирования:</b> {metrics.get('total_time_minutes', 0):.2f} минут"
     if metrics.get('total_time_minutes', 0) <= 5:
         time_msg += " ✅ (соответствует критерию ≤5 минут)"
     else:
         time_msg += " ⚠️ (превышает критерий)"
     
-    await message.answer("✅ **Анализ завершен!** Готовлю документы...", parse_mode="Markdown")
-    await message.answer(time_msg, parse_mode="Markdown")
-    
-    # 1. Основная информация
-    main_info = f"📁 **Проект:** {data.get('project_name', 'Не указано')}\n\n"
-    
-    if data.get('goal'):
-        main_info += f"🎯 **Цель:** {data.get('goal')}\n\n"
-    
-    if data.get('summary'):
-        main_info += f"📝 **Описание:** {data.get('summary')}\n\n"
-    
-    if data.get('scope'):
-        scope = data['scope']
-        main_info += "📌 **Scope:**\n"
-        if scope.get('in_scope'):
-            main_info += "✅ Входит:\n"
-            for item in scope['in_scope']:
-                main_info += f"  • {item}\n"
-        if scope.get('out_scope'):
-            main_info += "❌ Не входит:\n"
-            for item in scope['out_scope']:
-                main_info += f"  • {item}\n"
-        main_info += "\n"
-    
-    await message.answer(main_info, parse_mode="Markdown")
-    
-    # 2. Участники
-    if data.get('actors'):
-        actors_text = "👤 **Участники:**\n"
-        for actor in data['actors']:
-            if isinstance(actor, dict):
-                actors_text += f"• **{actor.get('role', '')}**: {actor.get('description', '')}\n"
-            else:
-                actors_text += f"• {actor}\n"
-        await message.answer(actors_text, parse_mode="Markdown")
-    
-    # 3. Триггер и результат
-    if data.get('trigger'):
-        await message.answer(f"🔔 **Триггер:** {data.get('trigger')}", parse_mode="Markdown")
-    
-    if data.get('expected_result'):
-        await message.answer(f"✅ **Ожидаемый результат:** {data.get('expected_result')}", parse_mode="Markdown")
-    
-    # 4. Бизнес-правила
-    if data.get('business_rules'):
-        rules_text = "📜 **Бизнес-правила:**\n"
-        for i, rule in enumerate(data['business_rules'], 1):
-            rules_text += f"{i}. {rule}\n"
-        await message.answer(rules_text, parse_mode="Markdown")
-    
-    # 5. KPI
-    if data.get('kpi'):
-        kpi_text = "📊 **KPI и метрики:**\n"
-        for kpi in data['kpi']:
-            if isinstance(kpi, dict):
-                kpi_text += f"• **{kpi.get('metric', '')}**: {kpi.get('target', '')} - {kpi.get('description', '')}\n"
-        await message.answer(kpi_text, parse_mode="Markdown")
-    
-    # 6. Требования
-    if data.get('requirements'):
-        req_text = "📋 **Функциональные требования:**\n"
-        for i, req in enumerate(data['requirements'], 1):
-            req_text += f"{i}. {req}\n"
-        await message.answer(req_text, parse_mode="Markdown")
-    
-    # 7. Use Cases
-    if data.get('use_cases'):
-        for uc in data['use_cases']:
-            if isinstance(uc, dict):
-                uc_text = (
-                    f"📘 **{uc.get('id', '')} - {uc.get('title', '')}**\n"
-                    f"Actor: {uc.get('actor', '')}\n"
-                    f"Precondition: {uc.get('precondition', '')}\n"
-                    f"Main Flow:\n"
-                )
-                for step in uc.get('main_flow', []):
-                    uc_text += f"  • {step}\n"
-                uc_text += f"Postcondition: {uc.get('postcondition', '')}\n"
-                await message.answer(uc_text, parse_mode="Markdown")
-    
-    # 8. User Stories
-    if data.get('user_stories'):
-        for us in data['user_stories']:
-            if isinstance(us, dict):
-                us_text = (
-                    f"📗 **{us.get('id', '')}**\n"
-                    f"As **{us.get('as', '')}** I want **{us.get('i_want', '')}** so that {us.get('so_that', '')}\n"
-                )
-                if us.get('acceptance_criteria'):
-                    us_text += "Acceptance Criteria:\n"
-                    for criteria in us['acceptance_criteria']:
-                        us_text += f"  ✓ {criteria}\n"
-                await message.answer(us_text, parse_mode="Markdown")
-    
-    # 9. Диаграмма
-    if data.get('mermaid_code'):
-        diagram_url = generate_diagram_link(data.get("mermaid_code", ""))
-        try:
-            # Пробуем отправить как фото через URL
-            await message.answer_photo(diagram_url, caption="📊 Схема процесса (Sequence Diagram)")
-        except:
-            # Если не получилось, отправляем ссылку
-            await message.answer(f"📊 **Схема процесса:**\n{diagram_url}", parse_mode="Markdown")
-    
-    # 10. Интеграция с Confluence
-    await message.answer("🔄 Создаю страницу в Confluence...", parse_mode="Markdown")
-    confluence_result = create_confluence_page(data)
-    if confluence_result.get("success"):
-        await message.answer(
-            f"✅ **Confluence:** {confluence_result.get('message')}\n"
-            f"📄 Страница: {confluence_result.get('page_url', 'N/A')}",
-            parse_mode="Markdown"
-        )
-    else:
-        await message.answer(
-            f"ℹ️ **Confluence:** {confluence_result.get('message', 'Не удалось создать страницу')}",
-            parse_mode="Markdown"
-        )
-    
-    # 11. Генерируем и отправляем файлы с требованиями
-    await message.answer("📄 Генерирую документ с требованиями...", parse_mode="Markdown")
+    await out.add("✅ <b>Анализ завершен!</b> Готовлю документы...")
+    await out.add(time_msg)
     
-    txt_file = generate_requirements_document(data, "txt")
-    json_file = generate_requirements_document(data, "json")
+    for section in sections:
+        await out.add(section)
     
-    if txt_file and os.path.exists(txt_file):
-        try:
-            await message.answer_document(
-                FSInputFile(txt_file),
-                caption="📄 Документ с требованиями (TXT)"
-            )
-        except Exception as e:
-            await message.answer(f"⚠️ Не удалось отправить TXT файл: {str(e)}")
-    
-    if json_file and os.path.exists(json_file):
-        try:
-            await message.answer_document(
-                FSInputFile(json_file),
-                caption="📄 Документ с требованиями (JSON)"
-            )
-        except Exception as e:
-            await message.answer(f"⚠️ Не удалось отправить JSON файл: {str(e)}")
+    await out.flush()
 
 @dp.message()
 async def handle_message(message: types.Message):
@@ -402,90 +542,112 @@ async def handle_message(message: types.Message):
     text = message.text.strip() if message.text else ""
     
     # Проверяем, не запрашивает ли пользователь файл
-    if user_id in user_files_cache:
-        files = user_files_cache[user_id]
-        
-        # Проверяем, является ли текст номером файла
+    shown = user_files_cache.get(user_id)
+    if shown is not None:
+        # Проверяем, является ли текст номером файла (нумерация как на показанной странице)
         try:
-            file_num = int(text)
-            if 1 <= file_num <= len(files):
-                file_info = files[file_num - 1]
+            index = int(text) - shown["offset"] - 1
+            if 0 <= index < len(shown["files"]):
+                file_info = shown["files"][index]
                 await send_file_to_user(message, file_info["path"], file_info["name"])
                 # Очищаем кеш
-                del user_files_cache[user_id]
+                user_files_cache.pop(user_id)
                 return
         except ValueError:
             pass
         
-        # Проверяем, является ли текст именем файла
-        for file_info in files:
-            if text.lower() in file_info["name"].lower():
-                await send_file_to_user(message, file_info["path"], file_info["name"])
-                del user_files_cache[user_id]
-                return
+        # Проверяем, является ли текст именем файла (поиск по всем файлам в каталоге)
+        file_info = find_user_file(user_id, text) if text else None
+        if file_info is not None:
+            await send_file_to_user(message, file_info["path"], file_info["name"])
+            user_files_cache.pop(user_id)
+            return
     
     # Обычная обработка текстового сообщения
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    # Запрос к Gemini
-    response = await get_ai_response(user_id, text)
+    # Запрос к Gemini: ответ показывается по мере генерации
+    reply = StreamingReply(message)
+    response = await get_ai_response(user_id, text, on_wait=queue_notifier(message), on_chunk=reply.push)
     
     if response["type"] == "text":
         # Просто вопрос от аналитика
-        await message.answer(response["text"])
+        await reply.finish(response["text"])
         
     elif response["type"] == "final":
         # Финал: пришли требования и диаграмма
+        await reply.discard()
         await handle_final_response(message, response["data"])
         
+    elif response["type"] == "busy":
+        # Очередь к Gemini переполнена
+        await message.answer(f"⏳ {response['text']}")
+        
     elif response["type"] == "error":
+        await reply.discard()
         await message.answer(f"⚠️ Ошибка API: {response['text']}")
 
 async def send_file_to_user(message: types.Message, file_path: str, filename: str):
-    """Отправляет файл пользователю в зависимости от его типа"""
+    """Отправляет файл пользователю в зависимости от его типа (повторно - по file_id, без загрузки)"""
     try:
         if not os.path.exists(file_path):
             await message.answer(f"❌ Файл не найден: {filename}")
             return
         
+        mark_file_used(file_path)
         file_ext = os.path.splitext(filename)[1].lower()
         file_size = os.path.getsize(file_path)
+        content_hash = await asyncio.to_thread(file_content_hash, file_path)
         
-        # Определяем тип файла и отправляем соответствующим методом
+        # Определяем тип файла и метод отправки
         if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
             # Отправляем как фото
-            await bot.send_chat_action(chat_id=message.chat.id, action="upload_photo")
-            photo = FSInputFile(file_path)
-            await message.answer_photo(photo, caption=f"📷 {filename}")
+            kind, action, send = "photo", "upload_photo", message.answer_photo
+            caption = f"📷 {filename}"
         
         elif file_ext in ['.mp4', '.avi', '.mov', '.mkv']:
             # Отправляем как видео
-            await bot.send_chat_action(chat_id=message.chat.id, action="upload_video")
-            video = FSInputFile(file_path)
-            await message.answer_video(video, caption=f"🎥 {filename}")
+            kind, action, send = "video", "upload_video", message.answer_video
+            caption = f"🎥 {filename}"
         
         elif file_ext in ['.mp3', '.wav', '.ogg', '.m4a']:
             # Отправляем как аудио
-            await bot.send_chat_action(chat_id=message.chat.id, action="upload_audio")
-            audio = FSInputFile(file_path)
-            await message.answer_audio(audio, caption=f"🎵 {filename}")
+            kind, action, send = "audio", "upload_audio", message.answer_audio
+            caption = f"🎵 {filename}"
         
         else:
             # Отправляем как документ
-            await bot.send_chat_action(chat_id=message.chat.id, action="upload_document")
-            document = FSInputFile(file_path, filename=filename)
-            await message.answer_document(document, caption=f"📄 {filename}\n📏 Размер: {file_size / 1024:.2f} KB")
+            kind, action, send = "document", "upload_document", message.answer_document
+            caption = f"📄 {filename}\n📏 Размер: {file_size / 1024:.2f} KB"
+        
+        await bot.send_chat_action(chat_id=message.chat.id, action=action)
+        await send_with_file_id(
+            kind, content_hash,
+            lambda media: telegram_limiter.send(message.chat.id, send, media, caption=caption),
+            FSInputFile(file_path, filename=filename)
+        )
     
     except Exception as e:
         await message.answer(f"⚠️ Ошибка отправки файла: {str(e)}")
 
 async def main():
     print("Бот запущен...")
-    # Очищаем старые файлы при запуске
-    cleanup_old_files()
-    await dp.start_polling(bot)
+    conversations.purge_older_than()
+    file_ids.purge_older_than()
+    janitor = asyncio.create_task(run_session_janitor())
+    flusher = asyncio.create_task(run_flush_loop(conversations))
+    # Старые файлы удаляются при запуске и дальше периодически, с квотами на объем
+    disk_cleaner = asyncio.create_task(run_disk_janitor())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        janitor.cancel()
+        flusher.cancel()
+        disk_cleaner.cancel()
+        # Дописываем в базу последние изменения диалогов
+        conversations.close()
+        file_ids.close()
+        jobs.shutdown()
 
 if __name__ == "__main__":
     asyncio.run(main())
-
-
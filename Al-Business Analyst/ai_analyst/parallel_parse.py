@@ -0,0 +1,84 @@
+"""
+Многопроцессный разбор больших CSV выгрузок.
+Файл делится на диапазоны байт по границам строк, каждый диапазон
+разбирается в отдельном процессе в частичный аккумулятор, затем
+аккумуляторы объединяются в порядке следования диапазонов.
+Прогресс сообщается после каждого диапазона; если progress бросает исключение
+(отмена задачи), оставшиеся диапазоны снимаются с пула.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from csv_ingest import data_start_offset, iter_byte_range_batches, open_csv, split_byte_ranges
+
+# Файлы крупнее этого порога разбираются параллельно автоматически
+PARALLEL_FILE_SIZE_THRESHOLD = 64 * 1024 * 1024
+
+# Диапазонов больше, чем процессов, чтобы выровнять нагрузку
+RANGES_PER_WORKER = 4
+
+
+def resolve_workers(file_path: str, workers: Optional[int] = None) -> int:
+    """Явное число процессов или автоматический выбор по размеру файла"""
+    if workers is not None:
+        return max(1, workers)
+    if os.path.getsize(file_path) > PARALLEL_FILE_SIZE_THRESHOLD:
+        return os.cpu_count() or 1
+    return 1
+
+
+def _parse_range(accumulator_cls, file_path: str, encoding: str, start: int, end: int,
+                 quoted_columns: List[int]):
+    """
+    Разбирает один диапазон байт в собственный аккумулятор (выполняется в дочернем процессе).
+    Возвращает аккумулятор и число разобранных строк.
+    """
+    accumulator = accumulator_cls()
+    rows = 0
+    for batch in iter_byte_range_batches(file_path, encoding, start, end, quoted_columns):
+        accumulator.update(batch)
+        rows += len(batch)
+    return accumulator, rows
+
+
+def parse_parallel(file_path: str, accumulator_cls, workers: int, end: Optional[int] = None,
+                   progress: Optional[Callable[[int, int, int], None]] = None):
+    """
+    Разбирает файл в workers процессах и возвращает объединенный аккумулятор.
+    accumulator_cls должен поддерживать update(batch) и merge(other).
+    end - где остановиться (по умолчанию конец файла), должен совпадать с началом строки.
+    progress(done, total, rows) вызывается после объединения каждого диапазона (байты от начала данных).
+    """
+    with open_csv(file_path) as source:
+        encoding = source.encoding
+        quoted_columns = source.quoted_columns
+
+    start = data_start_offset(file_path, encoding)
+    ranges: List[Tuple[int, int]] = split_byte_ranges(file_path, workers * RANGES_PER_WORKER, start, end)
+
+    result = accumulator_cls()
+    if not ranges:
+        return result
+
+    total = ranges[-1][1] - start
+    rows = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_parse_range, accumulator_cls, file_path, encoding, range_start, range_end, quoted_columns)
+            for range_start, range_end in ranges
+        ]
+        try:
+            # Объединяем строго по порядку диапазонов, чтобы примеры строк
+            # и порядок категорий совпадали с последовательным разбором
+            for future, (_, range_end) in zip(futures, ranges):
+                partial, range_rows = future.result()
+                result.merge(partial)
+                rows += range_rows
+                if progress is not None:
+                    progress(range_end - start, total, rows)
+        except BaseException:
+            # Отмена или ошибка: диапазоны из очереди не запускаем, ждем только уже начатые
+            pool.shutdown(cancel_futures=True)
+            raise
+    return result
@@ -0,0 +1,416 @@
+"""
+Единая модель отчета с требованиями и его представления.
+Ответ Gemini (JSON) нормализуется в Report, отчет раскладывается в
+последовательность блоков (заголовок раздела, абзац, поле, список, таблица,
+картинка), и один проход по блокам заполняет все нужные форматы сразу:
+TXT, Markdown, Confluence Storage Format (HTML) и разделы сообщений Telegram
+(HTML). Тексты экранируются под каждый формат, результат пишется в буферы
+в памяти - документы отправляются без временных файлов.
+"""
+import base64
+import html
+import io
+import json
+import re
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+# Фрагмент текста: строка или последовательность (текст, жирный)
+Inline = Union[str, Sequence[Tuple[str, bool]]]
+
+# Разделы отчета: ключ -> (заголовок, значок для Telegram)
+SECTIONS = {
+    "goal": ("Цель проекта", "🎯"),
+    "summary": ("Описание", "📝"),
+    "scope": ("Scope проекта", "📌"),
+    "actors": ("Участники", "👤"),
+    "trigger": ("Триггер процесса", "🔔"),
+    "expected_result": ("Ожидаемый результат", "✅"),
+    "business_rules": ("Бизнес-правила", "📜"),
+    "kpi": ("KPI и метрики", "📊"),
+    "requirements": ("Функциональные требования", "📋"),
+    "use_cases": ("Use Cases", "📘"),
+    "user_stories": ("User Stories", "📗"),
+    "diagram": ("Диаграмма процесса", "📊"),
+    "metrics": ("Метрики выполнения", "⏱️"),
+}
+
+# Форматы документов: расширение файла
+DOCUMENT_FORMATS = {"txt": "txt", "json": "json", "md": "md", "confluence": "html"}
+
+# Символы разметки Markdown внутри строки и в начале строки (заголовок, цитата, список)
+_MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]<>|~])")
+_MARKDOWN_LINE_START = re.compile(r"^(\s*)(#|>|\+|-|\d+(?=\.))", re.MULTILINE)
+
+
+def generate_diagram_link(mermaid_code: str) -> str:
+    """Превращает код диаграммы в картинку через сервис mermaid.ink"""
+    graphbytes = mermaid_code.encode("utf8")
+    base64_bytes = base64.b64encode(graphbytes)
+    base64_string = base64_bytes.decode("ascii")
+    return "https://mermaid.ink/img/" + base64_string
+
+
+def _text(value) -> str:
+    return "" if value is None else str(value).strip()
+
+
+def _list(value) -> List:
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _texts(value) -> List[str]:
+    return [text for text in (_text(item) for item in _list(value)) if text]
+
+
+def _dicts(value) -> List[Dict]:
+    return [item for item in _list(value) if isinstance(item, dict)]
+
+
+class Report:
+    """Нормализованный отчет: все поля есть, строки и списки приведены к одному виду"""
+
+    def __init__(self, data: Dict):
+        # Исходный JSON сохраняется для JSON-документа
+        self.data = data
+        self.project_name = _text(data.get("project_name")) or "Проект"
+        self.goal = _text(data.get("goal"))
+        self.summary = _text(data.get("summary"))
+        scope = data.get("scope") if isinstance(data.get("scope"), dict) else {}
+        self.in_scope = _texts(scope.get("in_scope"))
+        self.out_scope = _texts(scope.get("out_scope"))
+        self.actors: List[Tuple[str, str]] = [
+            (_text(actor.get("role")), _text(actor.get("description"))) if isinstance(actor, dict)
+            else ("", _text(actor))
+            for actor in _list(data.get("actors"))
+        ]
+        self.trigger = _text(data.get("trigger"))
+        self.expected_result = _text(data.get("expected_result"))
+        self.business_rules = _texts(data.get("business_rules"))
+        self.kpi = [(_text(kpi.get("metric")), _text(kpi.get("target")), _text(kpi.get("description")))
+                    for kpi in _dicts(data.get("kpi"))]
+        self.requirements = _texts(data.get("requirements"))
+        self.use_cases = [{
+            "id": _text(uc.get("id")),
+            "title": _text(uc.get("title")),
+            "actor": _text(uc.get("actor")),
+            "precondition": _text(uc.get("precondition")),
+            "main_flow": _texts(uc.get("main_flow")),
+            "postcondition": _text(uc.get("postcondition")),
+        } for uc in _dicts(data.get("use_cases"))]
+        self.user_stories = [{
+            "id": _text(us.get("id")),
+            "as": _text(us.get("as")),
+            "i_want": _text(us.get("i_want")),
+            "so_that": _text(us.get("so_that")),
+            "acceptance_criteria": _texts(us.get("acceptance_criteria")),
+        } for us in _dicts(data.get("user_stories"))]
+        self.mermaid_code = _text(data.get("mermaid_code"))
+        self.metrics = data.get("metrics") if isinstance(data.get("metrics"), dict) else {}
+
+    def file_stem(self, timestamp: str = None) -> str:
+        """Имя файла без расширения: проект и время формирования"""
+        timestamp = timestamp or datetime.now().strftime("%Y%m%d_%H%M%S")
+        safe_name = re.sub(r"[^\w\-]+", "_", self.project_name).strip("_") or "Проект"
+        return f"{safe_name}_{timestamp}"
+
+
+def report_blocks(report: Report) -> Iterator[Tuple]:
+    """Отчет как последовательность блоков, общая для всех форматов"""
+    yield ("title", report.project_name)
+    if report.goal:
+        yield ("section", "goal")
+        yield ("paragraph", report.goal)
+    if report.summary:
+        yield ("section", "summary")
+        yield ("paragraph", report.summary)
+    if report.in_scope or report.out_scope:
+        yield ("section", "scope")
+        if report.in_scope:
+            yield ("subheading", "Входит в scope:")
+            yield ("items", "bullet", report.in_scope)
+        if report.out_scope:
+            yield ("subheading", "Не входит в scope:")
+            yield ("items", "bullet", report.out_scope)
+    if report.actors:
+        yield ("section", "actors")
+        yield ("items", "bullet", [[(role, True), (f": {description}", False)] if role else description
+                                   for role, description in report.actors])
+    if report.trigger:
+        yield ("section", "trigger")
+        yield ("paragraph", report.trigger)
+    if report.expected_result:
+        yield ("section", "expected_result")
+        yield ("paragraph", report.expected_result)
+    if report.business_rules:
+        yield ("section", "business_rules")
+        yield ("items", "number", report.business_rules)
+    if report.kpi:
+        yield ("section", "kpi")
+        yield ("table", ("Метрика", "Целевое значение", "Описание"), report.kpi)
+    if report.requirements:
+        yield ("section", "requirements")
+        yield ("items", "number", report.requirements)
+    if report.use_cases:
+        yield ("section", "use_cases")
+        for uc in report.use_cases:
+            yield ("subheading", f"{uc['id']} - {uc['title']}")
+            yield ("field", "Actor", uc["actor"])
+            yield ("field", "Precondition", uc["precondition"])
+            yield ("field", "Main Flow", "")
+            yield ("items", "number", uc["main_flow"])
+            yield ("field", "Postcondition", uc["postcondition"])
+    if report.user_stories:
+        yield ("section", "user_stories")
+        for us in report.user_stories:
+            yield ("subheading", us["id"])
+            yield ("paragraph", [("As", True), (f" {us['as']} ", False), ("I want", True),
+                                 (f" {us['i_want']} ", False), ("so that", True), (f" {us['so_that']}", False)])
+            if us["acceptance_criteria"]:
+                yield ("field", "Acceptance Criteria", "")
+                yield ("items", "check", us["acceptance_criteria"])
+    if report.mermaid_code:
+        yield ("section", "diagram")
+        yield ("image", generate_diagram_link(report.mermaid_code), "Sequence Diagram")
+    if report.metrics:
+        yield ("section", "metrics")
+        yield ("items", "bullet", [
+            f"Время формирования: {report.metrics.get('total_time_minutes', 0):.2f} минут",
+            f"Количество сообщений: {report.metrics.get('messages_count', 0)}",
+        ])
+
+
+class _Writer:
+    """Представление отчета в одном формате; пишет в буфер в памяти"""
+
+    # Разделы, которые формат не выводит
+    skip_sections: Tuple[str, ...] = ()
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.write = self.buffer.write
+        self.skipping = False
+
+    def escape(self, text: str) -> str:
+        return text
+
+    def bold(self, text: str) -> str:
+        return text
+
+    def inline(self, value: Inline) -> str:
+        if isinstance(value, str):
+            return self.escape(value)
+        return "".join(self.bold(self.escape(text)) if strong else self.escape(text) for text, strong in value)
+
+    def feed(self, block: Tuple):
+        kind = block[0]
+        if kind == "section":
+            self.skipping = block[1] in self.skip_sections
+        if not self.skipping:
+            getattr(self, kind)(*block[1:])
+
+    def getvalue(self) -> str:
+        return self.buffer.getvalue()
+
+
+class TextWriter(_Writer):
+    """Обычный текст (TXT-документ)"""
+
+    skip_sections = ("diagram",)
+
+    def title(self, text):
+        self.write(f"БИЗНЕС-ТРЕБОВАНИЯ: {text}\n{'=' * 80}\n")
+
+    def section(self, key):
+        self.write(f"\n{SECTIONS[key][0].upper()}:\n")
+
+    def subheading(self, text):
+        self.write(f"\n{text}\n")
+
+    def paragraph(self, text):
+        self.write(f"{self.inline(text)}\n")
+
+    def field(self, label, value):
+        self.write(f"{label}: {value}\n" if value else f"{label}:\n")
+
+    def items(self, style, items):
+        for i, item in enumerate(items, 1):
+            marker = {"bullet": "  •", "number": f"{i}.", "check": "  ✓"}[style]
+            self.write(f"{marker} {self.inline(item)}\n")
+
+    def table(self, headers, rows):
+        for metric, target, description in rows:
+            self.write(f"  • {metric}: {target} - {description}\n")
+
+    def image(self, url, alt):
+        pass
+
+
+class MarkdownWriter(_Writer):
+    """Markdown-документ"""
+
+    def escape(self, text):
+        text = _MARKDOWN_SPECIAL.sub(r"\\\1", text)
+        return _MARKDOWN_LINE_START.sub(lambda m: f"{m.group(1)}{m.group(2)}\\" if m.group(2)[0].isdigit()
+                                        else f"{m.group(1)}\\{m.group(2)}", text)
+
+    def bold(self, text):
+        return f"**{text}**"
+
+    def title(self, text):
+        self.write(f"# {self.escape(text)}\n\n")
+
+    def section(self, key):
+        self.write(f"## {self.escape(SECTIONS[key][0])}\n\n")
+
+    def subheading(self, text):
+        self.write(f"### {self.escape(text)}\n\n")
+
+    def paragraph(self, text):
+        self.write(f"{self.inline(text)}\n\n")
+
+    def field(self, label, value):
+        self.write(f"{self.bold(self.escape(label))}: {self.escape(value)}\n\n" if value
+                   else f"{self.bold(self.escape(label))}:\n\n")
+
+    def items(self, style, items):
+        for i, item in enumerate(items, 1):
+            marker = {"bullet": "-", "number": f"{i}.", "check": "- [x]"}[style]
+            self.write(f"{marker} {self.inline(item)}\n")
+        self.write("\n")
+
+    def table(self, headers, rows):
+        self.write("| " + " | ".join(self.escape(h) for h in headers) + " |\n")
+        self.write("|" + " --- |" * len(headers) + "\n")
+        for row in rows:
+            self.write("| " + " | ".join(self.escape(cell) for cell in row) + " |\n")
+        self.write("\n")
+
+    def image(self, url, alt):
+        self.write(f"![{self.escape(alt)}]({url})\n\n")
+
+
+class HtmlWriter(_Writer):
+    """Confluence Storage Format (XHTML)"""
+
+    def escape(self, text):
+        return html.escape(text, quote=False)
+
+    def bold(self, text):
+        return f"<strong>{text}</strong>"
+
+    def title(self, text):
+        self.write(f"<h1>{self.escape(text)}</h1>\n")
+
+    def section(self, key):
+        self.write(f"<h2>{self.escape(SECTIONS[key][0])}</h2>\n")
+
+    def subheading(self, text):
+        self.write(f"<h3>{self.escape(text)}</h3>\n")
+
+    def paragraph(self, text):
+        self.write(f"<p>{self.inline(text)}</p>\n")
+
+    def field(self, label, value):
+        value = f" {self.escape(value)}" if value else ""
+        self.write(f"<p>{self.bold(self.escape(label))}:{value}</p>\n")
+
+    def items(self, style, items):
+        tag = "ol" if style == "number" else "ul"
+        self.write(f"<{tag}>\n")
+        for item in items:
+            self.write(f"<li>{self.inline(item)}</li>\n")
+        self.write(f"</{tag}>\n")
+
+    def table(self, headers, rows):
+        self.write("<table>\n<tr>" + "".join(f"<th>{self.escape(h)}</th>" for h in headers) + "</tr>\n")
+        for row in rows:
+            self.write("<tr>" + "".join(f"<td>{self.escape(cell)}</td>" for cell in row) + "</tr>\n")
+        self.write("</table>\n")
+
+    def image(self, url, alt):
+        self.write(f"<p><img src=\"{html.escape(url)}\" alt=\"{html.escape(alt)}\" /></p>\n")
+
+
+class ChatWriter(HtmlWriter):
+    """
+    Разделы сообщений Telegram (parse_mode="HTML"). Каждый заголовок начинает
+    новый раздел, разделы потом упаковываются в сообщения (MessageBatcher).
+    Диаграмма отправляется отдельно фото, время формирования - отдельным сообщением.
+    """
+
+    skip_sections = ("diagram", "metrics")
+
+    def __init__(self):
+        super().__init__()
+        self.sections: List[str] = []
+
+    def _next_section(self):
+        if self.buffer.tell():
+            self.sections.append(self.buffer.getvalue())
+        self.buffer = io.StringIO()
+        self.write = self.buffer.write
+
+    def bold(self, text):
+        return f"<b>{text}</b>"
+
+    def title(self, text):
+        self.write(f"📁 <b>Проект:</b> {self.escape(text)}\n")
+
+    def section(self, key):
+        self._next_section()
+        title, icon = SECTIONS[key]
+        self.write(f"{icon} <b>{self.escape(title)}:</b>\n")
+
+    def subheading(self, text):
+        self._next_section()
+        self.write(f"<b>{self.escape(text)}</b>\n")
+
+    def paragraph(self, text):
+        self.write(f"{self.inline(text)}\n")
+
+    def field(self, label, value):
+        self.write(f"{self.escape(label)}: {self.escape(value)}\n" if value else f"{self.escape(label)}:\n")
+
+    def items(self, style, items):
+        for i, item in enumerate(items, 1):
+            marker = {"bullet": "•", "number": f"{i}.", "check": "  ✓"}[style]
+            self.write(f"{marker} {self.inline(item)}\n")
+
+    def table(self, headers, rows):
+        for metric, target, description in rows:
+            self.write(f"• <b>{self.escape(metric)}</b>: {self.escape(target)} - {self.escape(description)}\n")
+
+    def getvalue(self) -> List[str]:
+        self._next_section()
+        return self.sections
+
+
+_WRITERS = {"txt": TextWriter, "md": MarkdownWriter, "confluence": HtmlWriter, "chat": ChatWriter}
+
+
+def render_report(report: Report, formats: Iterable[str]) -> Dict[str, Union[str, List[str]]]:
+    """
+    Представления отчета за один проход по блокам.
+    Форматы: txt, md, confluence (строка), json (строка), chat (список разделов).
+    """
+    formats = list(formats)
+    writers = {fmt: _WRITERS[fmt]() for fmt in formats if fmt in _WRITERS}
+    for block in report_blocks(report):
+        for writer in writers.values():
+            writer.feed(block)
+    rendered = {fmt: writer.getvalue() for fmt, writer in writers.items()}
+    if "json" in formats:
+        rendered["json"] = json.dumps(report.data, ensure_ascii=False, indent=2)
+    return rendered
+
+
+def render_documents(report: Report, formats: Iterable[str] = ("txt", "json")) -> Dict[str, Tuple[str, bytes]]:
+    """Документы для отправки: {формат: (имя файла, содержимое в UTF-8)}"""
+    stem = report.file_stem()
+    return {
+        fmt: (f"{stem}.{DOCUMENT_FORMATS[fmt]}", text.encode("utf-8"))
+        for fmt, text in render_report(report, formats).items()
+    }
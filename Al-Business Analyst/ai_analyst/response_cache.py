@@ -0,0 +1,125 @@
+"""
+Кеш ответов Gemini на первый ход диалога с файлом.
+Повторная загрузка той же выгрузки или скриншота с той же подписью в новой
+сессии отвечается с диска без запроса к модели. Ключ - хеш версии системного
+промпта и модели, содержимого файла и подписи. Размер кеша ограничен,
+при превышении удаляются записи, к которым дольше всего не обращались.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from gemini_client import GEMINI_MODEL_NAME
+from prompts import SYSTEM_PROMPT
+
+# Папка кеша ответов
+RESPONSE_CACHE_DIR = os.path.join("data", "response_cache")
+
+# Максимальный размер кеша на диске
+MAX_RESPONSE_CACHE_BYTES = 50 * 1024 * 1024
+
+# Версия промпта: при изменении системного промпта или модели старые ответы не используются
+PROMPT_VERSION = hashlib.sha256(f"{GEMINI_MODEL_NAME}\n{SYSTEM_PROMPT}".encode("utf-8")).hexdigest()[:16]
+
+
+def response_cache_key(kind: str, file_hash: str, caption: str, file_name: str = "") -> str:
+    """
+    Ключ ответа: версия промпта + тип файла + хеш содержимого + подпись.
+    file_name - имя файла, если оно попадает в текст запроса к модели.
+    """
+    raw = "\n".join((PROMPT_VERSION, kind, file_hash, caption.strip(), file_name))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Ответы на диске ({key}.json) с учетом размера и LRU-вытеснением"""
+
+    def __init__(self, directory: str = RESPONSE_CACHE_DIR, max_bytes: int = MAX_RESPONSE_CACHE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # {key: [размер, время последнего обращения]}, заполняется при первом обращении
+        self._index: Optional[Dict[str, list]] = None
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load_index(self) -> Dict[str, list]:
+        if self._index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._index = {}
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    self._index[entry.name[:-5]] = [stat.st_size, stat.st_mtime]
+            self.total_bytes = sum(size for size, _ in self._index.values())
+        return self._index
+
+    def _forget(self, key: str):
+        size, _ = self._index.pop(key)
+        self.total_bytes -= size
+
+    def get(self, key: str) -> Optional[str]:
+        """Текст сохраненного ответа или None"""
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                try:
+                    with open(self._path(key), encoding="utf-8") as f:
+                        text = json.load(f)["text"]
+                except (OSError, ValueError, KeyError):
+                    self._forget(key)
+                else:
+                    index[key][1] = time.time()
+                    self.stats["hits"] += 1
+                    return text
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, text: str):
+        """Сохраняет ответ (атомарно: через временный файл) и вытесняет старые записи сверх лимита"""
+        data = json.dumps({"text": text, "prompt_version": PROMPT_VERSION, "created": time.time()},
+                          ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            index = self._load_index()
+            path = self._path(key)
+            tmp_path = f"{path}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.warning(f"Не удалось сохранить ответ в кеш: {e}")
+                return
+            if key in index:
+                self._forget(key)
+            index[key] = [len(data), time.time()]
+            self.total_bytes += len(data)
+            self.stats["stored"] += 1
+
+            while self.total_bytes > self.max_bytes:
+                oldest = min(index, key=lambda k: index[k][1])
+                self._forget(oldest)
+                self.stats["evicted"] += 1
+                try:
+                    os.remove(self._path(oldest))
+                except OSError:
+                    pass
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def describe(self) -> str:
+        return (f"попаданий {self.stats['hits']}, промахов {self.stats['misses']} "
+                f"({self.hit_rate:.0%}), записей {len(self._index or {})}, "
+                f"{self.total_bytes / 1024:.0f} KB")
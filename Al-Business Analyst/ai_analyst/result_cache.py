@@ -0,0 +1,106 @@
+"""
+Кеш результатов анализа для /transactions и /behavior.
+Ключ - (тип анализа, путь, размер, время изменения, версия анализатора),
+вытеснение по LRU. Одновременные одинаковые запросы ждут одно
+общее вычисление (single-flight) вместо того, чтобы разбирать файл заново;
+каждый ожидающий может уйти сам, не отменяя вычисление для остальных.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+# Сколько результатов держим в памяти
+RESULT_CACHE_SIZE = 32
+
+
+def analysis_cache_key(kind: str, file_path: str, version: int) -> Tuple:
+    """Ключ результата: меняется при любом изменении файла или анализатора"""
+    try:
+        stat = os.stat(file_path)
+        size, mtime = stat.st_size, stat.st_mtime_ns
+    except OSError:
+        size, mtime = None, None
+    return (kind, os.path.abspath(file_path), size, mtime, version)
+
+
+class _Flight:
+    """Идущее вычисление: общий объект (задача asyncio или фоновая задача) и число ожидающих"""
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.waiters = 0
+
+
+class AnalysisResultCache:
+    """LRU-кеш результатов с объединением одновременных запросов"""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._results: "OrderedDict[Hashable, Dict]" = OrderedDict()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self.stats = {"hits": 0, "misses": 0, "shared": 0, "evictions": 0}
+
+    def get(self, key: Hashable) -> Optional[Dict]:
+        result = self._results.get(key)
+        if result is not None:
+            self._results.move_to_end(key)
+        return result
+
+    def put(self, key: Hashable, result: Dict):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Any],
+                             wait: Optional[Callable[[Any], Awaitable[Dict]]] = None) -> Dict:
+        """
+        Возвращает результат из кеша, присоединяется к уже идущему
+        вычислению с тем же ключом или запускает новое.
+
+        compute() запускает вычисление: возвращает awaitable с результатом или,
+        вместе с wait, общий объект с методом cancel() (например, фоновую задачу).
+        wait(shared) ждет результат от имени одного вызывающего - со своим
+        прогрессом и своей отменой: исключение ожидающего, который ушел, получает
+        только он. Вычисление отменяется, когда ожидающих не осталось.
+        Результаты с ошибкой не кешируются.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached
+
+        flight = self._inflight.get(key)
+        if flight is not None:
+            self.stats["shared"] += 1
+        else:
+            self.stats["misses"] += 1
+            shared = compute()
+            if wait is None:
+                shared = asyncio.ensure_future(shared)
+            flight = _Flight(shared)
+            self._inflight[key] = flight
+
+        flight.waiters += 1
+        finished = False
+        try:
+            if wait is not None:
+                result = await wait(flight.shared)
+            else:
+                # shield: отмена одного ожидающего не отменяет общее вычисление
+                result = await asyncio.shield(flight.shared)
+            finished = True
+            if "error" not in result:
+                self.put(key, result)
+            return result
+        finally:
+            flight.waiters -= 1
+            if self._inflight.get(key) is flight and (finished or not flight.waiters):
+                del self._inflight[key]
+                if not finished:
+                    flight.shared.cancel()
+
+    def clear(self):
+        self._results.clear()
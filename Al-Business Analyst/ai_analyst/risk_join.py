@@ -0,0 +1,149 @@
+"""
+Связывание транзакций с поведенческими паттернами по (cst_dim_id, дата).
+Индекс строится по таблице поведения (отсортированные составные ключи),
+транзакции проходят через него пакетами, без словаря на каждую строку.
+Результат - доля мошенничества в разрезе поведенческих сегментов.
+"""
+import os
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from analyze_behavior import DEFAULT_BEHAVIOR_FILE
+from analyze_transactions import DEFAULT_TRANSACTIONS_FILE
+from behavior_table import BehaviorTable
+from job_runner import JobCancelled
+from transaction_table import TransactionTable
+
+# Размер пакета транзакций при проходе через индекс
+JOIN_BATCH_SIZE = 1_000_000
+
+# Сегменты: (ключ, подпись, колонка поведения, условие)
+RISK_SEGMENTS = [
+    ("os_changes_high", "Смен ОС за месяц ≥3", "monthly_os_changes", lambda v: v >= 3),
+    ("os_changes_low", "Смен ОС за месяц <3", "monthly_os_changes", lambda v: v < 3),
+    ("phone_changes_high", "Смен телефона за месяц ≥3", "monthly_phone_model_changes", lambda v: v >= 3),
+    ("low_activity", "Менее 5 логинов за 30 дней", "logins_last_30_days", lambda v: v < 5),
+    ("normal_activity", "5 и более логинов за 30 дней", "logins_last_30_days", lambda v: v >= 5),
+]
+
+
+def _join_keys(client_ids: np.ndarray, dates: np.ndarray) -> np.ndarray:
+    """Составной ключ int64: id клиента в старших битах, номер дня в младших 20"""
+    days = np.asarray(dates, dtype="datetime64[D]").view(np.int64)
+    return (np.asarray(client_ids, dtype=np.int64) << 20) | (days & 0xFFFFF)
+
+
+class BehaviorIndex:
+    """Индекс поведенческой таблицы по (cst_dim_id, transdate)"""
+
+    def __init__(self, behavior: BehaviorTable):
+        keys = _join_keys(behavior.cst_dim_id, behavior.transdate)
+        valid = np.flatnonzero(~np.isnat(np.asarray(behavior.transdate)))
+        # Стабильная сортировка: при дублях ключа остается последняя запись
+        order = valid[np.argsort(keys[valid], kind="stable")]
+        sorted_keys = keys[order]
+        is_last = np.append(sorted_keys[1:] != sorted_keys[:-1], True) if len(order) else np.array([], dtype=bool)
+        self.keys = sorted_keys[is_last]
+        self.rows = order[is_last]
+
+    def probe(self, client_ids: np.ndarray, dates: np.ndarray) -> np.ndarray:
+        """Номера строк поведения для пакета транзакций, -1 если пары нет"""
+        keys = _join_keys(client_ids, dates)
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (self.keys[pos] == keys) & ~np.isnat(np.asarray(dates))
+        return np.where(found, self.rows[pos], -1)
+
+
+def join_risk_statistics(transactions_file: Optional[str] = None,
+                         behavior_file: Optional[str] = None,
+                         progress: Optional[Callable[[int, int, int], None]] = None) -> Dict:
+    """
+    Доля мошеннических транзакций по поведенческим сегментам клиента на дату транзакции.
+    progress(done, total, rows) вызывается после каждого пакета транзакций.
+    """
+    transactions_file = transactions_file or DEFAULT_TRANSACTIONS_FILE
+    behavior_file = behavior_file or DEFAULT_BEHAVIOR_FILE
+    for path in (transactions_file, behavior_file):
+        if not os.path.exists(path):
+            return {"error": f"Файл не найден: {path}"}
+
+    try:
+        transactions = TransactionTable.load(transactions_file)
+        behavior = BehaviorTable.load(behavior_file)
+
+        index = BehaviorIndex(behavior)
+        segment_columns = {column: np.asarray(getattr(behavior, column)) for _, _, column, _ in RISK_SEGMENTS}
+        segment_masks = {key: condition(segment_columns[column]) for key, _, column, condition in RISK_SEGMENTS}
+
+        total = len(transactions)
+        total_fraud = 0
+        matched = 0
+        matched_fraud = 0
+        segment_tx = {key: 0 for key, _, _, _ in RISK_SEGMENTS}
+        segment_fraud = {key: 0 for key, _, _, _ in RISK_SEGMENTS}
+
+        for start in range(0, total, JOIN_BATCH_SIZE):
+            end = min(start + JOIN_BATCH_SIZE, total)
+            fraud = np.asarray(transactions.target[start:end]) == 1
+            rows = index.probe(transactions.cst_dim_id[start:end], transactions.transdate[start:end])
+            hit = rows >= 0
+            total_fraud += int(np.count_nonzero(fraud))
+            matched += int(np.count_nonzero(hit))
+            matched_fraud += int(np.count_nonzero(fraud & hit))
+            hit_rows = rows[hit]
+            hit_fraud = fraud[hit]
+            for key, mask in segment_masks.items():
+                in_segment = mask[hit_rows]
+                segment_tx[key] += int(np.count_nonzero(in_segment))
+                segment_fraud[key] += int(np.count_nonzero(in_segment & hit_fraud))
+            if progress is not None:
+                progress(end, total, end)
+
+        base_rate = matched_fraud / matched * 100 if matched else 0
+        segments = []
+        for key, label, _, _ in RISK_SEGMENTS:
+            count = segment_tx[key]
+            rate = segment_fraud[key] / count * 100 if count else 0
+            segments.append({
+                "key": key,
+                "label": label,
+                "transactions": count,
+                "fraud_transactions": segment_fraud[key],
+                "fraud_rate": round(rate, 2),
+                "lift": round(rate / base_rate, 2) if base_rate else 0
+            })
+
+        return {
+            "total_transactions": total,
+            "fraud_transactions": total_fraud,
+            "matched_transactions": matched,
+            "match_rate": round(matched / total * 100, 2) if total else 0,
+            "matched_fraud_rate": round(base_rate, 2),
+            "segments": segments
+        }
+    except JobCancelled:
+        raise
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def get_risk_statistics_summary(stats: Dict) -> str:
+    """Форматирует статистику риска для вывода"""
+    if "error" in stats:
+        return f"❌ Ошибка: {stats['error']}"
+
+    segments_text = "\n".join(
+        f"• {s['label']}: {s['fraud_rate']:.2f}% мошенничества "
+        f"({s['fraud_transactions']:,} из {s['transactions']:,}, x{s['lift']:.1f})"
+        for s in stats['segments']
+    )
+    return (
+        f"🛡️ **Риск-анализ: транзакции × поведение клиентов**\n\n"
+        f"📈 Всего транзакций: {stats['total_transactions']:,}\n"
+        f"🔗 Связано с поведенческими данными: {stats['matched_transactions']:,} ({stats['match_rate']:.2f}%)\n"
+        f"⚠️ Доля мошенничества среди связанных: {stats['matched_fraud_rate']:.2f}%\n\n"
+        f"📊 **Доля мошенничества по сегментам:**\n{segments_text}"
+    )
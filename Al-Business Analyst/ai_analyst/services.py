@@ -1,157 +1,193 @@
-import google.generativeai as genai
 import json
-import base64
 import asyncio
 import time
 import os
+import logging
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Awaitable, Callable, Dict, Optional
 from PIL import Image
-from config import GOOGLE_API_KEY
-from prompts import SYSTEM_PROMPT
+from history_compaction import (budget_for, content_text, estimate_tokens, record_turn,
+                                schedule_compaction, wait_for_compaction)
+from session_store import MAX_SESSION_MEMORY_BYTES, SessionStore
+from conversation_db import ConversationStore
+from gemini_client import send_chat_message, start_chat
+from gemini_scheduler import SchedulerBusy, gemini_scheduler
+from response_cache import ResponseCache
 
-# Настройка Google API
-genai.configure(api_key=GOOGLE_API_KEY)
+# Оценка токенов изображения и ответа для квоты (уточняется по usage_metadata)
+IMAGE_TOKENS = 258
+REPLY_TOKENS_ESTIMATE = 500
+
+def _turns_size(contents) -> int:
+    """Оценка памяти под реплики истории (символы текста, ~2 байта на символ)"""
+    return sum(len(content_text(content)) for content in contents) * 2
+
+def _chat_size(chat) -> int:
+    """Оценка памяти под всю историю чата (при записи сессии в chats)"""
+    return _turns_size(chat.history)
 
 # Хранилище чатов {user_id: chat_session}
-# В Google API есть удобный объект ChatSession, который сам помнит историю
-chats = {}
+# В Google API есть удобный объект ChatSession, который сам помнит историю.
+# Брошенные диалоги удаляются по простою, лимиту числа сессий и памяти
+chats = SessionStore("chats", max_bytes=MAX_SESSION_MEMORY_BYTES, sizeof=_chat_size)
 
 # Хранилище метрик времени {user_id: {"start_time": ..., "messages_count": ...}}
-metrics = {}
+metrics = SessionStore("metrics")
+
+# Диалоги и метрики переживают перезапуск бота: в памяти только активные сессии,
+# остальные восстанавливаются из базы при следующем сообщении пользователя
+conversations = ConversationStore()
+
+# Ответы на первый ход с файлом (повторные загрузки того же файла с той же подписью)
+response_cache = ResponseCache()
+
+def clear_session(user_id: int):
+    """Удаляет диалог и метрики пользователя (/start, /clear)"""
+    chats.pop(user_id, None)
+    metrics.pop(user_id, None)
+    conversations.delete(user_id)
+
+async def _get_chat(user_id: int):
+    """Сессия чата из памяти, из базы (после перезапуска или вытеснения) или новая"""
+    chat = chats.get(user_id)
+    if chat is None:
+        # Чтение SQLite - в рабочем потоке, цикл событий не ждет диск
+        stored = await asyncio.to_thread(conversations.load, user_id)
+        # Модель общая, сессия хранит только историю
+        chat = start_chat(stored["history"] if stored else [])
+        chats[user_id] = chat
+        if stored and stored["metrics"] and user_id not in metrics:
+            metrics[user_id] = stored["metrics"]
+    return chat
+
+def estimate_request_tokens(chat, text: str) -> int:
+    """Токены запроса: история (по учету сжатия истории) + новое сообщение + ответ"""
+    return budget_for(chat).total_tokens + estimate_tokens(text) + REPLY_TOKENS_ESTIMATE
+
+def _save_session(user_id: int, chat):
+    """Ставит состояние диалога в очередь на запись в базу"""
+    conversations.save(user_id, chat.history, metrics.get(user_id))
+
+def _start_metrics(user_id: int):
+    """Инициализация и обновление метрик диалога"""
+    if user_id not in metrics:
+        metrics[user_id] = {
+            "start_time": time.time(),
+            "messages_count": 0,
+            "first_message_time": None
+        }
+    
+    metrics[user_id]["messages_count"] += 1
+    if metrics[user_id]["first_message_time"] is None:
+        metrics[user_id]["first_message_time"] = time.time()
+
+def _parse_response(user_id: int, chat, ai_text: str, request_time: float) -> Dict:
+    """Проверяем, не вернул ли Gemini JSON (финал), иначе это текст вопроса"""
+    clean_text = ai_text.replace("```json", "").replace("```", "").strip()
+    
+    try:
+        if "{" in clean_text and "}" in clean_text:
+            data = json.loads(clean_text)
+            if data.get("status") == "completed":
+                # Вычисляем общее время формирования требований
+                total_time = time.time() - metrics[user_id]["first_message_time"]
+                data["metrics"] = {
+                    "total_time_seconds": round(total_time, 2),
+                    "total_time_minutes": round(total_time / 60, 2),
+                    "messages_count": metrics[user_id]["messages_count"],
+                    "last_request_time": round(request_time, 2)
+                }
+                # Очищаем метрики после завершения
+                metrics.pop(user_id, None)
+                _save_session(user_id, chat)
+                return {"type": "final", "data": data}
+    except json.JSONDecodeError:
+        pass # Значит это просто текст вопроса
+    
+    _save_session(user_id, chat)
+    return {"type": "text", "text": ai_text}
 
-async def get_ai_response(user_id: int, user_text: str):
+async def _run_turn(user_id: int, content, text: str, extra_tokens: int = 0,
+                    on_wait: Optional[Callable[[int], Awaitable]] = None,
+                    on_chunk: Optional[Callable[[str], Awaitable]] = None,
+                    cache_key: Optional[str] = None) -> Dict:
+    """
+    Один ход диалога: сообщения пользователя обрабатываются по очереди,
+    запрос к Gemini ждет места в общей квоте.
+    cache_key - ключ кеша ответов; используется только для первого хода новой сессии.
+    """
     try:
-        # Инициализация метрик для нового диалога
-        if user_id not in metrics:
-            metrics[user_id] = {
-                "start_time": time.time(),
-                "messages_count": 0,
-                "first_message_time": None
-            }
-        
-        metrics[user_id]["messages_count"] += 1
-        if metrics[user_id]["first_message_time"] is None:
-            metrics[user_id]["first_message_time"] = time.time()
-        
-        # 1. Создаем или достаем сессию чата
-        if user_id not in chats:
-            model = genai.GenerativeModel(
-                model_name="gemini-2.0-flash",
-                system_instruction=SYSTEM_PROMPT
-            )
-            chats[user_id] = model.start_chat(history=[])
-        
-        chat = chats[user_id]
-        
-        # 2. Отправляем сообщение (синхронный вызов в executor для асинхронности)
-        start_request = time.time()
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, chat.send_message, user_text)
-        request_time = time.time() - start_request
-        
-        ai_text = response.text
-        
-        # 3. Проверяем, не вернул ли он JSON (финал)
-        clean_text = ai_text.replace("```json", "").replace("```", "").strip()
-        
-        try:
-            if "{" in clean_text and "}" in clean_text:
-                data = json.loads(clean_text)
-                if data.get("status") == "completed":
-                    # Вычисляем общее время формирования требований
-                    total_time = time.time() - metrics[user_id]["first_message_time"]
-                    data["metrics"] = {
-                        "total_time_seconds": round(total_time, 2),
-                        "total_time_minutes": round(total_time / 60, 2),
-                        "messages_count": metrics[user_id]["messages_count"],
-                        "last_request_time": round(request_time, 2)
-                    }
-                    # Очищаем метрики после завершения
-                    if user_id in metrics:
-                        del metrics[user_id]
-                    return {"type": "final", "data": data}
-        except json.JSONDecodeError:
-            pass # Значит это просто текст вопроса
+        async with gemini_scheduler.user_turn(user_id):
+            # 1. Сессия чата: из памяти, из базы (вместе с метриками незавершенного диалога) или новая
+            chat = await _get_chat(user_id)
+            _start_metrics(user_id)
+            
+            # История не должна меняться, пока идет фоновое сжатие
+            await wait_for_compaction(chat)
+            
+            if chat.history:
+                cache_key = None
+            elif cache_key is not None:
+                # Тот же файл с той же подписью уже разбирался - ответ из кеша без запроса к модели
+                cached_text = await asyncio.to_thread(response_cache.get, cache_key)
+                logging.info(f"Кеш ответов: {response_cache.describe()}")
+                if cached_text is not None:
+                    parts = content if isinstance(content, list) else [content]
+                    chat.history = [{"role": "user", "parts": parts}, {"role": "model", "parts": [cached_text]}]
+                    chats.grow(user_id, _turns_size(chat.history))
+                    record_turn(chat, None)
+                    return _parse_response(user_id, chat, cached_text, 0.0)
+            
+            # 2. Ждем квоту и отправляем сообщение (асинхронный API, общий лимит одновременных запросов)
+            estimated_tokens = estimate_request_tokens(chat, text) + extra_tokens
+            await gemini_scheduler.acquire(estimated_tokens, on_wait)
+            start_request = time.time()
+            turns_before = len(chat.history)
+            response = await send_chat_message(chat, content, on_chunk)
+            request_time = time.time() - start_request
+            # Размер сессии растет на новые реплики, без обхода всей истории
+            chats.grow(user_id, _turns_size(chat.history[turns_before:]))
+            
+            usage = getattr(response, "usage_metadata", None)
+            gemini_scheduler.settle(estimated_tokens, getattr(usage, "total_token_count", 0) or 0)
             
-        return {"type": "text", "text": ai_text}
+            # Учитываем токены хода и при превышении бюджета сворачиваем старые реплики в фоне
+            record_turn(chat, response)
+            schedule_compaction(chat, on_compacted=lambda: chats.remeasure(user_id))
+            
+            if cache_key is not None:
+                await asyncio.to_thread(response_cache.put, cache_key, response.text)
+            
+            # 3. Проверяем, не вернул ли он JSON (финал) - по собранному тексту, в том числе при потоке
+            return _parse_response(user_id, chat, response.text, request_time)
+    except SchedulerBusy as e:
+        return {"type": "busy", "text": str(e)}
     except Exception as e:
         return {"type": "error", "text": str(e)}
 
-async def get_ai_response_with_image(user_id: int, user_text: str, image_path: str):
+async def get_ai_response(user_id: int, user_text: str,
+                          on_wait: Optional[Callable[[int], Awaitable]] = None,
+                          on_chunk: Optional[Callable[[str], Awaitable]] = None,
+                          cache_key: Optional[str] = None):
+    """
+    Ответ аналитика на текстовое сообщение.
+    on_wait(position) вызывается, если запрос встал в очередь (для уведомления пользователя).
+    on_chunk(text) включает потоковый режим: вызывается на каждый фрагмент ответа.
+    cache_key (response_cache_key) - для сообщений с файлом: первый ход берется из кеша ответов.
+    """
+    return await _run_turn(user_id, user_text, user_text, on_wait=on_wait, on_chunk=on_chunk,
+                           cache_key=cache_key)
+
+async def get_ai_response_with_image(user_id: int, user_text: str, image_path: str,
+                                     on_wait: Optional[Callable[[int], Awaitable]] = None,
+                                     on_chunk: Optional[Callable[[str], Awaitable]] = None,
+                                     cache_key: Optional[str] = None):
     """Обрабатывает сообщение с изображением через Gemini Vision"""
     try:
-        # Инициализация метрик
-        if user_id not in metrics:
-            metrics[user_id] = {
-                "start_time": time.time(),
-                "messages_count": 0,
-                "first_message_time": None
-            }
-        
-        metrics[user_id]["messages_count"] += 1
-        if metrics[user_id]["first_message_time"] is None:
-            metrics[user_id]["first_message_time"] = time.time()
-        
-        # Создаем модель с поддержкой изображений
-        if user_id not in chats:
-            model = genai.GenerativeModel(
-                model_name="gemini-2.0-flash",
-                system_instruction=SYSTEM_PROMPT
-            )
-            chats[user_id] = model.start_chat(history=[])
-        
-        chat = chats[user_id]
-        
         # Загружаем изображение
         image = Image.open(image_path)
-        
-        # Отправляем сообщение с изображением
-        start_request = time.time()
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.get_event_loop()
-        
-        response = await loop.run_in_executor(
-            None, 
-            lambda: chat.send_message([user_text, image])
-        )
-        request_time = time.time() - start_request
-        
-        ai_text = response.text
-        
-        # Проверяем JSON ответ
-        clean_text = ai_text.replace("```json", "").replace("```", "").strip()
-        
-        try:
-            if "{" in clean_text and "}" in clean_text:
-                data = json.loads(clean_text)
-                if data.get("status") == "completed":
-                    total_time = time.time() - metrics[user_id]["first_message_time"]
-                    data["metrics"] = {
-                        "total_time_seconds": round(total_time, 2),
-                        "total_time_minutes": round(total_time / 60, 2),
-                        "messages_count": metrics[user_id]["messages_count"],
-                        "last_request_time": round(request_time, 2)
-                    }
-                    if user_id in metrics:
-                        del metrics[user_id]
-                    return {"type": "final", "data": data}
-        except json.JSONDecodeError:
-            pass
-        
-        return {"type": "text", "text": ai_text}
     except Exception as e:
         return {"type": "error", "text": str(e)}
-
-def generate_diagram_link(mermaid_code: str) -> str:
-    """Превращает код диаграммы в картинку через сервис mermaid.ink"""
-    graphbytes = mermaid_code.encode("utf8")
-    base64_bytes = base64.b64encode(graphbytes)
-    base64_string = base64_bytes.decode("ascii")
-    return "https://mermaid.ink/img/" + base64_string
-
+    return await _run_turn(user_id, [user_text, image], user_text,
+                           extra_tokens=IMAGE_TOKENS, on_wait=on_wait, on_chunk=on_chunk,
+                           cache_key=cache_key)
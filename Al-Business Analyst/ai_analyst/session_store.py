@@ -0,0 +1,190 @@
+"""
+Ограниченное хранилище пользовательских сессий.
+Заменяет глобальные словари chats, metrics и user_files_cache: записи
+удаляются после простоя (TTL), при превышении числа сессий и при выходе
+за бюджет памяти - в порядке давности последнего обращения (LRU).
+Счетчики вытеснений доступны через stats и session_stats().
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+# Сколько хранится сессия диалога без обращений
+SESSION_TTL_SECONDS = 6 * 60 * 60
+
+# Максимум одновременно хранимых сессий
+MAX_SESSIONS = 1000
+
+# Бюджет памяти на истории диалогов
+MAX_SESSION_MEMORY_BYTES = 256 * 1024 * 1024
+
+# Как часто фоновая задача удаляет просроченные сессии
+SESSION_SWEEP_INTERVAL_SECONDS = 10 * 60
+
+_MISSING = object()
+
+# Все созданные хранилища - для периодической очистки и статистики
+_stores: "weakref.WeakSet[SessionStore]" = weakref.WeakSet()
+
+
+class _Entry:
+    __slots__ = ("value", "last_access", "size")
+
+    def __init__(self, value, size: int):
+        self.value = value
+        self.last_access = time.monotonic()
+        self.size = size
+
+
+class SessionStore:
+    """
+    Словарь сессий {user_id: значение} с TTL, лимитом числа записей
+    и бюджетом памяти. Поддерживает in, get, [], del, pop и len.
+
+    sizeof(value) - оценка размера значения в байтах; считается только
+    при записи. Значения, которые растут на месте (истории чатов), сообщают
+    о росте через grow() или пересчитываются целиком через remeasure().
+    """
+
+    def __init__(self, name: str, ttl_seconds: float = SESSION_TTL_SECONDS,
+                 max_sessions: int = MAX_SESSIONS, max_bytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {"expired": 0, "evicted_lru": 0, "evicted_memory": 0}
+        _stores.add(self)
+
+    def _measure(self, value) -> int:
+        if self._sizeof is None:
+            return 0
+        try:
+            return self._sizeof(value)
+        except Exception:
+            return 0
+
+    def _remove(self, key: Hashable) -> _Entry:
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.size
+        return entry
+
+    def _is_expired(self, entry: _Entry, now: float) -> bool:
+        return now - entry.last_access > self.ttl_seconds
+
+    def _live_entry(self, key: Hashable) -> Optional[_Entry]:
+        """Запись без просроченных; обращение продлевает жизнь записи"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if self._is_expired(entry, now):
+            self._remove(key)
+            self.stats["expired"] += 1
+            return None
+        entry.last_access = now
+        self._entries.move_to_end(key)
+        return entry
+
+    def _set_size(self, key: Hashable, size: int):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        size = max(0, size)
+        self.total_bytes += size - entry.size
+        entry.size = size
+        self._enforce_limits(keep=key)
+
+    def _enforce_limits(self, keep: Hashable = _MISSING):
+        """Вытесняет самые давние сессии сверх лимитов (текущую запись keep не трогаем)"""
+        while len(self._entries) > self.max_sessions:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            self._remove(oldest)
+            self.stats["evicted_lru"] += 1
+        if self.max_bytes is None:
+            return
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            oldest = next(iter(self._entries))
+            if oldest == keep:
+                break
+            self._remove(oldest)
+            self.stats["evicted_memory"] += 1
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._live_entry(key) is not None
+
+    def get(self, key: Hashable, default=None):
+        entry = self._live_entry(key)
+        return entry.value if entry is not None else default
+
+    def __getitem__(self, key: Hashable):
+        entry = self._live_entry(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry.value
+
+    def __setitem__(self, key: Hashable, value):
+        if key in self._entries:
+            self._remove(key)
+        entry = _Entry(value, self._measure(value))
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        self._enforce_limits(keep=key)
+
+    def grow(self, key: Hashable, nbytes: int):
+        """Учитывает рост значения на месте (например, новые реплики истории) без пересчета sizeof"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._set_size(key, entry.size + nbytes)
+
+    def remeasure(self, key: Hashable):
+        """Пересчитывает размер значения через sizeof (после перезаписи на месте)"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._set_size(key, self._measure(entry.value))
+
+    def __delitem__(self, key: Hashable):
+        self._remove(key)
+
+    def pop(self, key: Hashable, default=None):
+        if key not in self._entries:
+            return default
+        return self._remove(key).value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def sweep(self) -> int:
+        """Удаляет просроченные сессии, возвращает их число"""
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if self._is_expired(entry, now)]
+        for key in expired:
+            self._remove(key)
+        self.stats["expired"] += len(expired)
+        self._enforce_limits()
+        return len(expired)
+
+
+def session_stats() -> Dict[str, Dict]:
+    """Размер и счетчики вытеснений всех хранилищ"""
+    return {
+        store.name: {"sessions": len(store), "bytes": store.total_bytes, **store.stats}
+        for store in list(_stores)
+    }
+
+
+async def run_session_janitor(interval: float = SESSION_SWEEP_INTERVAL_SECONDS):
+    """Фоновая задача: периодически удаляет просроченные сессии во всех хранилищах"""
+    while True:
+        await asyncio.sleep(interval)
+        for store in list(_stores):
+            store.sweep()
+        logging.info(f"Сессии: {session_stats()}")
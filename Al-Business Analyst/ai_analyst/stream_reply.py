@@ -0,0 +1,90 @@
+"""
+Потоковый вывод ответа Gemini в Telegram.
+Первый фрагмент ответа отправляется сообщением сразу, дальше сообщение
+редактируется не чаще раза в EDIT_INTERVAL_SECONDS; правки идут через
+общий лимитер чата (telegram_outbox), как и остальные отправки.
+Итоговый JSON с требованиями по мере генерации не показывается:
+его разбирает services по собранному тексту ответа.
+"""
+import time
+from typing import Optional
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from telegram_outbox import TELEGRAM_MESSAGE_LIMIT, send_text, split_message, telegram_limiter
+
+# Минимальный интервал между правками одного сообщения (секунды)
+EDIT_INTERVAL_SECONDS = 1.5
+
+# Признак того, что ответ еще генерируется
+CURSOR = " ▌"
+
+# Сколько раз повторять итоговую правку при ответе Telegram "retry after" (промежуточные - один раз)
+FINAL_EDIT_ATTEMPTS = 3
+
+
+def _looks_like_json(text: str) -> bool:
+    stripped = text.lstrip()
+    return stripped.startswith("{") or stripped.startswith("```")
+
+
+class StreamingReply:
+    """Сообщение, которое дописывается по мере поступления фрагментов ответа"""
+
+    def __init__(self, message: types.Message, prefix: str = "", interval: float = EDIT_INTERVAL_SECONDS):
+        self.message = message
+        self.prefix = prefix
+        self.interval = interval
+        self.text = ""
+        self.sent: Optional[types.Message] = None
+        self.hidden: Optional[bool] = None
+        self._shown = ""
+        self._next_edit = 0.0
+
+    async def push(self, chunk: str):
+        """Очередной фрагмент ответа (используется как on_chunk для services)"""
+        self.text += chunk
+        if self.hidden is None and self.text.strip():
+            # Итоговый JSON пользователю по частям не показываем
+            self.hidden = _looks_like_json(self.text)
+        if self.hidden is not False or time.monotonic() < self._next_edit:
+            return
+        preview = (self.prefix + self.text)[:TELEGRAM_MESSAGE_LIMIT - len(CURSOR)]
+        await self._show(preview + CURSOR)
+
+    async def _show(self, text: str, final: bool = False):
+        if text == self._shown:
+            return
+        chat_id = self.message.chat.id
+        attempts = FINAL_EDIT_ATTEMPTS if final else 1
+        try:
+            if self.sent is None:
+                self.sent = await telegram_limiter.send(chat_id, self.message.answer, text, attempts=attempts)
+            else:
+                await telegram_limiter.send(chat_id, self.sent.edit_text, text, attempts=attempts)
+            self._shown = text
+            self._next_edit = time.monotonic() + self.interval
+        except TelegramRetryAfter as e:
+            # Промежуточную правку пропускаем: лимитер уже приостановил чат на это время
+            self._next_edit = time.monotonic() + e.retry_after
+        except TelegramBadRequest:
+            # Например, "message is not modified"
+            pass
+
+    async def finish(self, text: str):
+        """Итоговый текст: последняя правка сообщения, не поместившееся уходит следующими сообщениями"""
+        parts = split_message(self.prefix + text)
+        await self._show(parts[0], final=True)
+        for part in parts[1:]:
+            await send_text(self.message, part)
+
+    async def discard(self):
+        """Удаляет промежуточное сообщение (ответ оказался итоговым JSON или ошибкой)"""
+        if self.sent is None:
+            return
+        try:
+            await self.sent.delete()
+        except TelegramBadRequest:
+            pass
+        self.sent = None
@@ -0,0 +1,101 @@
+"""
+Онлайн-аккумуляторы для потокового (однопроходного) анализа CSV.
+Память не зависит от размера файла: храним только счетчики и суммы.
+"""
+import math
+import os
+from typing import List, Optional
+
+# Файлы крупнее этого порога анализируются потоково автоматически
+STREAMING_FILE_SIZE_THRESHOLD = 200 * 1024 * 1024
+
+
+def should_stream(file_path: str, streaming: Optional[bool] = None) -> bool:
+    """Явный выбор режима или автоматический по размеру файла"""
+    if streaming is not None:
+        return streaming
+    return os.path.getsize(file_path) > STREAMING_FILE_SIZE_THRESHOLD
+
+
+def _add_exact(partials: List[float], value: float):
+    """
+    Точное суммирование (алгоритм Шевчука, как в math.fsum).
+    Сумма не зависит от порядка слагаемых, поэтому частичные суммы
+    из разных процессов объединяются без расхождений с последовательным проходом.
+    """
+    i = 0
+    for y in partials:
+        if abs(value) < abs(y):
+            value, y = y, value
+        hi = value + y
+        lo = y - (hi - value)
+        if lo:
+            partials[i] = lo
+            i += 1
+        value = hi
+    partials[i:] = [value]
+
+
+class RunningStats:
+    """Количество, сумма, минимум/максимум и дисперсия (алгоритм Уэлфорда) за один проход"""
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._partials: List[float] = []
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, value: float):
+        self.count += 1
+        _add_exact(self._partials, value)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def merge(self, other: "RunningStats"):
+        """Объединяет со статистикой другой части файла (формула Чана для дисперсии)"""
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.min, self.max = other.min, other.max
+            self._partials = list(other._partials)
+            self._mean, self._m2 = other._mean, other._m2
+            return
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        for value in other._partials:
+            _add_exact(self._partials, value)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def total(self) -> float:
+        return math.fsum(self._partials)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / self.count if self.count else 0
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    def min_or(self, default: float = 0) -> float:
+        return self.min if self.count else default
+
+    def max_or(self, default: float = 0) -> float:
+        return self.max if self.count else default
@@ -0,0 +1,167 @@
+"""
+Отправка сообщений в Telegram с ограничением частоты.
+Отчет из десятков разделов упаковывается в минимальное число сообщений
+до 4096 символов (MessageBatcher), а каждый вызов Bot API проходит через
+лимитер: в одном чате - не чаще PER_CHAT_MESSAGES_PER_MINUTE с небольшим
+запасом на всплеск, для всего бота - не чаще GLOBAL_MESSAGES_PER_SECOND.
+Ответ Telegram "retry after" приостанавливает чат на указанное время,
+после чего отправка повторяется.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from gemini_scheduler import TokenBucket
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Лимиты Telegram: около 1 сообщения в секунду в чате (кратко можно чаще), 30 в секунду на бота
+PER_CHAT_MESSAGES_PER_MINUTE = 60
+PER_CHAT_BURST = 3
+GLOBAL_MESSAGES_PER_SECOND = 30
+
+# Сколько раз повторять отправку после "retry after"
+MAX_SEND_ATTEMPTS = 3
+
+# Сколько чатов держать в лимитере, прежде чем удалять простаивающие
+MAX_TRACKED_CHATS = 1000
+
+# Разделитель разделов внутри одного сообщения
+SECTION_SEPARATOR = "\n\n"
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Делит текст на части не длиннее limit, по возможности по переводам строк"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+class _ChatState:
+    __slots__ = ("lock", "bucket", "blocked_until", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+        self.bucket = TokenBucket(PER_CHAT_BURST, PER_CHAT_MESSAGES_PER_MINUTE)
+        self.blocked_until = 0.0
+
+
+class ChatRateLimiter:
+    """Лимит частоты вызовов Bot API по чатам и для бота в целом; порядок сообщений в чате сохраняется"""
+
+    def __init__(self, global_per_second: int = GLOBAL_MESSAGES_PER_SECOND):
+        self.global_bucket = TokenBucket(global_per_second, global_per_second * 60)
+        self._chats: Dict[int, _ChatState] = {}
+        self.stats = {"sent": 0, "throttled": 0, "retry_after": 0}
+
+    @asynccontextmanager
+    async def slot(self, chat_id: int):
+        """Очередь на отправку в чат: внутри блока можно сделать один вызов Bot API"""
+        if len(self._chats) > MAX_TRACKED_CHATS:
+            self._chats = {key: value for key, value in self._chats.items() if value.users}
+        state = self._chats.setdefault(chat_id, _ChatState())
+        state.users += 1
+        try:
+            async with state.lock:
+                while True:
+                    delay = max(state.blocked_until - time.monotonic(),
+                                state.bucket.delay(1), self.global_bucket.delay(1))
+                    if delay <= 0:
+                        break
+                    self.stats["throttled"] += 1
+                    await asyncio.sleep(delay)
+                state.bucket.take(1)
+                self.global_bucket.take(1)
+                self.stats["sent"] += 1
+                yield state
+        finally:
+            # Состояние чата без ожидающих отправок не храним
+            state.users -= 1
+            if not state.users and state.bucket.delay(PER_CHAT_BURST) <= 0 \
+                    and state.blocked_until <= time.monotonic() and self._chats.get(chat_id) is state:
+                del self._chats[chat_id]
+
+    async def send(self, chat_id: int, call: Callable[..., Awaitable], *args,
+                   attempts: int = MAX_SEND_ATTEMPTS, **kwargs):
+        """
+        Вызов Bot API через лимитер с повтором после "retry after".
+        attempts=1 - без повтора: TelegramRetryAfter сразу уходит вызывающему, чат остается приостановленным.
+        """
+        for attempt in range(attempts):
+            async with self.slot(chat_id) as state:
+                try:
+                    return await call(*args, **kwargs)
+                except TelegramRetryAfter as e:
+                    self.stats["retry_after"] += 1
+                    state.blocked_until = time.monotonic() + e.retry_after
+                    if attempt == attempts - 1:
+                        raise
+                    # Пауза выдерживается здесь, пока очередь чата занята
+                    await asyncio.sleep(e.retry_after)
+
+
+# Общий лимитер бота
+telegram_limiter = ChatRateLimiter()
+
+
+async def send_text(message: types.Message, text: str, parse_mode: Optional[str] = None) -> types.Message:
+    """Текст в чат сообщения через лимитер; если разметка не разобралась - отправка без нее"""
+    try:
+        return await telegram_limiter.send(message.chat.id, message.answer, text, parse_mode=parse_mode)
+    except TelegramBadRequest:
+        if parse_mode is None:
+            raise
+        return await telegram_limiter.send(message.chat.id, message.answer, text)
+
+
+class MessageBatcher:
+    """
+    Собирает разделы в сообщения до TELEGRAM_MESSAGE_LIMIT символов.
+    Раздел целиком попадает в одно сообщение; раздел длиннее лимита делится по строкам.
+    """
+
+    def __init__(self, message: types.Message, parse_mode: Optional[str] = "Markdown",
+                 limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.message = message
+        self.parse_mode = parse_mode
+        self.limit = limit
+        self._pending: List[str] = []
+        self._length = 0
+        self.messages_sent = 0
+
+    async def add(self, text: str):
+        text = text.strip()
+        if not text:
+            return
+        extra = len(text) + (len(SECTION_SEPARATOR) if self._pending else 0)
+        if self._pending and self._length + extra > self.limit:
+            await self.flush()
+            extra = len(text)
+        if len(text) > self.limit:
+            for part in split_message(text, self.limit):
+                await self.add(part)
+            return
+        self._pending.append(text)
+        self._length += extra
+
+    async def flush(self):
+        """Отправляет накопленное (перед фото, файлами и долгими шагами)"""
+        if not self._pending:
+            return
+        text = SECTION_SEPARATOR.join(self._pending)
+        self._pending = []
+        self._length = 0
+        await send_text(self.message, text, self.parse_mode)
+        self.messages_sent += 1
@@ -0,0 +1,131 @@
+"""
+Колоночное представление транзакций на базе NumPy.
+Вместо словаря на каждую строку CSV храним типизированные массивы,
+а все агрегаты считаем векторно.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from columnar_cache import ColumnarTable
+from csv_ingest import batched, concat_columns, open_csv, parse_int, to_datetime64
+
+
+class TransactionTable(ColumnarTable):
+    """Таблица транзакций с типизированными колонками"""
+
+    CACHE_KIND = "transactions"
+    COLUMNS = ("cst_dim_id", "transdate", "transdatetime", "amount", "docno",
+               "direction", "direction_categories", "target")
+
+    def __init__(self, cst_dim_id: np.ndarray, transdate: np.ndarray, transdatetime: np.ndarray,
+                 amount: np.ndarray, docno: np.ndarray, direction: np.ndarray,
+                 direction_categories: np.ndarray, target: np.ndarray):
+        self.cst_dim_id = cst_dim_id
+        self.transdate = transdate
+        self.transdatetime = transdatetime
+        self.amount = amount
+        self.docno = docno
+        self.direction = direction
+        self.direction_categories = direction_categories
+        self.target = target
+
+    def __len__(self) -> int:
+        return len(self.amount)
+
+    @classmethod
+    def from_batches(cls, batches: Iterable[List[List[str]]]) -> "TransactionTable":
+        """
+        Строит таблицу из пакетов строк CSV (кавычки с дат уже сняты слоем csv_ingest).
+        Каждый пакет сразу переводится в массивы, списки живут только в пределах пакета.
+        """
+        ids: List[np.ndarray] = []
+        dates: List[np.ndarray] = []
+        datetimes: List[np.ndarray] = []
+        amounts: List[np.ndarray] = []
+        docnos: List[np.ndarray] = []
+        directions: List[np.ndarray] = []
+        targets: List[np.ndarray] = []
+        categories: Dict[str, int] = {}
+
+        for batch in batches:
+            rows = [row for row in batch if len(row) >= 7]
+            if not rows:
+                continue
+            ids.append(np.array([parse_int(row[0]) for row in rows], dtype=np.int64))
+            dates.append(to_datetime64([row[1][:10] for row in rows], "D"))
+            datetimes.append(to_datetime64([row[2][:19] for row in rows], "s"))
+            amounts.append(np.array([float(row[3]) if row[3] else 0 for row in rows], dtype=np.float64))
+            docnos.append(np.array([parse_int(row[4]) for row in rows], dtype=np.int64))
+            directions.append(np.array([categories.setdefault(row[5], len(categories)) for row in rows],
+                                       dtype=np.int32))
+            targets.append(np.array([1 if row[6] == '1' else 0 for row in rows], dtype=np.int8))
+
+        return cls(
+            cst_dim_id=concat_columns(ids, np.int64),
+            transdate=concat_columns(dates, "datetime64[D]"),
+            transdatetime=concat_columns(datetimes, "datetime64[s]"),
+            amount=concat_columns(amounts, np.float64),
+            docno=concat_columns(docnos, np.int64),
+            direction=concat_columns(directions, np.int32),
+            direction_categories=np.array(list(categories), dtype=str),
+            target=concat_columns(targets, np.int8),
+        )
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[str]]) -> "TransactionTable":
+        """Строит таблицу из потока строк CSV (разбивается на пакеты, см. from_batches)"""
+        return cls.from_batches(batched(rows))
+
+    @classmethod
+    def from_csv(cls, file_path: str) -> "TransactionTable":
+        """Читает CSV выгрузку транзакций. Бросает CsvIngestError, если файл не читается"""
+        with open_csv(file_path) as source:
+            return cls.from_batches(source.batches())
+
+    def records(self, limit: int = 5, indices: Optional[Sequence[int]] = None) -> List[Dict]:
+        """Строки таблицы в виде словарей: первые limit или с номерами indices (для примеров в отчете)"""
+        if indices is None:
+            indices = range(min(limit, len(self)))
+        result = []
+        for i in indices:
+            result.append({
+                'cst_dim_id': str(self.cst_dim_id[i]),
+                'transdate': str(self.transdate[i]),
+                'transdatetime': str(self.transdatetime[i]).replace('T', ' '),
+                'amount': float(self.amount[i]),
+                'docno': str(self.docno[i]),
+                'direction': str(self.direction_categories[self.direction[i]]),
+                'target': int(self.target[i])
+            })
+        return result
+
+    def statistics(self) -> Dict:
+        """Векторно считает агрегаты по таблице"""
+        total = len(self)
+        fraud_mask = self.target == 1
+        target_1 = int(np.count_nonzero(fraud_mask))
+        target_0 = total - target_1
+        fraud_percent = (target_1 / total * 100) if total > 0 else 0
+
+        amounts = self.amount
+        avg_amount = float(amounts.mean()) if total else 0
+        max_amount = float(amounts.max()) if total else 0
+        min_amount = float(amounts.min()) if total else 0
+
+        fraud_amounts = amounts[fraud_mask]
+        avg_fraud_amount = float(fraud_amounts.mean()) if target_1 else 0
+        std_amount = float(amounts.std()) if total else 0
+
+        return {
+            "total_transactions": total,
+            "normal_transactions": target_0,
+            "fraud_transactions": target_1,
+            "fraud_percentage": round(fraud_percent, 2),
+            "avg_amount": round(avg_amount, 2),
+            "max_amount": round(max_amount, 2),
+            "min_amount": round(min_amount, 2),
+            "avg_fraud_amount": round(avg_fraud_amount, 2),
+            "std_amount": round(std_amount, 2),
+            "sample_transactions": self.records(5)
+        }
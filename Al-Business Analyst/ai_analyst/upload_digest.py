@@ -0,0 +1,163 @@
+"""
+Дайджест загруженной CSV выгрузки для Gemini.
+Схема файла (транзакции или поведенческие паттерны) определяется по строке
+с именами колонок, файл целиком разбирается локально теми же таблицами,
+что и /transactions и /behavior, а в модель уходят только агрегаты и
+небольшая стратифицированная выборка строк вместо сырого начала файла.
+"""
+import csv
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from behavior_table import BehaviorTable
+from csv_ingest import CsvIngestError, open_csv, sniff_file_encoding
+from transaction_table import TransactionTable
+
+# Сколько строк выборки отправляем в модель (делятся поровну между группами)
+DIGEST_SAMPLE_SIZE = 12
+
+# Сколько символов файла показываем модели, если схема не распознана
+UPLOAD_PREVIEW_CHARS = 5000
+
+# Обязательные колонки каждой схемы
+SCHEMA_COLUMNS = {
+    "transactions": {"cst_dim_id", "transdate", "transdatetime", "amount", "docno", "direction", "target"},
+    "behavior": {"transdate", "cst_dim_id", "monthly_os_changes", "monthly_phone_model_changes",
+                 "last_phone_model_categorical", "last_os_categorical",
+                 "logins_last_7_days", "logins_last_30_days"},
+}
+
+# Таблица, которой разбирается выгрузка каждой схемы
+SCHEMA_TABLES = {
+    "transactions": TransactionTable,
+    "behavior": BehaviorTable,
+}
+
+SCHEMA_TITLES = {
+    "transactions": "выгрузка транзакций",
+    "behavior": "выгрузка поведенческих паттернов клиентов",
+}
+
+
+def schema_for_columns(columns: Sequence[str]) -> Optional[str]:
+    """Тип выгрузки по именам колонок или None"""
+    columns = set(columns)
+    for schema, required in SCHEMA_COLUMNS.items():
+        if required <= columns:
+            return schema
+    return None
+
+
+def detect_schema(file_path: str) -> Optional[str]:
+    """Тип выгрузки по именам колонок или None, если файл не похож на известные выгрузки"""
+    try:
+        with open_csv(file_path) as source:
+            return schema_for_columns(source.columns)
+    except (CsvIngestError, csv.Error, OSError, UnicodeDecodeError):
+        return None
+
+
+def stratified_indices(strata: np.ndarray, size: int = DIGEST_SAMPLE_SIZE) -> np.ndarray:
+    """
+    Номера строк выборки: поровну из каждой группы, внутри группы - равномерно
+    по файлу. Редкие группы (мошенничество) попадают в выборку наравне с частыми.
+    """
+    groups = np.unique(strata)
+    if not len(groups):
+        return np.array([], dtype=np.int64)
+    per_group = max(1, size // len(groups))
+    picked = []
+    for group in groups:
+        rows = np.flatnonzero(strata == group)
+        take = min(per_group, len(rows))
+        picked.append(rows[np.linspace(0, len(rows) - 1, take).astype(np.int64)])
+    return np.sort(np.concatenate(picked))
+
+
+def build_upload_digest(file_path: str, sample_size: int = DIGEST_SAMPLE_SIZE) -> Optional[Dict]:
+    """
+    Разбирает выгрузку целиком и возвращает агрегаты и выборку.
+    None, если схема не распознана или файл не читается.
+    """
+    schema = detect_schema(file_path)
+    if schema is None:
+        return None
+    try:
+        table = SCHEMA_TABLES[schema].load(file_path)
+    except CsvIngestError:
+        return None
+    return digest_from_table(schema, table, sample_size)
+
+
+def digest_from_table(schema: str, table, sample_size: int = DIGEST_SAMPLE_SIZE) -> Optional[Dict]:
+    """Агрегаты и выборка по уже разобранной таблице (например, собранной во время загрузки)"""
+    if schema == "transactions":
+        stats = table.statistics()
+        stats.pop("sample_transactions", None)
+        strata = np.asarray(table.target)
+        strata_title = "target (0 - чистая, 1 - мошенническая)"
+    elif schema == "behavior":
+        stats = table.statistics()
+        suspicious = (np.asarray(table.monthly_os_changes) >= 3) | (np.asarray(table.monthly_phone_model_changes) >= 3)
+        low_activity = np.asarray(table.logins_last_30_days) < 5
+        strata = suspicious.astype(np.int8) * 2 + low_activity.astype(np.int8)
+        strata_title = "частая смена устройства/ОС × низкая активность"
+    else:
+        return None
+
+    if "error" in stats:
+        return None
+    return {
+        "schema": schema,
+        "rows": len(table),
+        "statistics": stats,
+        "strata": strata_title,
+        "sample": table.records(indices=stratified_indices(strata, sample_size)),
+    }
+
+
+def _sample_as_csv(sample: List[Dict]) -> str:
+    """Выборка в виде CSV: так короче, чем JSON с именами полей в каждой строке"""
+    if not sample:
+        return ""
+
+    def cell(value) -> str:
+        return str(round(value, 3)) if isinstance(value, float) else str(value)
+
+    columns = list(sample[0])
+    lines = [";".join(columns)]
+    lines.extend(";".join(cell(row[column]) for column in columns) for row in sample)
+    return "\n".join(lines)
+
+
+def format_upload_digest(digest: Dict, file_name: str) -> str:
+    """Компактный текст дайджеста для запроса к Gemini"""
+    stats = json.dumps(digest["statistics"], ensure_ascii=False, separators=(",", ":"))
+    return (
+        f"Загружен файл {file_name}: {SCHEMA_TITLES[digest['schema']]}, {digest['rows']:,} строк.\n"
+        f"Агрегаты по всему файлу (посчитаны локально):\n{stats}\n\n"
+        f"Стратифицированная выборка ({len(digest['sample'])} строк, поровну по группам: {digest['strata']}):\n"
+        f"{_sample_as_csv(digest['sample'])}"
+    )
+
+
+def read_preview(file_path: str, limit: int = UPLOAD_PREVIEW_CHARS) -> str:
+    """Начало текстового файла (не больше limit символов) для нераспознанных файлов"""
+    encoding = sniff_file_encoding(file_path) or 'utf-8'
+    with open(file_path, 'r', encoding=encoding, errors='ignore') as f:
+        return f.read(limit)
+
+
+def describe_upload(file_path: str, file_name: str, parsed: Optional[Tuple[str, object]] = None) -> str:
+    """
+    Текст о загруженном файле для модели: дайджест выгрузки или начало файла.
+    parsed - (схема, таблица), если выгрузка уже разобрана во время загрузки.
+    """
+    if os.path.splitext(file_name)[1].lower() == '.csv':
+        digest = digest_from_table(*parsed) if parsed else build_upload_digest(file_path)
+        if digest is not None:
+            return format_upload_digest(digest, file_name)
+    return f"Содержимое файла {file_name}:\n\n{read_preview(file_path)}"
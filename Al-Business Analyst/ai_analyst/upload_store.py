@@ -0,0 +1,201 @@
+"""
+Загрузка документов из Telegram с хранением по содержимому.
+Файл принимается потоком: каждый фрагмент один раз пишется на диск, по
+нему же считается SHA-256, проверяется размер, а по первым байтам -
+кодировка и строка с именами колонок. Файл слишком большой или не похожий
+на текст отклоняется после первого фрагмента. Известная CSV выгрузка
+разбирается в таблицу в рабочем потоке, пока остаток файла еще скачивается.
+
+Одинаковое содержимое хранится один раз (temp_files/blobs/<sha256><расширение>),
+а файлы пользователей - жесткие ссылки на него (save_file). Если Telegram
+уже присылал этот файл (тот же file_unique_id), он не скачивается вовсе.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from typing import BinaryIO, Dict, Optional
+
+from aiogram import Bot, types
+
+from columnar_cache import remember_content_hash
+from csv_ingest import SNIFF_BYTES, CsvIngestError, CsvStream, detect_encoding
+from file_handler import BLOB_DIR, catalog, save_file, store_blob
+from upload_digest import SCHEMA_TABLES, schema_for_columns
+
+# Лимит Bot API на скачивание файлов (локальный сервер Bot API позволяет больше)
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+# Файлы, которые читаются как текст: их кодировка проверяется по первым байтам
+TEXT_EXTENSIONS = {".csv", ".txt", ".md"}
+
+
+class UploadRejected(Exception):
+    """Файл отклонен во время загрузки (размер, формат)"""
+
+
+class UploadSink:
+    """
+    Файл для bot.download_file: пишет фрагменты на диск и по ходу загрузки
+    считает хеш, проверяет размер и кодировку, разбирает CSV выгрузку.
+    """
+
+    def __init__(self, file: BinaryIO, file_ext: str, max_bytes: int = MAX_UPLOAD_BYTES):
+        self._file = file
+        self._digest = hashlib.sha256()
+        self.size = 0
+        self.max_bytes = max_bytes
+        self.file_ext = file_ext
+        self._head = b""
+        self.sniffed = file_ext not in TEXT_EXTENSIONS
+        self.encoding: Optional[str] = None
+        self.schema: Optional[str] = None
+        self.stream: Optional[CsvStream] = None
+        self.table_task: Optional[asyncio.Future] = None
+        self.blob: Optional[str] = None
+
+    def write(self, chunk: bytes) -> int:
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadRejected(f"файл больше {self.max_bytes / (1024 * 1024):g} MB")
+        self._digest.update(chunk)
+        self._file.write(chunk)
+        if not self.sniffed:
+            self._head += chunk
+            if len(self._head) >= SNIFF_BYTES:
+                self._sniff()
+        elif self.stream is not None:
+            self._feed(chunk)
+        return len(chunk)
+
+    def flush(self):
+        self._file.flush()
+
+    def hexdigest(self) -> str:
+        return self._digest.hexdigest()
+
+    def _sniff(self):
+        """Проверка начала текстового файла и запуск разбора CSV"""
+        self.sniffed = True
+        head, self._head = self._head, b""
+        sample = head[:SNIFF_BYTES]
+        self.encoding = detect_encoding(sample)
+        if self.encoding is None or b"\x00" in sample:
+            raise UploadRejected("файл не похож на текст в UTF-8 или cp1251")
+        if self.file_ext == ".csv":
+            self.stream = CsvStream(self.encoding)
+            self._feed(head)
+
+    def _feed(self, chunk: bytes, final: bool = False):
+        try:
+            if final:
+                self.stream.finish()
+            else:
+                self.stream.feed(chunk)
+        except (CsvIngestError, UnicodeDecodeError) as e:
+            # Не выгрузка или битая кодировка дальше по файлу - анализ возьмет файл целиком
+            self._stop_stream(str(e))
+            return
+        if self.table_task is None and self.stream.columns is not None:
+            self.schema = schema_for_columns(self.stream.columns)
+            if self.schema is None:
+                self._stop_stream("Неизвестная схема")
+                return
+            table_cls = SCHEMA_TABLES[self.schema]
+            self.table_task = asyncio.ensure_future(asyncio.to_thread(table_cls.from_rows, self.stream.rows()))
+
+    def _stop_stream(self, error: str):
+        self.stream.close(error)
+        self.stream = None
+        self.schema = None
+
+    def finish(self):
+        """Загрузка завершена (короткий файл проверяется только здесь)"""
+        if not self.sniffed:
+            self._sniff()
+        if self.stream is not None:
+            self._feed(b"", final=True)
+
+    def abort(self):
+        """Загрузка прервана: рабочий поток разбора не должен ждать данных"""
+        if self.stream is not None:
+            self._stop_stream("Загрузка прервана")
+
+    async def parsed_table(self):
+        """(схема, таблица), разобранная во время загрузки, или None"""
+        if self.table_task is None:
+            return None
+        try:
+            table = await self.table_task
+        except Exception as e:
+            logging.info(f"Потоковый разбор выгрузки не удался: {e}")
+            return None
+        return (self.schema, table) if self.schema else None
+
+
+async def download_blob(bot: Bot, document: types.Document, file_ext: str) -> UploadSink:
+    """Скачивает документ в хранилище по хешу; путь к blob - в sink.blob"""
+    if document.file_size and document.file_size > MAX_UPLOAD_BYTES:
+        raise UploadRejected(f"файл больше {MAX_UPLOAD_BYTES / (1024 * 1024):g} MB")
+    file_info = await bot.get_file(document.file_id)
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    # Точка в начале: незавершенные загрузки не попадают в каталог
+    tmp_path = os.path.join(BLOB_DIR, f".incoming-{uuid.uuid4().hex}{file_ext}")
+    sink = None
+    try:
+        with open(tmp_path, "wb") as f:
+            sink = UploadSink(f, file_ext)
+            await bot.download_file(file_info.file_path, sink, seek=False)
+            sink.finish()
+        sink.blob, _ = store_blob(tmp_path, sink.hexdigest(), file_ext)
+    except BaseException:
+        if sink is not None:
+            sink.abort()
+            if sink.table_task is not None:
+                await asyncio.gather(sink.table_task, return_exceptions=True)
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    catalog.remember_upload(document.file_unique_id, sink.blob)
+    return sink
+
+
+async def save_document(bot: Bot, document: types.Document, user_id: int) -> Dict:
+    """
+    Сохраняет документ пользователя.
+    Возвращает результат save_file с полями content_hash, downloaded
+    (False - содержимое уже было в хранилище и не скачивалось) и parsed
+    ((схема, таблица), если выгрузка разобрана во время загрузки).
+    """
+    file_ext = os.path.splitext(document.file_name or "file")[1].lower()
+    blob = catalog.upload_blob(document.file_unique_id)
+    sink = None
+    try:
+        if blob is None or not os.path.isfile(blob):
+            sink = await download_blob(bot, document, file_ext)
+            blob = sink.blob
+
+        result = save_file(blob, user_id, "document", blob=blob)
+        if not result["success"] and sink is None:
+            # blob удалили между проверкой и ссылкой - скачиваем заново
+            catalog.forget_upload(document.file_unique_id)
+            sink = await download_blob(bot, document, file_ext)
+            blob = sink.blob
+            result = save_file(blob, user_id, "document", blob=blob)
+    except UploadRejected as e:
+        return {"success": False, "error": f"Файл отклонен: {e}"}
+    parsed = await sink.parsed_table() if sink is not None else None
+    if not result["success"]:
+        return result
+
+    content_hash = os.path.splitext(os.path.basename(blob))[0]
+    remember_content_hash(result["path"], content_hash)
+    result["content_hash"] = content_hash
+    result["downloaded"] = sink is not None
+    result["parsed"] = parsed
+    if parsed:
+        # Бинарный кеш колонок, как после обычного разбора файла
+        await asyncio.to_thread(parsed[1].save_cache, result["path"])
+    return result